@@ -38,7 +38,7 @@ def debug_task(self):
 class IntegrationsRouter(object):
     def route_for_task(self, task, args=None, kwargs=None):
         if any(task.startswith(x) for x in settings.CELERY_IMPORTS):
-            queue = task.split('.')[-2]
+            queue = settings.TASK_QUEUES.get(task, task.split('.')[-2])
             if queue == 'admin':
                 return 'default'
 
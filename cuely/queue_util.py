@@ -1,6 +1,8 @@
 import os
 import redis
 
+_redis_client = None
+
 
 def queue_full(name, threshold=100, r=None):
     if not r:
@@ -13,5 +15,13 @@ def queues_full(queues, threshold=100):
     return any(queue_full(q, threshold, r) for q in queues)
 
 
+def get_redis():
+    """ Shared redis client. The client keeps a connection pool, so there's no need to create one per call. """
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.StrictRedis(host=os.environ['REDIS_ENDPOINT'], port=6379, db=0)
+    return _redis_client
+
+
 def _redis():
-    return redis.StrictRedis(host=os.environ['REDIS_ENDPOINT'], port=6379, db=0)
+    return get_redis()
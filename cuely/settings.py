@@ -216,6 +216,10 @@ CELERY_IMPORTS = (
 CELERY_BROKER_URL = 'redis://' + os.environ['REDIS_ENDPOINT'] + ':6379/0'
 BROKER_URL = 'redis://' + os.environ['REDIS_ENDPOINT'] + ':6379/0'
 CELERY_IGNORE_RESULT = True
+# tasks get ids (of users, documents) and load the objects themselves, so messages stay small and fresh
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'json'
+CELERY_ACCEPT_CONTENT = ['json']
 CELERY_CREATE_MISSING_QUEUES = True
 # define routing for integration tasks (any other task will go to the default 'celery' queue)
 CELERY_ROUTES = ('cuely.celery.IntegrationsRouter', )
@@ -231,8 +235,14 @@ CELERY_QUEUES = (
     Queue('pipedrive', routing_key='pipedrive'),
     Queue('jira', routing_key='jira'),
     Queue('github', routing_key='github'),
-    Queue('trello', routing_key='trello')
+    Queue('trello', routing_key='trello'),
+    Queue('extract', routing_key='extract')
 )
+# tasks that don't run on the queue of their integration
+TASK_QUEUES = {
+    # downloads of files for text extraction take a while, they have their own worker
+    'dataimporter.tasks.gdrive.extract_gdrive_document': 'extract',
+}
 CELERYBEAT_SCHEDULE = {
     'sync-gdrive': {
         'task': 'dataimporter.tasks.gdrive.update_synchronization',
@@ -264,11 +274,27 @@ CELERYBEAT_SCHEDULE = {
     }
 }
 
-# Algolia setup
+# Allowance of external APIs per credential: provider -> (number of requests, per seconds)
+# (see dataimporter/rate_limit.py)
+API_RATE_LIMITS = {
+    'google-oauth2': (1000, 100),
+    'github': (5000, 3600),
+    'trello': (100, 10),
+    'jira-oauth': (60, 60),
+    'pipedrive-apikeys': (100, 10),
+    'helpscout-apikeys': (200, 60),
+    'helpscout-docs-apikeys': (2000, 600),
+}
+
+# Search backend: 'algolia' or 'local' (SQLite database at LOCAL_SEARCH_DB, see dataimporter/algolia/local.py)
+SEARCH_ENGINE = os.environ.get('SEARCH_ENGINE', 'algolia')
+LOCAL_SEARCH_DB = os.environ.get('LOCAL_SEARCH_DB', os.path.join(BASE_DIR, 'search.sqlite3'))
+
+# Algolia setup (the index name is used by the local search backend as well)
 ALGOLIA = {
-    'APPLICATION_ID': os.environ['ALGOLIA_APPLICATION_ID'],
-    'API_KEY': os.environ['ALGOLIA_API_KEY'],
-    'API_SEARCH_KEY': os.environ['ALGOLIA_API_SEARCH_KEY'],
+    'APPLICATION_ID': os.environ.get('ALGOLIA_APPLICATION_ID'),
+    'API_KEY': os.environ.get('ALGOLIA_API_KEY'),
+    'API_SEARCH_KEY': os.environ.get('ALGOLIA_API_SEARCH_KEY'),
     'INDEX_NAME': os.environ['ALGOLIA_INDEX_NAME']
 }
 
@@ -1,81 +1,238 @@
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from django.conf import settings
 from algoliasearch import algoliasearch
+from algoliasearch.helpers import CustomJSONEncoder
 from django.db.models.signals import pre_delete
+from cuely.queue_util import get_redis
 from dataimporter.algolia.index import INDEX_MODEL_MAP
+from dataimporter.models import bulk_update
 from datetime import datetime, timezone
 
 import logging
 logger = logging.getLogger(__name__)
 
+# processes skip setting up an index for this many seconds after it was set up (e.g. after a deploy)
+REGISTRATION_TTL = 24 * 3600
+# list of existing Algolia indexes is cached for this many seconds
+INDEX_LIST_TTL = 3600
+# rows (and index objects) are bulk deleted in chunks of this size
+DELETE_CHUNK_SIZE = 1000
+
 
 class AlgoliaEngineError(Exception):
     """ Something went wrong with Algolia engine. """
 
 
-class AlgoliaEngine(object):
-    def __init__(self, app_id=None, api_key=None):
-        """ Initializes Algolia client and indexes. """
-        if not app_id:
-            app_id = settings.ALGOLIA['APPLICATION_ID']
-            api_key = settings.ALGOLIA['API_KEY']
+class AlgoliaBatch(object):
+    """
+    Collects the objects that would otherwise be sent to Algolia one by one and writes them in batches.
+    The buffer is flushed when it holds 'max_items' objects or 'max_bytes' of (JSON) payload, and when
+    the batch is closed. Fingerprints of the written objects are stored once they are flushed.
+    Writes of the same object are merged, so there is at most one write per object and the writes can be
+    grouped by index and action without changing their outcome.
+    """
+    SAVE = 'save'
+    PARTIAL = 'partial'
+
+    def __init__(self, max_items=1000, max_bytes=5 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        # (algolia index, objectID) -> (action, object)
+        self._buffer = OrderedDict()
+        # (algolia index, objectID) -> (instance, fingerprint)
+        self._fingerprints = OrderedDict()
+        self._items = 0
+        self._bytes = 0
+
+    def add(self, algolia_idx, action, obj, instance=None, fingerprint=None):
+        key = (algolia_idx, obj['objectID'])
+        pending = self._buffer.get(key)
+        if pending is None:
+            self._items = self._items + 1
+            self._buffer[key] = (action, obj)
+        elif action == self.PARTIAL:
+            # the attributes are updated in the pending write (a full save stays a full save)
+            self._buffer[key] = (pending[0], dict(pending[1], **obj))
+        else:
+            # a full save replaces whatever is pending
+            self._buffer[key] = (action, obj)
+        if fingerprint:
+            self._fingerprints[(algolia_idx, obj['objectID'])] = (instance, fingerprint)
+        self._bytes = self._bytes + len(json.dumps(obj, cls=CustomJSONEncoder).encode('UTF-8'))
+        if self._items >= self.max_items or self._bytes >= self.max_bytes:
+            self.flush()
+
+    def discard(self, algolia_idx, object_id):
+        """ Remove the object from the buffer, e.g. when it's deleted before the batch is flushed. """
+        if self._buffer.pop((algolia_idx, object_id), None) is not None:
+            self._items = self._items - 1
+        self._fingerprints.pop((algolia_idx, object_id), None)
+
+    def flush(self):
+        buffer = self._buffer
+        fingerprints = self._fingerprints
+        self._buffer = OrderedDict()
+        self._fingerprints = OrderedDict()
+        self._items = 0
+        self._bytes = 0
+        writes = OrderedDict()
+        for (algolia_idx, object_id), (action, obj) in buffer.items():
+            writes.setdefault((algolia_idx, action), []).append(obj)
+        for (algolia_idx, action), objects in writes.items():
+            if action == self.PARTIAL:
+                algolia_idx.partial_update_objects(objects)
+            else:
+                # 'addObject' batch action would ignore our objectID, so new objects are saved as well
+                algolia_idx.save_objects(objects)
+            logger.debug("Flushed %s objects to Algolia index %s", len(objects), algolia_idx.index_name)
+        _store_fingerprints(fingerprints.values())
+
+
+def _fingerprint(index_key, obj):
+    """
+    Hash of the (JSON) object, used to skip writes of objects that haven't changed. The object is hashed
+    together with 'index_key' (backend and index), so a write to one index doesn't skip the writes to another.
+    """
+    data = json.dumps(obj, sort_keys=True, cls=CustomJSONEncoder)
+    return hashlib.sha1('{}\n{}'.format(index_key, data).encode('UTF-8')).hexdigest()
+
+
+def _store_fingerprints(written):
+    """ Persist fingerprints of (instance, fingerprint) pairs, after the objects were written to Algolia. """
+    by_model = OrderedDict()
+    for instance, fingerprint in written:
+        instance.index_fingerprint = fingerprint
+        by_model.setdefault(type(instance), []).append(instance)
+    for model, instances in by_model.items():
+        bulk_update(model, instances, fields=['index_fingerprint'])
+
+
+class SearchEngine(object):
+    """
+    Search backend: keeps the registered indexes and syncs (batches of) model instances to them. Backends
+    implement init_index(), index_exists() and generate_new_search_key(). Index objects returned by
+    init_index() support the subset of Algolia's index api that is used here (add_object, save_object(s),
+    partial_update_object(s), delete_object(s), set_settings and 'index_name').
+    Indexes are set up lazily, on their first use, so starting a process doesn't need the network.
+    """
+    # whether the set up of indexes is remembered in redis, so other processes can skip it
+    cache_registration = True
 
+    def __init__(self):
         self._indices = {}
-        self.client = algoliasearch.Client(app_id, api_key)
-        self.client.set_extra_header('User-Agent', 'Cuely Backend')
-        self.existing_algolia_indexes = [x.get('name') for x in self.client.list_indexes().get('items', [])]
+        # (index name, settings, model type) of registered indexes that are not set up yet
+        self._pending = []
+        self._index_model = None
+        self._load_db_indices = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def init_index(self, index_name):
+        raise NotImplementedError()
+
+    def index_exists(self, index_name):
+        raise NotImplementedError()
+
+    def generate_new_search_key(self, user_id):
+        """ Key for searching only the documents of 'user_id'. """
+        raise NotImplementedError()
 
     def register_db_model(self, index_model):
         self._index_model = index_model
-        # check for any existing indices in the DB
-        for idx in index_model.objects.all():
-            self.register(idx.name, idx.settings, idx.model_type)
+        # existing indices in the DB are registered on first use
+        self._load_db_indices = True
 
     def register(self, index_name, index_settings, model_type):
-        """ Registers the Algolia index. If the index doesn't exist yet, it will create a new one. """
-        db_idx, created = self._index_model.objects.get_or_create(
-            name=index_name,
-            defaults={'settings': index_settings}
-        )
-        algolia_idx = self.client.init_index(index_name)
-        if created and index_name not in self.existing_algolia_indexes:
-            algolia_idx.set_settings(index_settings)
-
-        self._indices[index_name] = (db_idx, algolia_idx, INDEX_MODEL_MAP[model_type][1])
+        """ Registers the index, it's set up on first use (see _setup()). """
+        self._pending.append((index_name, index_settings, model_type))
         # Connect to the signalling for deletion
         pre_delete.connect(self._pre_delete_receiver, INDEX_MODEL_MAP[model_type][0])
-        logging.info("Registered Algolia index %s", index_name)
 
-    def generate_new_search_key(self, user_id):
-        # generate a new search key that is valid only for 'user_id' and for two hours
-        search_key = settings.ALGOLIA['API_SEARCH_KEY']
-        return self.client.generate_secured_api_key(
-            search_key,
-            {
-                'filters': 'user_id={}'.format(user_id),
-                'restrictIndices': settings.ALGOLIA['INDEX_NAME'],
-                'validUntil': int(datetime.now(timezone.utc).timestamp()) + 7200
-            }
-        )
+    def _ensure_registered(self):
+        if not (self._pending or self._load_db_indices):
+            return
+        with self._lock:
+            # registrations are dropped only once they succeed, so a failed set up is retried on the next use
+            if self._load_db_indices:
+                self._pending.extend((x.name, x.settings, x.model_type) for x in self._index_model.objects.all())
+                self._load_db_indices = False
+            while self._pending:
+                self._setup(*self._pending[0])
+                self._pending.pop(0)
+
+    def _setup(self, index_name, index_settings, model_type):
+        """ Set up the index. If the index doesn't exist yet, it will create a new one. """
+        if index_name in self._indices:
+            return
+        algolia_idx = self.init_index(index_name)
+        registered_key = 'search:registered:{}:{}'.format(type(self).__name__, index_name)
+        if not (self.cache_registration and get_redis().exists(registered_key)):
+            db_idx, created = self._index_model.objects.get_or_create(
+                name=index_name,
+                defaults={'settings': index_settings}
+            )
+            if not self.index_exists(index_name):
+                algolia_idx.set_settings(db_idx.settings)
+                # the index is empty, so all objects have to be written regardless of their fingerprints
+                INDEX_MODEL_MAP[model_type][0].objects.update(index_fingerprint=None)
+            if self.cache_registration:
+                get_redis().setex(registered_key, REGISTRATION_TTL, 1)
+        self._indices[index_name] = (algolia_idx, INDEX_MODEL_MAP[model_type][1])
+        logging.info("Registered %s index %s", type(self).__name__, index_name)
 
     # Signal hook for deleting a model instance
     def _pre_delete_receiver(self, instance, **kwargs):
         """ Signal handler for when a registered model has been deleted. """
-        self.get_index(instance)[0].delete_object(instance.pk)
+        self.delete(instance)
+
+    def delete(self, instance):
+        """ Remove the instance from the index. """
+        algolia_idx = self.get_index(instance)[0]
+        current = getattr(self._local, 'batch', None)
+        if current is not None:
+            current.discard(algolia_idx, instance.pk)
+        algolia_idx.delete_object(instance.pk)
+
+    def bulk_delete(self, queryset):
+        """
+        Delete the rows of 'queryset' together with their index objects, with one SQL delete and one batch
+        of index deletes per chunk of rows. Rows are deleted without signals (and cascades), so there
+        are no per row index calls.
+        """
+        algolia_idx = self.get_index(None)[0]
+        current = getattr(self._local, 'batch', None)
+        deleted = 0
+        while True:
+            pks = list(queryset.values_list('pk', flat=True)[:DELETE_CHUNK_SIZE])
+            if not pks:
+                break
+            if current is not None:
+                for pk in pks:
+                    current.discard(algolia_idx, pk)
+            algolia_idx.delete_objects(pks)
+            queryset.model.objects.filter(pk__in=pks)._raw_delete(queryset.db)
+            deleted = deleted + len(pks)
+        logger.debug("Deleted %s objects from %s index %s", deleted, type(self).__name__, algolia_idx.index_name)
+        return deleted
 
     def reconfigure(self, index_name, new_settings):
         """ Reconfigure an existing index """
+        self._ensure_registered()
         if index_name not in self._indices:
             raise AlgoliaEngineError('{} is unknown index. Register it first!'.format(index_name))
 
-        db_idx, algolia_idx, fields = self._indices.get(index_name, (None, None, None))
+        algolia_idx, fields = self._indices.get(index_name)
         algolia_idx.set_settings(new_settings)
-        db_idx.settings = new_settings
-        db_idx.save()
+        self._index_model.objects.filter(name=index_name).update(settings=new_settings)
 
     def get_index(self, instance):
         # TODO: lookup index based on team_id (when teams are implemented)
-        db_idx, algolia_idx, fields = self._indices.get(settings.ALGOLIA['INDEX_NAME'])
-        return (algolia_idx, fields)
+        self._ensure_registered()
+        return self._indices.get(settings.ALGOLIA['INDEX_NAME'])
 
     def _build_object(self, instance, fields, with_id=False):
         """ Build the JSON object. """
@@ -89,15 +246,104 @@ class AlgoliaEngine(object):
             tmp[field] = attr
         return tmp
 
-    def sync(self, instance, add=True):
-        idx, fields = self.get_index(instance)
-        obj = self._build_object(instance, fields, not add)
-        if add:
+    @contextmanager
+    def batch(self, max_items=1000, max_bytes=5 * 1024 * 1024):
+        """
+        Buffer all sync() calls made in this thread and send them to Algolia in batches. Nested calls
+        reuse the outer batch. Make sure to flush() the batch before queueing any subtask that syncs the
+        same objects, otherwise the (older) buffered objects may overwrite the ones synced by the subtask.
+        """
+        current = getattr(self._local, 'batch', None)
+        if current is not None:
+            yield current
+            return
+        self._local.batch = AlgoliaBatch(max_items=max_items, max_bytes=max_bytes)
+        try:
+            yield self._local.batch
+        finally:
+            current = self._local.batch
+            self._local.batch = None
+            current.flush()
+
+    def sync(self, instance, add=True, fields=None):
+        """
+        Send the instance to Algolia. If 'fields' are specified, then only those attributes are
+        (partially) updated, the rest of the indexed object stays as it is (see the attribute sets in index.py).
+        The write is skipped if it is the same as the last write of the object to the same index (its fingerprint
+        is stored with the instance).
+        """
+        idx, index_fields = self.get_index(instance)
+        if fields:
+            obj = self._build_object(instance, [x for x in fields if x in index_fields], with_id=True)
+        else:
+            obj = self._build_object(instance, index_fields, with_id=True)
+        fingerprint = _fingerprint('{}:{}'.format(type(self).__name__, idx.index_name), obj)
+        if fingerprint == getattr(instance, 'index_fingerprint', None):
+            logger.debug("Object %s in Algolia index %s hasn't changed", instance.pk, idx.index_name)
+            return
+
+        current = getattr(self._local, 'batch', None)
+        if current is not None:
+            current.add(idx, AlgoliaBatch.PARTIAL if fields else AlgoliaBatch.SAVE, obj, instance, fingerprint)
+            return
+        if fields:
+            idx.partial_update_object(obj)
+        elif add:
+            del obj['objectID']
             idx.add_object(obj, instance.pk)
         else:
             idx.save_object(obj)
+        _store_fingerprints([(instance, fingerprint)])
         logger.debug("Saved object %s to Algolia index %s", instance.pk, idx.index_name)
 
 
-# Algolia engine
-algolia_engine = AlgoliaEngine()
+class AlgoliaEngine(SearchEngine):
+    def __init__(self, app_id=None, api_key=None):
+        """ Initializes Algolia client and indexes. """
+        super(AlgoliaEngine, self).__init__()
+        if not app_id:
+            app_id = settings.ALGOLIA['APPLICATION_ID']
+            api_key = settings.ALGOLIA['API_KEY']
+
+        self.app_id = app_id
+        self.client = algoliasearch.Client(app_id, api_key)
+        self.client.set_extra_header('User-Agent', 'Cuely Backend')
+
+    def init_index(self, index_name):
+        return self.client.init_index(index_name)
+
+    def index_exists(self, index_name):
+        key = 'search:algolia-indexes:{}'.format(self.app_id)
+        names = get_redis().get(key)
+        if names is None:
+            names = json.dumps([x.get('name') for x in self.client.list_indexes().get('items', [])])
+            get_redis().setex(key, INDEX_LIST_TTL, names)
+        exists = index_name in json.loads(names)
+        if not exists:
+            # the index is about to be created
+            get_redis().delete(key)
+        return exists
+
+    def generate_new_search_key(self, user_id):
+        # generate a new search key that is valid only for 'user_id' and for two hours
+        search_key = settings.ALGOLIA['API_SEARCH_KEY']
+        return self.client.generate_secured_api_key(
+            search_key,
+            {
+                'filters': 'user_id={}'.format(user_id),
+                'restrictIndices': settings.ALGOLIA['INDEX_NAME'],
+                'validUntil': int(datetime.now(timezone.utc).timestamp()) + 7200
+            }
+        )
+
+
+def _create_engine():
+    """ The search backend configured with SEARCH_ENGINE setting. """
+    if settings.SEARCH_ENGINE == 'local':
+        from dataimporter.algolia.local import LocalEngine
+        return LocalEngine(settings.LOCAL_SEARCH_DB)
+    return AlgoliaEngine()
+
+
+# search engine (the name is kept from the times when Algolia was the only backend)
+algolia_engine = _create_engine()
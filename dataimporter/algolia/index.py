@@ -174,6 +174,65 @@ def index_list():
     default_index = DocumentIndex(default_index_name)
     return [default_index]
 
+
+# Attribute sets for partial updates (see AlgoliaEngine.sync()). Documents loaded from the database only have
+# their metadata columns, so existing documents are updated with the attributes that the task actually built,
+# instead of replacing the whole indexed object (and wiping e.g. content that was written by another task).
+METADATA_FIELDS = [
+    'last_updated_ts',
+    'last_updated',
+    'webview_link',
+    'primary_keywords',
+    'secondary_keywords'
+]
+GDRIVE_METADATA_FIELDS = METADATA_FIELDS + [
+    'title',
+    'mime_type',
+    'icon_link',
+    'owner_display_name',
+    'owner_photo_link',
+    'modifier_display_name',
+    'modifier_photo_link',
+    'thumbnail_link',
+    'path'
+]
+GDRIVE_CONTENT_FIELDS = ['content']
+HELPSCOUT_CUSTOMER_FIELDS = METADATA_FIELDS + [
+    'helpscout_title',
+    'helpscout_name',
+    'helpscout_company',
+    'helpscout_emails'
+]
+# attributes of a customer that are updated from customer's conversations
+HELPSCOUT_CONVERSATION_FIELDS = [
+    'last_updated',
+    'last_updated_ts',
+    'helpscout_mailbox',
+    'helpscout_mailbox_id',
+    'helpscout_folder',
+    'helpscout_status',
+    'helpscout_assigned',
+    'helpscout_emails',
+    'helpscout_content'
+]
+HELPSCOUT_DOCUMENT_FIELDS = METADATA_FIELDS + [
+    'helpscout_document_title',
+    'helpscout_document_collection',
+    'helpscout_document_users',
+    'helpscout_document_keywords',
+    'helpscout_document_status',
+    'helpscout_document_public_link'
+]
+HELPSCOUT_DOCUMENT_CONTENT_FIELDS = ['helpscout_document_categories', 'helpscout_document_content']
+TRELLO_BOARD_FIELDS = METADATA_FIELDS + [
+    'trello_title',
+    'trello_board_status',
+    'trello_board_org',
+    'trello_board_members'
+]
+# board's lists with their cards
+TRELLO_BOARD_CONTENT_FIELDS = ['trello_content']
+
 INDEX_MODEL_MAP = {
     AlgoliaIndex.DOCUMENT: (Document, DocumentIndex.fields)
 }
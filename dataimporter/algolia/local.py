@@ -0,0 +1,193 @@
+"""
+Local search backend, an alternative to Algolia that needs no network (e.g. for development and benchmarks).
+Indexed objects are kept as JSON in a SQLite database and searched with a FTS5 table, built from the
+searchable attributes in index settings. Results are ordered by relevance, then by the custom ranking.
+"""
+import os
+import json
+import sqlite3
+import threading
+from algoliasearch.helpers import CustomJSONEncoder
+from django.conf import settings
+from django.core import signing
+
+from dataimporter.algolia.engine import SearchEngine
+import logging
+logger = logging.getLogger(__name__)
+
+# search keys are valid for this many seconds (the same as secured Algolia keys)
+SEARCH_KEY_MAX_AGE = 7200
+
+
+def _searchable_attributes(index_settings):
+    """ Attributes from 'attributesToIndex' setting, without modifiers, e.g. 'unordered(title)' -> 'title'. """
+    attributes = []
+    for attr in index_settings.get('attributesToIndex', []):
+        if attr.startswith('unordered('):
+            attr = attr[len('unordered('):-1]
+        attributes.append(attr)
+    return attributes
+
+
+def _custom_ranking(index_settings):
+    """ (attribute, direction) pairs from 'customRanking' setting, e.g. 'desc(last_updated_ts)'. """
+    ranking = []
+    for rank in index_settings.get('customRanking', []):
+        direction, attr = rank.rstrip(')').split('(')
+        ranking.append((attr, direction.upper()))
+    return ranking
+
+
+def _text(value):
+    """ Searchable text of an attribute value, nested lists and dicts are flattened. """
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ' '.join(_text(x) for x in value)
+    if isinstance(value, dict):
+        return ' '.join(_text(x) for x in value.values())
+    return str(value)
+
+
+def _attribute_text(obj, attr):
+    """ Text of (nested) attribute 'attr' of the object, e.g. 'jira_issue_assignee.name'. """
+    values = [obj]
+    for name in attr.split('.'):
+        values = [x.get(name) for v in values for x in (v if isinstance(v, list) else [v]) if isinstance(x, dict)]
+    return _text(values)
+
+
+class LocalIndex(object):
+    def __init__(self, engine, index_name):
+        self.engine = engine
+        self.index_name = index_name
+        self.objects_table = '"{}_objects"'.format(index_name)
+        self.fts_table = '"{}_fts"'.format(index_name)
+
+    def get_settings(self):
+        row = self.engine.connection().execute(
+            'SELECT settings FROM index_settings WHERE name = ?', (self.index_name,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def set_settings(self, index_settings):
+        """ Store the settings and rebuild the full-text table for (possibly changed) searchable attributes. """
+        db = self.engine.connection()
+        attributes = _searchable_attributes(index_settings)
+        with db:
+            db.execute('INSERT OR REPLACE INTO index_settings (name, settings) VALUES (?, ?)',
+                       (self.index_name, json.dumps(index_settings)))
+            db.execute('DROP TABLE IF EXISTS {}'.format(self.fts_table))
+            db.execute('CREATE VIRTUAL TABLE {} USING fts5(object_id UNINDEXED, {})'.format(
+                self.fts_table, ', '.join('a{}'.format(i) for i in range(len(attributes)))))
+            for object_id, data in db.execute('SELECT object_id, data FROM {}'.format(self.objects_table)):
+                self._index_object(db, attributes, object_id, json.loads(data))
+
+    def _index_object(self, db, attributes, object_id, obj):
+        db.execute('DELETE FROM {} WHERE object_id = ?'.format(self.fts_table), (object_id,))
+        db.execute('INSERT INTO {} VALUES (?, {})'.format(self.fts_table, ', '.join('?' * len(attributes))),
+                   [object_id] + [_attribute_text(obj, x) for x in attributes])
+
+    def _write(self, objects, partial=False):
+        db = self.engine.connection()
+        attributes = _searchable_attributes(self.get_settings())
+        with db:
+            for obj in objects:
+                object_id = str(obj['objectID'])
+                # same as the JSON that would be sent to Algolia
+                obj = json.loads(json.dumps(obj, cls=CustomJSONEncoder))
+                if partial:
+                    row = db.execute(
+                        'SELECT data FROM {} WHERE object_id = ?'.format(self.objects_table), (object_id,)).fetchone()
+                    if row:
+                        obj = dict(json.loads(row[0]), **obj)
+                db.execute('INSERT OR REPLACE INTO {} (object_id, data) VALUES (?, ?)'.format(self.objects_table),
+                           (object_id, json.dumps(obj)))
+                self._index_object(db, attributes, object_id, obj)
+
+    def add_object(self, obj, object_id):
+        self._write([dict(obj, objectID=object_id)])
+
+    def save_object(self, obj):
+        self._write([obj])
+
+    def save_objects(self, objects):
+        self._write(objects)
+
+    def partial_update_object(self, obj):
+        self._write([obj], partial=True)
+
+    def partial_update_objects(self, objects):
+        self._write(objects, partial=True)
+
+    def delete_object(self, object_id):
+        self.delete_objects([object_id])
+
+    def delete_objects(self, object_ids):
+        db = self.engine.connection()
+        with db:
+            for object_id in object_ids:
+                db.execute('DELETE FROM {} WHERE object_id = ?'.format(self.objects_table), (str(object_id),))
+                db.execute('DELETE FROM {} WHERE object_id = ?'.format(self.fts_table), (str(object_id),))
+
+    def search(self, query, user_id, limit=20):
+        """
+        Objects of 'user_id' that match all words of the query (as prefixes). The relevance weighs matches
+        in the order of searchable attributes, ties are broken by the custom ranking.
+        """
+        index_settings = self.get_settings()
+        attributes = _searchable_attributes(index_settings)
+        terms = ' '.join('"{}"*'.format(x.replace('"', '""')) for x in query.split())
+        if not terms:
+            return []
+        weights = ', '.join(str(len(attributes) - i) for i in range(len(attributes)))
+        order = ''.join(", json_extract(o.data, '$.{}') {}".format(attr, direction)
+                        for attr, direction in _custom_ranking(index_settings))
+        sql = (
+            'SELECT o.data FROM {fts} f JOIN {objects} o ON o.object_id = f.object_id '
+            "WHERE {fts} MATCH ? AND json_extract(o.data, '$.user_id') = ? "
+            'ORDER BY bm25({fts}, 0, {weights}){order} LIMIT ?'
+        ).format(fts=self.fts_table, objects=self.objects_table, weights=weights, order=order)
+        rows = self.engine.connection().execute(sql, (terms, user_id, limit))
+        return [json.loads(data) for data, in rows]
+
+
+class LocalEngine(SearchEngine):
+    # the database is local to the host, so other processes can't rely on its set up
+    cache_registration = False
+
+    def __init__(self, path):
+        """ Local search engine with indexes in SQLite database at 'path'. """
+        super(LocalEngine, self).__init__()
+        self.path = path
+        self._connections = threading.local()
+
+    def connection(self):
+        """ Connection of the current thread (and process, connections can't be shared with forked workers). """
+        pid, db = getattr(self._connections, 'db', (None, None))
+        if pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS index_settings (name TEXT PRIMARY KEY, settings TEXT)')
+            self._connections.db = (os.getpid(), db)
+        return db
+
+    def init_index(self, index_name):
+        index = LocalIndex(self, index_name)
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS {} (object_id TEXT PRIMARY KEY, data TEXT)'.format(index.objects_table))
+        return index
+
+    def index_exists(self, index_name):
+        return self.connection().execute(
+            'SELECT 1 FROM index_settings WHERE name = ?', (index_name,)).fetchone() is not None
+
+    def generate_new_search_key(self, user_id):
+        # there is no search service to restrict the key, it's a signed token of the user instead
+        return signing.dumps({'user_id': user_id}, salt='local-search')
+
+    def search(self, query, search_key, limit=20):
+        """ Search the default index with a key from generate_new_search_key(). """
+        user_id = signing.loads(search_key, salt='local-search', max_age=SEARCH_KEY_MAX_AGE)['user_id']
+        self._ensure_registered()
+        index, fields = self._indices.get(settings.ALGOLIA['INDEX_NAME'])
+        return index.search(query, user_id, limit=limit)
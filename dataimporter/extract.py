@@ -0,0 +1,123 @@
+"""
+Text extraction from binary documents (PDF and Office files). It runs in tasks of the 'extract' queue, which has
+its own worker, so that the metadata syncs don't wait for it. A file which takes too long is interrupted by the
+task's time limit (see gdrive.extract_gdrive_document()). Extractors stop as soon as they have enough text to fill
+the index record, and results are cached in redis per file version.
+"""
+import io
+import zipfile
+from xml.etree.ElementTree import iterparse
+from celery.exceptions import SoftTimeLimitExceeded
+
+from cuely.queue_util import get_redis
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    from pdfminer.high_level import extract_text_to_fp
+except ImportError:
+    # PDF extraction is optional
+    extract_text_to_fp = None
+
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+DRAWING_NS = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+# files bigger than this are not downloaded for extraction
+EXTRACT_MAX_FILE_BYTES = 20 * 1024 * 1024
+# seconds that a task may spend downloading and extracting a single file
+EXTRACT_TIMEOUT = 120
+# PDFs are parsed only up to this many pages
+PDF_MAX_PAGES = 10
+# extracted texts are cached for this many seconds
+EXTRACT_CACHE_TTL = 7 * 24 * 3600
+
+
+def _zip_texts(path, names, text_tag, break_tag, max_bytes):
+    """ Text of 'text_tag' elements in xml files 'names' of a zip archive, until 'max_bytes' are collected. """
+    texts = []
+    size = 0
+    with zipfile.ZipFile(path) as zf:
+        for name in names(zf):
+            for _, elem in iterparse(zf.open(name)):
+                if elem.tag == text_tag and elem.text:
+                    texts.append(elem.text)
+                    size = size + len(elem.text.encode('UTF-8'))
+                elif elem.tag == break_tag:
+                    texts.append('\n')
+                    # free the parsed elements, documents can be big
+                    elem.clear()
+                if size >= max_bytes:
+                    return ''.join(texts)
+            texts.append('\n')
+    return ''.join(texts)
+
+
+def _slide_names(zf):
+    """ Slides of a presentation, in their order (slide10.xml comes after slide9.xml). """
+    slides = [x for x in zf.namelist() if x.startswith('ppt/slides/slide') and x.endswith('.xml')]
+    return sorted(slides, key=lambda x: int(x[len('ppt/slides/slide'):-len('.xml')]))
+
+
+def _extract_docx(path, max_bytes):
+    return _zip_texts(path, lambda zf: ['word/document.xml'], WORD_NS + 't', WORD_NS + 'p', max_bytes)
+
+
+def _extract_xlsx(path, max_bytes):
+    # most of the cell texts are kept in the shared strings table
+    names = lambda zf: [x for x in ['xl/sharedStrings.xml'] if x in zf.namelist()]
+    return _zip_texts(path, names, SHEET_NS + 't', SHEET_NS + 'si', max_bytes)
+
+
+def _extract_pptx(path, max_bytes):
+    return _zip_texts(path, _slide_names, DRAWING_NS + 't', DRAWING_NS + 'p', max_bytes)
+
+
+def _extract_pdf(path, max_bytes):
+    out = io.BytesIO()
+    with open(path, 'rb') as f:
+        extract_text_to_fp(f, out, codec='UTF-8', maxpages=PDF_MAX_PAGES)
+    return out.getvalue()[:max_bytes].decode('UTF-8', errors='ignore')
+
+
+EXTRACTORS = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': _extract_docx,
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': _extract_xlsx,
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation': _extract_pptx,
+}
+if extract_text_to_fp:
+    EXTRACTORS['application/pdf'] = _extract_pdf
+
+
+def can_extract(mime_type):
+    return mime_type in EXTRACTORS
+
+
+def _extract(mime_type, path, max_bytes):
+    return EXTRACTORS[mime_type](path, max_bytes)
+
+
+def _cache_key(file_id, version):
+    return 'extract:{}:{}'.format(file_id, version)
+
+
+def get_cached_text(file_id, version):
+    """ Text extracted from the file with 'file_id' (e.g. gdrive file id) and 'version' (e.g. modifiedTime). """
+    text = get_redis().get(_cache_key(file_id, version))
+    return text.decode('UTF-8') if text is not None else None
+
+
+def extract_text(file_id, version, mime_type, path, max_bytes):
+    """
+    Extract (at least) 'max_bytes' of text from the downloaded file at 'path', the result is cached per file
+    version. Returns None if the file couldn't be parsed in time.
+    """
+    try:
+        text = _extract(mime_type, path, max_bytes)
+    except SoftTimeLimitExceeded:
+        logger.warning("Extraction of text from file %s [%s] timed out", file_id, mime_type)
+        return None
+    except Exception:
+        logger.exception("Could not extract text from file %s [%s]", file_id, mime_type)
+        return None
+    get_redis().setex(_cache_key(file_id, version), EXTRACT_CACHE_TTL, text.encode('UTF-8'))
+    return text
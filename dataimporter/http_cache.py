@@ -0,0 +1,201 @@
+"""
+Conditional requests for API clients. Bodies of GET responses are kept in redis together with their
+validators (ETag, Last-Modified), keyed by provider, credential and URL. Repeated requests send the validators
+and when the response is 304 Not Modified, the client gets the cached body as if the response was a 200.
+This saves payload on the periodic syncs, and Github doesn't count not modified responses against the rate limit.
+
+There is a hook for each kind of client:
+  - https_connection_class() for http.client based clients (PyGithub),
+  - CachingAdapter for requests sessions (Jira),
+  - CachingHttp for httplib2 (Google APIs).
+Hits and misses are counted per provider, see get_cache_stats().
+"""
+import re
+import json
+import hashlib
+import httplib2
+from http.client import HTTPSConnection
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from cuely.queue_util import get_redis
+import logging
+logger = logging.getLogger(__name__)
+
+# cached responses expire after this many seconds
+HTTP_CACHE_TTL = 24 * 3600
+# bigger responses are not cached
+HTTP_CACHE_MAX_BYTES = 1024 * 1024
+
+
+def get_cache_stats(provider):
+    """ Number of GET requests that were answered from the cache (hits) and that were downloaded (misses). """
+    stats = get_redis().hgetall('http-cache:stats:{}'.format(provider))
+    return {k.decode('UTF-8'): int(v) for k, v in stats.items()}
+
+
+class ResponseCache(object):
+    def __init__(self, provider, credential):
+        self.provider = provider
+        self.credential = credential or ''
+
+    def _key(self, url):
+        digest = hashlib.sha1('{}\n{}'.format(self.credential, url).encode('UTF-8')).hexdigest()
+        return 'http-cache:{}:{}'.format(self.provider, digest)
+
+    def get(self, url):
+        """ Returns (headers, body) of the cached response or None. """
+        entry = get_redis().hmget(self._key(url), 'headers', 'body')
+        if entry[0] is None:
+            return None
+        return json.loads(entry[0].decode('UTF-8')), entry[1] or b''
+
+    def validators(self, headers):
+        """ Headers of a conditional request for the cached response with 'headers'. """
+        headers = CaseInsensitiveDict(headers)
+        result = {}
+        if headers.get('etag'):
+            result['If-None-Match'] = headers['etag']
+        if headers.get('last-modified'):
+            result['If-Modified-Since'] = headers['last-modified']
+        return result
+
+    def store(self, url, headers, body):
+        """ Cache the response, if it has validators and is not too big. """
+        if self.validators(headers) and len(body) <= HTTP_CACHE_MAX_BYTES:
+            self.put(url, headers, body)
+
+    def put(self, url, headers, body):
+        key = self._key(url)
+        pipe = get_redis().pipeline()
+        pipe.hmset(key, {'headers': json.dumps(dict(headers)), 'body': body})
+        pipe.expire(key, HTTP_CACHE_TTL)
+        pipe.execute()
+
+    def delete(self, url):
+        get_redis().delete(self._key(url))
+
+    def count(self, hit):
+        get_redis().hincrby('http-cache:stats:{}'.format(self.provider), 'hits' if hit else 'misses', 1)
+
+
+def _merge_headers(cached_headers, headers):
+    """ Headers of a not modified response are newer (e.g. rate limits), except for the ones describing the body. """
+    merged = CaseInsensitiveDict(cached_headers)
+    for k, v in headers.items():
+        if k.lower() not in ('content-length', 'content-encoding', 'transfer-encoding'):
+            merged[k] = v
+    return merged
+
+
+class _CachedResponse(object):
+    """ Just enough of http.client.HTTPResponse for the clients. """
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def getheaders(self):
+        return list(self.headers.items())
+
+    def getheader(self, name, default=None):
+        return CaseInsensitiveDict(self.headers).get(name, default)
+
+    def read(self, amt=None):
+        return self.body
+
+
+class CachingHTTPSConnection(HTTPSConnection):
+    """ HTTPS connection that makes conditional GET requests, the credential is taken from Authorization header. """
+    provider = None
+
+    def request(self, method, url, body=None, headers=None, **kwargs):
+        headers = dict(headers or {})
+        self._cache = None
+        if method == 'GET':
+            self._cache = ResponseCache(self.provider, headers.get('Authorization'))
+            self._url = '{}{}'.format(self.host, url)
+            self._cached = self._cache.get(self._url)
+            if self._cached:
+                headers.update(self._cache.validators(self._cached[0]))
+        super(CachingHTTPSConnection, self).request(method, url, body, headers, **kwargs)
+
+    def getresponse(self):
+        response = super(CachingHTTPSConnection, self).getresponse()
+        if self._cache is None:
+            return response
+        body = response.read()
+        headers = dict(response.getheaders())
+        if response.status == 304 and self._cached:
+            self._cache.count(hit=True)
+            cached_headers, cached_body = self._cached
+            return _CachedResponse(200, _merge_headers(cached_headers, headers), cached_body)
+        self._cache.count(hit=False)
+        if response.status == 200:
+            self._cache.store(self._url, headers, body)
+        return _CachedResponse(response.status, headers, body)
+
+
+def https_connection_class(provider):
+    """ CachingHTTPSConnection for 'provider', e.g. to inject into PyGithub's Requester. """
+    return type('CachingHTTPSConnection', (CachingHTTPSConnection,), {'provider': provider})
+
+
+class CachingAdapter(HTTPAdapter):
+    """ Transport adapter for requests sessions that makes conditional GET requests. """
+    def __init__(self, provider, credential, **kwargs):
+        super(CachingAdapter, self).__init__(**kwargs)
+        self.cache = ResponseCache(provider, credential)
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super(CachingAdapter, self).send(request, **kwargs)
+        cached = self.cache.get(request.url)
+        if cached:
+            request.headers.update(self.cache.validators(cached[0]))
+        response = super(CachingAdapter, self).send(request, **kwargs)
+        if response.status_code == 304 and cached:
+            self.cache.count(hit=True)
+            response.status_code = 200
+            response.headers = _merge_headers(cached[0], response.headers)
+            response._content = cached[1]
+            return response
+        self.cache.count(hit=False)
+        if response.status_code == 200:
+            self.cache.store(request.url, response.headers, response.content)
+        return response
+
+
+class _Httplib2Cache(object):
+    """ Cache interface of httplib2 (which handles the validators itself) on top of redis. """
+    def __init__(self, provider, credential):
+        self.cache = ResponseCache(provider, credential)
+
+    def get(self, key):
+        cached = self.cache.get(key)
+        return cached[1] if cached else None
+
+    def set(self, key, value):
+        # httplib2 keeps headers and body together, only JSON metadata is cached, not file contents (downloads
+        # or exports), those would fill up redis
+        headers = re.split(b'\r?\n\r?\n', value, 1)[0].lower()
+        if not re.search(b'^content-type: *application/json', headers, re.MULTILINE) or \
+                len(value) > HTTP_CACHE_MAX_BYTES:
+            return
+        self.cache.put(key, {}, value)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+
+class CachingHttp(httplib2.Http):
+    """ httplib2 client with responses cached in redis, see _Httplib2Cache. """
+    def __init__(self, provider, credential, **kwargs):
+        self.response_cache = ResponseCache(provider, credential)
+        super(CachingHttp, self).__init__(cache=_Httplib2Cache(provider, credential), **kwargs)
+
+    def request(self, uri, method='GET', *args, **kwargs):
+        response, content = super(CachingHttp, self).request(uri, method, *args, **kwargs)
+        if method == 'GET':
+            self.response_cache.count(hit=response.fromcache)
+        return response, content
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+NATURAL_KEYS = (
+    ('document_id', 'requester', 'user_id'),
+    ('github_repo_id', 'github_file_id', 'requester'),
+    ('github_repo_id', 'github_commit_id', 'requester'),
+    ('github_repo_id', 'github_issue_id', 'requester'),
+    ('trello_board_id', 'trello_card_id', 'requester'),
+    ('jira_issue_key', 'requester'),
+    ('pipedrive_deal_id', 'requester'),
+    ('helpscout_customer_id', 'requester'),
+    ('helpscout_document_id', 'requester'),
+)
+
+
+def remove_duplicates(apps, schema_editor):
+    """
+    Unique constraints can't be created while there are duplicated rows, keep only the oldest one.
+    Historical models don't send signals to the search engine, so the index objects of removed rows are
+    deleted here, before the rows.
+    """
+    from dataimporter.algolia.engine import algolia_engine
+    Document = apps.get_model('dataimporter', 'Document')
+    removed = set()
+    for fields in NATURAL_KEYS:
+        duplicates = Document.objects \
+            .filter(**{'{}__isnull'.format(f): False for f in fields}) \
+            .values(*fields) \
+            .annotate(min_id=Min('id'), count=Count('id')) \
+            .filter(count__gt=1)
+        for dup in duplicates:
+            removed.update(Document.objects.filter(**{f: dup[f] for f in fields}).exclude(id=dup['min_id'])
+                           .values_list('id', flat=True))
+    if not removed:
+        return
+    algolia_idx = algolia_engine.get_index(None)[0]
+    removed = sorted(removed)
+    for i in range(0, len(removed), 1000):
+        algolia_idx.delete_objects(removed[i:i + 1000])
+        Document.objects.filter(id__in=removed[i:i + 1000]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataimporter', '0045_remove_algolia_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='document',
+            unique_together=set(NATURAL_KEYS),
+        ),
+        migrations.AlterIndexTogether(
+            name='document',
+            index_together=set([('requester', 'download_status', 'last_synced')]),
+        ),
+    ]
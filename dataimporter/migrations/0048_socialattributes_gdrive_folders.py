@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+import django_mysql.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataimporter', '0047_sync_cursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='socialattributes',
+            name='gdrive_folders',
+            field=django_mysql.models.JSONField(default=dict),
+        ),
+    ]
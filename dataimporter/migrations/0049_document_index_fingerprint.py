@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataimporter', '0048_socialattributes_gdrive_folders'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='index_fingerprint',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
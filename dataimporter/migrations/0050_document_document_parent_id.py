@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataimporter', '0049_document_index_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='document_parent_id',
+            field=models.CharField(max_length=200, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='document',
+            index_together=set([('requester', 'download_status', 'last_synced'), ('user_id', 'document_parent_id')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+import django_mysql.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dataimporter', '0050_document_document_parent_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='github_issue_comments',
+            field=django_mysql.models.JSONField(default=list),
+        ),
+    ]
@@ -1,7 +1,9 @@
 from __future__ import unicode_literals
 
+from collections import OrderedDict
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Case, When, Value
 from django_mysql.models import JSONField
 from django.core.exceptions import MultipleObjectsReturned
 
@@ -17,6 +19,8 @@ class Document(models.Model):
     )
 
     document_id = models.CharField(max_length=200, null=True)
+    # gdrive folder that contains the document
+    document_parent_id = models.CharField(max_length=200, null=True)
     title = models.CharField(max_length=500, blank=True, null=True)
     last_synced = models.DateTimeField(blank=True, null=True)
     last_updated = models.DateTimeField(auto_now_add=True)
@@ -46,9 +50,34 @@ class Document(models.Model):
     github_commit_id = models.CharField(max_length=50, blank=True, null=True)
     github_file_id = models.CharField(max_length=50, blank=True, null=True)
     github_issue_id = models.CharField(max_length=50, blank=True, null=True)
+    # comments of the last sync, incremental syncs list only the updated ones
+    github_issue_comments = JSONField(default=list)
     trello_title = models.CharField(max_length=500, blank=True, null=True)
     trello_board_id = models.CharField(max_length=50, blank=True, null=True)
     trello_card_id = models.CharField(max_length=50, blank=True, null=True)
+    # hash of the last (full or partial) write of the document to the search index, see AlgoliaEngine.sync()
+    index_fingerprint = models.CharField(max_length=40, blank=True, null=True)
+
+    class Meta:
+        # natural keys of documents in each integration (NULLs don't collide, so rows of other integrations
+        # are not affected by these constraints)
+        unique_together = (
+            ('document_id', 'requester', 'user_id'),
+            ('github_repo_id', 'github_file_id', 'requester'),
+            ('github_repo_id', 'github_commit_id', 'requester'),
+            ('github_repo_id', 'github_issue_id', 'requester'),
+            ('trello_board_id', 'trello_card_id', 'requester'),
+            ('jira_issue_key', 'requester'),
+            ('pipedrive_deal_id', 'requester'),
+            ('helpscout_customer_id', 'requester'),
+            ('helpscout_document_id', 'requester'),
+        )
+        index_together = (
+            # sync status checks
+            ('requester', 'download_status', 'last_synced'),
+            # documents in (hidden) gdrive folders
+            ('user_id', 'document_parent_id'),
+        )
 
     def __str__(self):
         return str(self.id) if self.id else "Not saved to DB"
@@ -56,9 +85,26 @@ class Document(models.Model):
 
 class SocialAttributes(models.Model):
     start_page_token = models.CharField(max_length=100, blank=True, null=True)
+    # folder tree of user's gdrive: folder id -> id, parent, name, hidden
+    gdrive_folders = JSONField(default=dict)
     user = models.ForeignKey(User)
 
 
+class SyncCursor(models.Model):
+    """
+    Progress of a paged sync (e.g. the next page token), stored after every committed page,
+    so that the sync can be resumed after its worker died.
+    """
+    updated = models.DateTimeField(auto_now=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    provider = models.CharField(max_length=100)
+    key = models.CharField(max_length=200)
+    cursor = JSONField(default=dict)
+
+    class Meta:
+        unique_together = (('user', 'provider', 'key'),)
+
+
 class UserAttributes(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     segment_identify = models.BooleanField(blank=False, null=False, default=True)
@@ -96,3 +142,106 @@ def get_or_create(model, **filter_args):
         for obj in all_objects[1:]:
             obj.delete()
         return (all_objects[0], False)
+
+
+BULK_CHUNK_SIZE = 500
+# inserts that collide with rows inserted by other tasks are retried as updates this many times
+BULK_SAVE_ATTEMPTS = 3
+
+
+def bulk_get_or_create(model, key_field, keys, **filter_args):
+    """
+    Bulk version of 'get_or_create'. Loads the existing rows for all 'keys' (values of 'key_field') with one
+    '__in' query per chunk of keys and returns an ordered dict of key -> (obj, created). Created objects are
+    not saved yet, use 'bulk_save' for that. Duplicates are automatically deleted (same as in 'get_or_create').
+    """
+    keys = [str(k) for k in keys]
+    existing = {}
+    duplicates = []
+    for chunk in _chunks(list(OrderedDict.fromkeys(keys)), BULK_CHUNK_SIZE):
+        objects = model.objects.filter(**filter_args).filter(**{'{}__in'.format(key_field): chunk}).order_by('pk')
+        for obj in objects:
+            key = getattr(obj, key_field)
+            if key in existing:
+                duplicates.append(obj)
+            else:
+                existing[key] = obj
+    for obj in duplicates:
+        obj.delete()
+
+    # lookups (e.g. 'github_commit_id__isnull') are not model fields, the same as in django's 'get_or_create'
+    defaults = {k: v for k, v in filter_args.items() if '__' not in k}
+    result = OrderedDict()
+    for key in keys:
+        if key in result:
+            continue
+        if key in existing:
+            result[key] = (existing[key], False)
+        else:
+            new_obj = model(**defaults)
+            setattr(new_obj, key_field, key)
+            result[key] = (new_obj, True)
+    return result
+
+
+def bulk_save(model, objs, key_field, **filter_args):
+    """
+    Bulk version of 'save' for objects returned by 'bulk_get_or_create'. New objects are inserted with
+    'bulk_create' and their primary keys are loaded afterwards (MySQL doesn't return them on insert).
+    Existing objects are written with 'bulk_update'. If another task has inserted some of the new objects
+    in the meantime (the insert violates a natural key constraint), they are updated instead.
+    """
+    objs = list(OrderedDict((id(o), o) for o in objs).values())
+    new_objs = [o for o in objs if o.pk is None]
+    old_objs = [o for o in objs if o.pk is not None]
+    attempts = 0
+    while new_objs:
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create(new_objs, batch_size=BULK_CHUNK_SIZE)
+        except IntegrityError:
+            attempts = attempts + 1
+            if attempts >= BULK_SAVE_ATTEMPTS:
+                raise
+            with transaction.atomic():
+                # a locking read sees the rows committed by the other task, even in an older transaction
+                _load_pks(model.objects.select_for_update(), new_objs, key_field, filter_args)
+            old_objs.extend(o for o in new_objs if o.pk is not None)
+            new_objs = [o for o in new_objs if o.pk is None]
+            continue
+        _load_pks(model.objects.all(), new_objs, key_field, filter_args)
+        break
+    bulk_update(model, old_objs)
+
+
+def _load_pks(queryset, objs, key_field, filter_args):
+    """ Set primary keys of 'objs' from the stored rows with the same 'key_field' values. """
+    lookup = {getattr(o, key_field): o for o in objs}
+    for chunk in _chunks(list(lookup.keys()), BULK_CHUNK_SIZE):
+        rows = queryset.filter(**filter_args).filter(**{'{}__in'.format(key_field): chunk})
+        for key, pk in rows.values_list(key_field, 'pk'):
+            lookup[key].pk = pk
+            lookup[key]._state.adding = False
+
+
+def bulk_update(model, objs, fields=None, batch_size=100):
+    """
+    Write 'fields' (by default all concrete, non-relational fields) of already saved 'objs' with one
+    UPDATE ... CASE WHEN statement per batch, instead of one UPDATE per object.
+    """
+    if fields:
+        fields = [model._meta.get_field(x) for x in fields]
+    else:
+        fields = [f for f in model._meta.concrete_fields if not (f.primary_key or f.is_relation)]
+    for chunk in _chunks(objs, batch_size):
+        updates = {}
+        for field in fields:
+            updates[field.attname] = Case(
+                *[When(pk=o.pk, then=Value(getattr(o, field.attname), output_field=field)) for o in chunk],
+                output_field=field
+            )
+        model.objects.filter(pk__in=[o.pk for o in chunk]).update(**updates)
+
+
+def _chunks(items, size):
+    return [items[x:x + size] for x in range(0, len(items), size)]
@@ -0,0 +1,144 @@
+"""
+Rate limiting of external API calls. Every integration has a token bucket per (provider, credential) in
+redis, so all workers that use the same credential share one allowance. Tasks call acquire() before
+making API requests and sleep only as long as is needed to stay within the provider's limits.
+Resumable tasks don't sleep through long waits, they re-queue themselves instead (see task_util.resumable()).
+The same happens when a provider throttles a request anyway, see get_retry_after().
+"""
+import math
+import time
+import hashlib
+from django.conf import settings
+
+from cuely.queue_util import get_redis
+from dataimporter.task_util import get_api_credential, RateLimited
+import logging
+logger = logging.getLogger(__name__)
+
+# Atomically refill the bucket and take tokens from it. Returns the number of seconds to wait
+# (as a string, because redis would truncate a lua number to integer), zero if tokens were taken.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'blocked_until')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+local blocked_until = tonumber(bucket[3]) or 0
+if now < blocked_until then
+    return tostring(blocked_until - now)
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+_token_bucket = None
+# resumable tasks re-queue themselves rather than sleep for longer than this (in seconds)
+MAX_BLOCKING_WAIT = 10
+# throttled requests are retried after this many seconds, unless the provider says otherwise
+DEFAULT_RETRY_AFTER = 60
+
+
+def get_retry_after(exc):
+    """
+    Seconds to wait before retrying, if 'exc' (raised by an API client) is a response to a throttled request,
+    None otherwise. Clients keep the response status in different places: jira and helpscout in 'status_code',
+    trello in '_status', google apis in 'resp' (also reporting exceeded rate limits as 403) and pypedriver
+    keeps just the error message.
+    """
+    response = getattr(exc, 'response', None)
+    if response is None:
+        response = getattr(exc, 'resp', None)
+    status = getattr(exc, 'status_code', None) or getattr(exc, '_status', None) or \
+        getattr(response, 'status_code', None) or getattr(response, 'status', None)
+    if status == 403 and b'ateLimitExceeded' in (getattr(exc, 'content', None) or b''):
+        status = 429
+    elif isinstance(exc, ConnectionError) and 'over limit' in str(exc).lower():
+        status = 429
+    if status != 429:
+        return None
+    # httplib2 responses are dicts of headers
+    headers = getattr(response, 'headers', None) or getattr(exc, 'headers', None) or \
+        (response if isinstance(response, dict) else {})
+    retry_after = {k.lower(): v for k, v in dict(headers).items()}.get('retry-after')
+    try:
+        return max(1, int(float(retry_after)))
+    except (TypeError, ValueError):
+        # missing or an http date
+        return DEFAULT_RETRY_AFTER
+
+
+class RateLimiter(object):
+    def __init__(self, provider, credential, max_wait=None):
+        requests, period = settings.API_RATE_LIMITS[provider]
+        self.provider = provider
+        self.max_wait = max_wait
+        self.rate = float(requests) / period
+        self.capacity = requests
+        self.key = 'ratelimit:{}:{}'.format(provider, hashlib.sha1(credential.encode('UTF-8')).hexdigest())
+
+    @classmethod
+    def for_user(cls, user, provider, max_wait=None):
+        """ Rate limiter for the credential that 'user' uses with 'provider'. """
+        return cls(provider, get_api_credential(user, provider) or str(user.id), max_wait=max_wait)
+
+    def try_acquire(self, tokens=1):
+        """ Take 'tokens' from the bucket if possible, returns number of seconds to wait otherwise. """
+        global _token_bucket
+        if _token_bucket is None:
+            _token_bucket = get_redis().register_script(TOKEN_BUCKET_SCRIPT)
+        return float(_token_bucket(keys=[self.key], args=[self.rate, self.capacity, tokens, time.time()]))
+
+    def acquire(self, tokens=1):
+        """
+        Block until 'tokens' (number of API calls about to be made) are available. Raises RateLimited
+        instead if that would take longer than 'max_wait' seconds.
+        """
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            if self.max_wait is not None and wait > self.max_wait:
+                raise RateLimited(self.provider, int(math.ceil(wait)))
+            logger.debug("Rate limit for %s reached, waiting %.1fs", self.provider, wait)
+            time.sleep(wait)
+
+    def update(self, remaining, reset_ts=None):
+        """
+        Correct the bucket with the real remaining allowance reported by the provider (e.g. rate limit
+        headers). If the allowance is used up, the bucket stays empty until 'reset_ts'.
+        """
+        values = {
+            'tokens': min(self.capacity, max(0, remaining)),
+            'ts': time.time(),
+            'blocked_until': reset_ts if remaining <= 0 and reset_ts else 0
+        }
+        get_redis().hmset(self.key, values)
+
+    def block(self, seconds):
+        """ Keep the bucket empty for 'seconds', e.g. after the provider has throttled a request. """
+        self.update(0, time.time() + seconds)
+
+
+class GithubRateLimiter(RateLimiter):
+    """
+    Github reports the remaining allowance in every response, so the bucket is corrected with the
+    latest rate limit headers of the client before taking tokens.
+    """
+    def __init__(self, github_client, user, max_wait=None):
+        super(GithubRateLimiter, self).__init__(
+            'github', get_api_credential(user, 'github') or str(user.id), max_wait=max_wait)
+        self.github_client = github_client
+
+    def acquire(self, tokens=1):
+        remaining, limit = self.github_client.rate_limiting
+        self.update(remaining, self.github_client.rate_limiting_resettime)
+        super(GithubRateLimiter, self).acquire(tokens)
@@ -1,13 +1,28 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
 from functools import wraps
-from celery.task.control import inspect
-from dataimporter.models import User
-from cuely.queue_util import queue_full
-from datetime import datetime, timezone
+from itertools import islice
+from celery import current_app
+from cuely.queue_util import queue_full, get_redis
+from datetime import datetime, timezone, timedelta
+from django.contrib.auth.models import User
+from dataimporter.models import SyncCursor
 import logging
 logger = logging.getLogger(__name__)
 
 
 auth_fields = ['api_key', 'access_token', 'oauth_token']
+# leases are renewed every third of their ttl, see Lease class
+LEASE_TTL = 300
+# checkpoints older than this are considered stale, so the sync starts from the beginning
+SYNC_CURSOR_MAX_AGE = timedelta(days=1)
+# a re-queued task keeps its credential leased for this long after its countdown, see resumable()
+RESUME_LEASE_MARGIN = 60
+# lookups shared by subtasks are kept in redis for this many seconds, see stash_lookups()
+LOOKUPS_TTL = 24 * 3600
 
 
 def get_social_data(user, provider, social_keys):
@@ -17,41 +32,253 @@ def get_social_data(user, provider, social_keys):
     return {key: social.extra_data.get(key) for key in social_keys}
 
 
-def get_api_creds(username, provider):
-    u = User.objects.filter(username=username).first()
-    if not u:
-        return (None, None)
-    api_data = get_social_data(u, provider, auth_fields)
-    return filter(None, [api_data.get(x) for x in auth_fields])
+def get_api_credential(user, provider):
+    """ Returns the credential (api key or token) that 'user' uses for 'provider', serialized as a string. """
+    api_data = get_social_data(user, provider, auth_fields)
+    credential = next((api_data.get(x) for x in auth_fields if api_data.get(x)), None)
+    if credential is None:
+        return None
+    return credential if isinstance(credential, str) else json.dumps(credential, sort_keys=True)
 
 
-def get_active_api_keys(provider, package):
-    active_tasks = inspect().active()
-    if not active_tasks:
-        return []
+class Lease(object):
+    """
+    A lease on an api credential, held by a task while it uses the credential. Leases are kept in a
+    redis sorted set per (provider, credential), where each holder's score is the expiry timestamp of its
+    lease. The holder renews the lease in a background thread (heartbeat), so leases of dead workers
+    simply expire.
+    """
+    def __init__(self, provider, credential, ttl=LEASE_TTL):
+        self.key = _lease_key(provider, credential)
+        self.ttl = ttl
+        self.holder = uuid.uuid4().hex
+        self._released = threading.Event()
+        self._heartbeat = None
 
-    active_keys = []
-    for key, task_list in (active_tasks.items() or []):
-        for task in (task_list or []):
-            # unfortunately, celery inspect() returns arguments as string, so there has to be some hacky manipulation
-            if package in task.get('name'):
-                arg = next((task.get(x) for x in ['args', 'kwargs'] if '<User: ' in task.get(x)), None)
-                if arg:
-                    username = arg.split('<User: ')[1].split('>')[0]
-                    for auth_value in get_api_creds(username, provider):
-                        active_keys.append(auth_value)
-    return active_keys
+    def acquire(self):
+        self._renew()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+        return self
 
+    def release(self):
+        self._released.set()
+        get_redis().zrem(self.key, self.holder)
 
-def should_sync(user, provider, package):
-    keys = get_active_api_keys(provider, package)
-    social = user.social_auth.filter(provider=provider).first()
-    if social:
-        return not any(social.extra_data.get(x) in keys for x in auth_fields)
+    def _renew(self):
+        r = get_redis().pipeline()
+        r.zadd(self.key, time.time() + self.ttl, self.holder)
+        r.expire(self.key, self.ttl)
+        r.execute()
+
+    def _beat(self):
+        while not self._released.wait(self.ttl / 3.0):
+            try:
+                self._renew()
+            except Exception:
+                logger.exception("Could not renew lease %s", self.key)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def reserve_lease(provider, credential, ttl):
+    """
+    Keep the credential leased for 'ttl' seconds without a live holder, e.g. while a re-queued task waits
+    for its countdown, so that no other sync starts in the meantime.
+    """
+    key = _lease_key(provider, credential)
+    r = get_redis().pipeline()
+    r.zadd(key, time.time() + ttl, 'reserved:{}'.format(uuid.uuid4().hex))
+    r.expire(key, max(ttl, LEASE_TTL))
+    r.execute()
+
+
+def is_leased(provider, credential):
+    """ Check if any (live) task holds a lease on the credential. """
+    key = _lease_key(provider, credential)
+    r = get_redis().pipeline()
+    r.zremrangebyscore(key, '-inf', time.time())
+    r.zcard(key)
+    return r.execute()[1] > 0
+
+
+def loads_requester(fn):
+    """
+    Decorator for tasks that get the id of their requester (first argument or 'requester' keyword argument)
+    in the task message. The id is replaced with the User, tasks of deleted users are skipped.
+    """
+    @wraps(fn)
+    def with_requester(*args, **kwargs):
+        requester_id = kwargs.get('requester', args[0] if args else None)
+        requester = User.objects.filter(id=requester_id).first()
+        if requester is None:
+            logger.info("User %s doesn't exist anymore, skipping task %s", requester_id, fn.__name__)
+            return None
+        args, kwargs = _replace_requester(args, kwargs, requester)
+        return fn(*args, **kwargs)
+    return with_requester
+
+
+def _replace_requester(args, kwargs, requester):
+    if 'requester' in kwargs:
+        return args, dict(kwargs, requester=requester)
+    return (requester,) + tuple(args[1:]), kwargs
+
+
+def stash_lookups(**lookups):
+    """
+    Store lookups (e.g. users or folders of an account) that are shared by many subtasks in redis, instead of
+    sending them in every task message. Returns the key to pass to subtasks, see get_lookups().
+    Note that keys of the lookup dicts become strings.
+    """
+    data = json.dumps(lookups, sort_keys=True)
+    key = 'lookups:{}'.format(hashlib.sha1(data.encode('UTF-8')).hexdigest())
+    get_redis().setex(key, LOOKUPS_TTL, data)
+    return key
+
+
+def get_lookups(key):
+    """ Returns lookups stored with stash_lookups() or None if they have expired. """
+    data = get_redis().get(key)
+    return json.loads(data.decode('UTF-8')) if data else None
+
+
+def holds_lease(provider):
+    """
+    Decorator for tasks that use the 'provider' credentials of the task's requester (first argument
+    or 'requester' keyword argument). The task holds the lease on the credential while it runs, which
+    prevents starting another sync with the same credential (see should_sync()).
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def with_lease(*args, **kwargs):
+            requester = kwargs.get('requester', args[0] if args else None)
+            credential = get_api_credential(requester, provider) if requester else None
+            if not credential:
+                return fn(*args, **kwargs)
+            with Lease(provider, credential):
+                return fn(*args, **kwargs)
+        return with_lease
+    return decorator
+
+
+def get_sync_state(user, provider, key):
+    """ Returns the persisted state of a sync (e.g. high-water marks), see SyncCursor. """
+    db_cursor = SyncCursor.objects.filter(user=user, provider=provider, key=key).first()
+    return db_cursor.cursor if db_cursor else {}
+
+
+def set_sync_state(user, provider, key, state):
+    SyncCursor.objects.update_or_create(user=user, provider=provider, key=key, defaults={'cursor': state})
+
+
+class RateLimited(Exception):
+    """ Raised when waiting for the rate limit would take longer than allowed. """
+    def __init__(self, provider, countdown):
+        super(RateLimited, self).__init__("Rate limit for {} reached, retry in {}s".format(provider, countdown))
+        self.countdown = countdown
+
+
+class SyncCheckpoint(dict):
+    """
+    Paging progress of a resumable task. Unless the task was re-queued with its cursor, it's loaded from
+    the last checkpoint (SyncCursor) of the same sync, so that a sync continues where it left off even if
+    its worker died.
+    """
+    def __init__(self, user, provider, key, cursor=None):
+        self.user = user
+        self.provider = provider
+        self.key = key
+        if cursor is None:
+            db_cursor = SyncCursor.objects.filter(
+                user=user,
+                provider=provider,
+                key=key,
+                updated__gt=datetime.now(timezone.utc) - SYNC_CURSOR_MAX_AGE
+            ).first()
+            cursor = db_cursor.cursor if db_cursor else {}
+            if cursor:
+                logger.info("Resuming %s sync '%s' for user '%s' from checkpoint", provider, key, user.username)
+        super(SyncCheckpoint, self).__init__(cursor)
+
+    def checkpoint(self):
+        """ Store the progress, should be called after every committed page. """
+        set_sync_state(self.user, self.provider, self.key, dict(self))
+
+    def clear(self):
+        SyncCursor.objects.filter(user=self.user, provider=self.provider, key=self.key).delete()
+
+
+def resumable(provider, key=None):
+    """
+    Decorator for tasks that page through big listings of the task's requester (first argument or 'requester'
+    keyword argument, loaded with loads_requester()). The task gets a 'cursor' keyword argument (SyncCheckpoint),
+    a dict in which it keeps its paging progress and checkpoints it after every committed page. If the task raises
+    RateLimited (or the provider throttles one of its requests), it is re-queued with the current cursor and a
+    countdown, so it continues where it left off (the credential stays leased in the meantime, see
+    reserve_lease()). The checkpoint is removed once the task finishes. 'key' is a function of task arguments,
+    for tasks that run several syncs for the same user (e.g. one per board).
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def with_cursor(*args, **kwargs):
+            requester = kwargs.get('requester', args[0] if args else None)
+            cursor_key = '{}:{}'.format(fn.__name__, key(*args, **kwargs)) if key else fn.__name__
+            cursor = SyncCheckpoint(requester, provider, cursor_key, kwargs.pop('cursor', None))
+            try:
+                result = fn(*args, cursor=cursor, **kwargs)
+            except Exception as e:
+                countdown = e.countdown if isinstance(e, RateLimited) else _throttled(provider, requester, e)
+                if countdown is None:
+                    raise
+                task = current_app.tasks['{}.{}'.format(fn.__module__, fn.__name__)]
+                logger.info("Task %s is rate limited, resuming in %ss", task.name, countdown)
+                kwargs['cursor'] = dict(cursor)
+                # re-queue with the requester's id, see loads_requester()
+                args, kwargs = _replace_requester(args, kwargs, requester.id)
+                task.apply_async(args=args, kwargs=kwargs, countdown=countdown)
+                # the task's own lease is released when it returns, keep the credential leased until it resumes
+                credential = get_api_credential(requester, provider)
+                if credential:
+                    reserve_lease(provider, credential, countdown + RESUME_LEASE_MARGIN)
+                return None
+            cursor.clear()
+            return result
+        return with_cursor
+    return decorator
+
+
+def _throttled(provider, user, exc):
+    """
+    Countdown for re-queueing a task that failed with 'exc', if it's the provider's response to a throttled
+    request (see rate_limit.get_retry_after()). None otherwise.
+    """
+    # rate_limit module depends on this one
+    from dataimporter.rate_limit import RateLimiter, get_retry_after
+    retry_after = get_retry_after(exc)
+    if retry_after is not None:
+        # hold back the other tasks that use the same credential
+        RateLimiter.for_user(user, provider).block(retry_after)
+    return retry_after
+
+
+def should_sync(user, provider):
+    credential = get_api_credential(user, provider)
+    if credential:
+        return not is_leased(provider, credential)
     else:
         return True
 
 
+def _lease_key(provider, credential):
+    # don't use plain credentials in redis keys
+    return 'lease:{}:{}'.format(provider, hashlib.sha1(credential.encode('UTF-8')).hexdigest())
+
+
 def should_queue(fn):
     """ Decorator that checks for queue length and does nothing in case the queue is full """
     @wraps(fn)
@@ -66,21 +293,116 @@ def should_queue(fn):
     return check_queue
 
 
-def cut_utf_string(s, bytes_len_max, step=1):
+def cut_utf_string(s, bytes_len_max):
     """
     Algolia has record limit of 10 kilobytes. Therefore, we need to cut file content to less than that.
-    Unfortunately, there is no easy way to cut a UTF string to exact bytes length (characters may be in
-    different byte sizes, i.e. usually up to 4 bytes).
+    Characters may be in different byte sizes (up to 4 bytes), so the string is encoded and cut at the
+    last whole character that fits into 'bytes_len_max' bytes.
     """
-    # worst case, every character is 1 byte, so we first cut the string to max bytes length
+    # every character is at least 1 byte, so longer strings are cut to max bytes length first
     s = s[:bytes_len_max]
-    l = len(s.encode('UTF-8'))
-    while l > bytes_len_max:
-        s = s[:-step]
-        l = len(s.encode('UTF-8'))
+    encoded = s.encode('UTF-8')
+    if len(encoded) <= bytes_len_max:
+        return s
+    # the character that doesn't fit whole is dropped by the decoder
+    return encoded[:bytes_len_max].decode('UTF-8', errors='ignore')
+
+
+def json_len(s):
+    """
+    Length of the string in a JSON record, without the quotes. Algolia client sends ASCII JSON, so besides
+    quotes and control characters, all non-ASCII characters are escaped too.
+    """
+    return len(json.dumps(s)) - 2
+
+
+def _json_char_len(c):
+    if c in '"\\\b\f\n\r\t':
+        return 2
+    code = ord(c)
+    if code < 0x20:
+        return 6
+    if code < 0x80:
+        return 1
+    # characters outside of the basic plane are escaped as surrogate pairs
+    return 6 if code < 0x10000 else 12
+
+
+def cut_json_string(s, json_len_max):
+    """ Cut the string at the last whole character that fits into 'json_len_max' bytes of JSON (see json_len()). """
+    if json_len(s) <= json_len_max:
+        return s
+    size = 0
+    for i, c in enumerate(s):
+        size = size + _json_char_len(c)
+        if size > json_len_max:
+            return s[:i]
     return s
 
 
+def cut_utf_strings(strings, bytes_len_max, min_len=0):
+    """
+    Cut 'strings' (ordered by priority) so that together they fit into 'bytes_len_max' bytes of JSON (see
+    json_len()). Strings shorter than an equal share of the budget are kept whole and what they leave is shared
+    equally among the longer ones. If the share would be less than 'min_len' bytes, strings with the lowest
+    priority are dropped (None).
+    """
+    sizes = [json_len(s) for s in strings]
+    count = len(strings)
+    cap = None
+    while count > 0:
+        cap = _fair_share(sizes[:count], bytes_len_max)
+        if cap is None or cap >= min_len:
+            break
+        count = count - 1
+    cut = [s if cap is None or size <= cap else cut_json_string(s, cap) for s, size in zip(strings, sizes[:count])]
+    return cut + [None] * (len(strings) - count)
+
+
+def _fair_share(sizes, bytes_len_max):
+    """ The largest cap, such that the sizes cut to it sum up to at most 'bytes_len_max' (None if all fit). """
+    if sum(sizes) <= bytes_len_max:
+        return None
+    remaining = max(bytes_len_max, 0)
+    ordered = sorted(sizes)
+    for i, size in enumerate(ordered):
+        share = remaining // (len(ordered) - i)
+        if size > share:
+            return share
+        remaining = remaining - size
+    return 0
+
+
+def fit_record(record, slots, bytes_len_max, min_len=0):
+    """
+    Cut texts in 'slots' ((dict, key) pairs within 'record', ordered by priority) so that the whole record
+    fits into 'bytes_len_max' bytes of JSON, serialized the same way as by Algolia client. The rest of the record
+    is measured once, then the remaining budget is shared among the texts (see cut_utf_strings()). Returns the
+    dicts whose texts were dropped, the caller should remove them from the record.
+    """
+    slots = [(d, key) for d, key in slots if d.get(key)]
+    texts = [d[key] for d, key in slots]
+    for d, key in slots:
+        d[key] = ''
+    overhead = len(json.dumps(record))
+    dropped = []
+    for (d, key), text in zip(slots, cut_utf_strings(texts, bytes_len_max - overhead, min_len=min_len)):
+        d[key] = text
+        if text is None:
+            dropped.append(d)
+    return dropped
+
+
 def get_utc_timestamp():
     utc_dt = datetime.now(timezone.utc)
     return utc_dt.astimezone()
+
+
+def chunked(iterable, size):
+    """ Iterate over (lazy) 'iterable' in lists of 'size' items, e.g. to process paged api results in batches. """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -4,16 +4,17 @@ Admin tasks for user accounts, teams, etc.
 from celery import shared_task
 
 from dataimporter.models import Document
+from dataimporter.algolia.engine import algolia_engine
+from dataimporter.task_util import loads_requester
 import logging
 logger = logging.getLogger(__name__)
 
 
 @shared_task
+@loads_requester
 def purge_documents(user, remove_user=False):
-    # this can take a long time, if the user has many documents
-    # reason is that for every deleted row we also call delete on Algolia index
     logger.info("Purging all documents for user %s/%s", user.id, user.username)
-    Document.objects.filter(user_id=user.id).delete()
+    algolia_engine.bulk_delete(Document.objects.filter(user_id=user.id))
     if remove_user:
         logger.info("Deleting account for user %s/%s", user.id, user.username)
         user.delete()
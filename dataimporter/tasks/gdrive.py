@@ -1,15 +1,27 @@
 import os
-import httplib2
+import codecs
+import tempfile
 import re
+from collections import defaultdict
 from dateutil.parser import parse as parse_date
 
 from apiclient import discovery
-from celery import shared_task, subtask
+from apiclient.errors import HttpError
+from apiclient.http import MediaIoBaseDownload
+from celery import shared_task, subtask, group
+from django.db import transaction
+from django.db.models import Q
 from oauth2client.client import GoogleCredentials
 
-from dataimporter.models import Document, SocialAttributes, get_or_create
+from dataimporter.models import Document, SocialAttributes, bulk_get_or_create, bulk_save
 from dataimporter.algolia.engine import algolia_engine
-from dataimporter.task_util import should_sync, should_queue, cut_utf_string, get_utc_timestamp
+from dataimporter.algolia.index import GDRIVE_METADATA_FIELDS, GDRIVE_CONTENT_FIELDS
+from dataimporter.extract import can_extract, extract_text, get_cached_text, EXTRACT_MAX_FILE_BYTES, EXTRACT_TIMEOUT
+from dataimporter.rate_limit import RateLimiter, MAX_BLOCKING_WAIT
+from dataimporter.http_cache import CachingHttp
+from dataimporter.task_util import (
+    should_sync, loads_requester, holds_lease, resumable, should_queue, cut_utf_string, get_utc_timestamp, chunked
+)
 import logging
 logger = logging.getLogger(__name__)
 
@@ -33,6 +45,7 @@ ignored_mimes_regex = [
     r'audio/.*'
 ]
 IGNORED_MIMES = [re.compile(x, re.UNICODE | re.IGNORECASE) for x in ignored_mimes_regex]
+FOLDER_MIME = 'application/vnd.google-apps.folder'
 FILE_FIELDSET = ','.join([
     'name',
     'id',
@@ -81,11 +94,15 @@ GDRIVE_KEYWORDS = {
         'application/vnd.google-apps.folder': 'folders,dirs'
     }
 }
+# only this much of the file content is indexed (Algolia's record limit is 10 KB)
+GDRIVE_CONTENT_BYTES = 9000
+# files for text extraction are downloaded in chunks of this size
+GDRIVE_DOWNLOAD_CHUNK = 1024 * 1024
 
 
 def start_synchronization(user):
     """ Run initial syncing of user's data in external systems. Gdrive-only at the moment. """
-    if should_sync(user, 'google-oauth2', 'tasks.gdrive'):
+    if should_sync(user, 'google-oauth2'):
         access_token, refresh_token = get_google_tokens(user)
 
         # ## gdrive ###################
@@ -97,7 +114,7 @@ def start_synchronization(user):
             user=user, defaults={'start_page_token': response.get('startPageToken')})
 
         # 2. Start the synchronization
-        collect_gdrive_docs.delay(user, access_token, refresh_token)
+        collect_gdrive_docs.delay(user.id)
     else:
         logger.info("Gdrive oauth token for user '%s' already in use, skipping sync ...", user.username)
 
@@ -111,16 +128,18 @@ def update_synchronization():
     """
     logger.debug("Update synchronizations started")
     for sa in SocialAttributes.objects.filter(start_page_token__isnull=False):
-        if should_sync(sa.user, 'google-oauth2', 'tasks.gdrive'):
+        if should_sync(sa.user, 'google-oauth2'):
             if sa.user.social_auth.filter(provider='google-oauth2').first():
-                access_token, refresh_token = get_google_tokens(sa.user)
-                subtask(sync_gdrive_changes).delay(sa.user, access_token, refresh_token, sa.start_page_token)
+                subtask(sync_gdrive_changes).delay(sa.user.id, sa.start_page_token)
         else:
             logger.info("Gdrive oauth token for user '%s' already in use, skipping sync ...", sa.user.username)
 
 
 @shared_task
-def collect_gdrive_docs(requester, access_token, refresh_token):
+@loads_requester
+@holds_lease('google-oauth2')
+@resumable('google-oauth2')
+def collect_gdrive_docs(requester, cursor=None):
     logger.debug("LIST gdrive files")
 
     def _call_gdrive(service, page_token):
@@ -136,16 +155,19 @@ def collect_gdrive_docs(requester, access_token, refresh_token):
             params['pageToken'] = page_token
         return service.files().list(**params).execute()
 
-    process_gdrive_docs(requester, access_token, refresh_token, files_fn=_call_gdrive, json_key='files')
+    process_gdrive_docs(requester, files_fn=_call_gdrive, json_key='files', cursor=cursor)
 
 
 @shared_task
-def collect_gdrive_folders(requester, access_token, refresh_token):
+@loads_requester
+@holds_lease('google-oauth2')
+@resumable('google-oauth2')
+def collect_gdrive_folders(requester, cursor=None):
     logger.debug("LIST gdrive folders")
 
     def _call_gdrive(service, page_token):
         params = {
-            'q': "mimeType = 'application/vnd.google-apps.folder'",
+            'q': "mimeType = '{}'".format(FOLDER_MIME),
             'pageSize': 300,
             'fields': 'files({}),nextPageToken'.format(FILE_FIELDSET)
         }
@@ -153,17 +175,20 @@ def collect_gdrive_folders(requester, access_token, refresh_token):
             params['pageToken'] = page_token
         return service.files().list(**params).execute()
 
-    process_gdrive_docs(requester, access_token, refresh_token, files_fn=_call_gdrive, json_key='files')
+    process_gdrive_docs(requester, files_fn=_call_gdrive, json_key='files', cursor=cursor)
 
 
 @shared_task
-def sync_gdrive_changes(requester, access_token, refresh_token, start_page_token):
+@loads_requester
+@holds_lease('google-oauth2')
+@resumable('google-oauth2')
+def sync_gdrive_changes(requester, start_page_token, cursor=None):
     logger.debug("CHANGES gdrive files")
 
     def _call_gdrive(service, page_token):
         params = {
             'pageSize': 300,
-            'fields': 'changes(file({})),newStartPageToken,nextPageToken'.format(FILE_FIELDSET),
+            'fields': 'changes(fileId,removed,file({})),newStartPageToken,nextPageToken'.format(FILE_FIELDSET),
             'pageToken': page_token or start_page_token,
             'spaces': 'drive',
             'includeRemoved': True,
@@ -173,154 +198,324 @@ def sync_gdrive_changes(requester, access_token, refresh_token, start_page_token
 
     new_start_page_token = process_gdrive_docs(
         requester,
-        access_token,
-        refresh_token,
         files_fn=_call_gdrive,
-        json_key='changes'
+        json_key='changes',
+        cursor=cursor
     )
     if new_start_page_token:
         SocialAttributes.objects.update_or_create(user=requester, defaults={'start_page_token': new_start_page_token})
 
 
-def process_gdrive_docs(requester, access_token, refresh_token, files_fn, json_key):
-    service = connect_to_gdrive(access_token, refresh_token)
-    folders = {}
+def process_gdrive_docs(requester, files_fn, json_key, cursor):
+    service = connect_to_gdrive(*get_google_tokens(requester))
+    limiter = RateLimiter.for_user(requester, 'google-oauth2', max_wait=MAX_BLOCKING_WAIT)
+    # folders are kept up to date from the changes feed, full listings refresh the whole tree
+    incremental = json_key == 'changes'
+    folders = None
 
-    page_token = None
+    # continue from the last checkpoint, if any
+    page_token = cursor.get('page_token')
     new_start_page_token = None
-    while True:
-        files = files_fn(service, page_token)
-        new_start_page_token = files.get('newStartPageToken', new_start_page_token)
-        items = files.get(json_key, [])
-        if not folders and len(items) > 0:
-            # retrieve all folders to be able to get file path more easily in the file listing(s)
-            logger.debug("Getting folders for %s/%s", requester.id, requester.username)
-            folders = get_gdrive_folders(service)
-            # check if any folder was marked as hidden and we already have it synced ...
-            # if we do, then remove it (plus all children) from our indexing
-            for folder_id, folder in folders.items():
-                if folder.get('hidden') is True:
-                    desync_folder(folder.get('id'), folders, requester, service)
-
-        for item in items:
-            if 'file' in item:
-                item = item['file']
-            # check for ignored mime types
-            if any(x.match(item.get('mimeType', '')) for x in IGNORED_MIMES):
-                continue
-            parents = item.get('parents', [])
-            hidden = is_hidden(item.get('description')) or any(is_hidden_in_folder(f, folders) for f in parents)
-            if item.get('trashed') or hidden:
-                # file was removed or hidden
-                Document.objects.filter(
-                    document_id=item['id'],
-                    requester=requester,
-                    user_id=requester.id
-                ).delete()
-                continue
-
-            # handle file path within gdrive
-            parent = parents[0] if parents else None
-            path = get_gdrive_path(parent, folders)
-
-            doc, created = get_or_create(
-                model=Document,
-                document_id=item['id'],
-                requester=requester,
-                user_id=requester.id
-            )
-            doc.mime_type = item.get('mimeType').lower()
-            doc.title = item.get('name')
-            doc.webview_link = item.get('webViewLink')
-            doc.icon_link = item.get('iconLink')
-            doc.thumbnail_link = item.get('thumbnailLink')
-            doc.last_updated = item.get('modifiedTime')
-            doc.path = path
-            last_modified_on_server = parse_date(doc.last_updated)
-            doc.last_updated_ts = last_modified_on_server.timestamp()
-            doc.modifier_display_name = item.get('lastModifyingUser', {}).get('displayName')
-            doc.modifier_photo_link = item.get('lastModifyingUser', {}).get('photoLink')
-            doc.owner_display_name = item['owners'][0]['displayName']
-            doc.owner_photo_link = item.get('owners', [{}])[0].get('photoLink')
-            doc.primary_keywords = GDRIVE_KEYWORDS['primary']
-            doc.secondary_keywords = GDRIVE_KEYWORDS['secondary'][doc.mime_type] \
-                if doc.mime_type in GDRIVE_KEYWORDS['secondary'] else None
-            can_download = item.get('capabilities', {}).get('canDownload', True)
-            if can_download:
-                # check also the mime type as we only support some of them
-                if not any(x for x in EXPORTABLE_MIMES if doc.mime_type.startswith(x)):
-                    can_download = False
-            if can_download:
-                if not created:
-                    if doc.download_status is Document.READY and can_download and \
-                            (doc.last_synced is None or last_modified_on_server > doc.last_synced):
-                        doc.download_status = Document.PENDING
-                        subtask(download_gdrive_document).delay(doc, access_token, refresh_token)
+    with algolia_engine.batch() as batch:
+        while True:
+            limiter.acquire()
+            files = files_fn(service, page_token)
+            new_start_page_token = files.get('newStartPageToken', new_start_page_token)
+            items = files.get(json_key, [])
+            if folders is None and len(items) > 0:
+                # folder tree is needed to get file path more easily in the file listing(s)
+                folders = load_gdrive_folders(requester, service, limiter, refresh=not incremental)
+
+            removed = []
+            listed = []
+            folders_changed = False
+            for item in items:
+                if item.get('removed'):
+                    # file was deleted or is not accessible anymore
+                    removed.append(item.get('fileId'))
+                    folders_changed = folders.remove_folder(item.get('fileId')) or folders_changed
+                    continue
+                if 'file' in item:
+                    item = item['file']
+                if incremental and item.get('mimeType') == FOLDER_MIME:
+                    if item.get('trashed'):
+                        folders.remove_folder(item.get('id'))
+                    elif folders.update_folder(item):
+                        desync_folder(item.get('id'), folders, requester, service, limiter)
+                    folders_changed = True
+                # check for ignored mime types
+                if any(x.match(item.get('mimeType', '')) for x in IGNORED_MIMES):
+                    continue
+                parents = item.get('parents', [])
+                hidden = is_hidden(item.get('description')) or any(folders.is_hidden(f) for f in parents)
+                if item.get('trashed') or hidden:
+                    # file was removed or hidden
+                    removed.append(item['id'])
+                    continue
+                listed.append(item)
+
+            # commit the whole page at once
+            with transaction.atomic():
+                if removed:
+                    algolia_engine.bulk_delete(Document.objects.filter(
+                        document_id__in=removed,
+                        requester=requester,
+                        user_id=requester.id
+                    ))
+                synced, downloads = _process_page(requester, listed, folders)
+                if folders_changed:
+                    store_gdrive_folders(requester, folders)
+
+            for doc, created in synced:
+                if created:
+                    algolia_engine.sync(doc, add=True)
                 else:
-                    algolia_engine.sync(doc, add=created)
-                    subtask(download_gdrive_document).delay(doc, access_token, refresh_token)
-            else:
-                doc.download_status = Document.READY
-                doc.last_synced = get_utc_timestamp()
-                doc.save()
-                algolia_engine.sync(doc, add=False)
+                    # keep the content that is already in the index, it's updated by download tasks
+                    algolia_engine.sync(doc, add=False, fields=GDRIVE_METADATA_FIELDS)
 
-            doc.save()
+            # flush the index before queueing downloads, so that buffered objects (without content)
+            # don't overwrite the ones synced by download tasks
+            batch.flush()
+            if downloads:
+                group(_download_task(doc) for doc in downloads).apply_async()
 
-        page_token = files.get('nextPageToken')
-        if not page_token:
-            break
+            page_token = files.get('nextPageToken')
+            if not page_token:
+                break
+            cursor['page_token'] = page_token
+            cursor.checkpoint()
     return new_start_page_token
 
 
-def desync_folder(folder_id, folders, requester, service):
-    db_folder = Document.objects.filter(document_id=folder_id, user_id=requester.id)
-    if db_folder.exists():
-        page_token = None
-        while True:
-            params = {
-                'q': "'{}' in parents".format(folder_id),
-                'pageSize': 100,
-                'fields': 'files(id),nextPageToken'
-            }
-            if page_token:
-                params['pageToken'] = page_token
-            children = service.files().list(**params).execute()
-            child_ids = [c.get('id') for c in children.get('files', [])]
-            for cid in child_ids:
-                if cid in folders:
-                    desync_folder(cid, folders, requester, service)
-            Document.objects.filter(document_id__in=child_ids, user_id=requester.id).delete()
-            page_token = children.get('nextPageToken')
-            if not page_token:
-                break
-        db_folder.delete()
+def _process_page(requester, items, folders):
+    """
+    Update db documents of (listed) gdrive items. Returns changed documents (with a flag whether they are new)
+    and documents whose content should be downloaded. Unchanged documents are skipped.
+    """
+    db_docs = bulk_get_or_create(
+        Document, 'document_id', [item['id'] for item in items], requester=requester, user_id=requester.id)
+    synced = []
+    downloads = []
+    for item in items:
+        doc, created = db_docs[item['id']]
+        old_title, old_updated_ts, old_parent = doc.title, doc.last_updated_ts, doc.document_parent_id
+        # handle file path within gdrive
+        parents = item.get('parents', [])
+        parent = parents[0] if parents else None
+        # files without a parent get an empty one, null means that the parent is not known yet
+        doc.document_parent_id = parent or ''
+        doc.path = folders.path(parent)
+        doc.mime_type = item.get('mimeType').lower()
+        doc.title = item.get('name')
+        doc.webview_link = item.get('webViewLink')
+        doc.icon_link = item.get('iconLink')
+        doc.thumbnail_link = item.get('thumbnailLink')
+        doc.last_updated = item.get('modifiedTime')
+        last_modified_on_server = parse_date(doc.last_updated)
+        doc.last_updated_ts = last_modified_on_server.timestamp()
+        doc.modifier_display_name = item.get('lastModifyingUser', {}).get('displayName')
+        doc.modifier_photo_link = item.get('lastModifyingUser', {}).get('photoLink')
+        doc.owner_display_name = item['owners'][0]['displayName']
+        doc.owner_photo_link = item.get('owners', [{}])[0].get('photoLink')
+        doc.primary_keywords = GDRIVE_KEYWORDS['primary']
+        doc.secondary_keywords = GDRIVE_KEYWORDS['secondary'][doc.mime_type] \
+            if doc.mime_type in GDRIVE_KEYWORDS['secondary'] else None
+        can_download = item.get('capabilities', {}).get('canDownload', True)
+        if can_download:
+            # check also the mime type as we only support some of them
+            if not (any(x for x in EXPORTABLE_MIMES if doc.mime_type.startswith(x)) or can_extract(doc.mime_type)):
+                can_download = False
+        modified = doc.last_synced is None or last_modified_on_server > doc.last_synced
+        new_version = int(doc.last_updated_ts) != old_updated_ts
+        # a pending download of an older version skips the document (see sync_content()),
+        # so every new version gets its own download
+        needs_download = can_download and (
+            created or (modified and (doc.download_status is Document.READY or new_version)))
+        changed = doc.title != old_title or new_version or doc.document_parent_id != old_parent
+        if not (created or needs_download or changed):
+            # nothing has changed since the last sync
+            continue
+        if needs_download:
+            doc.download_status = Document.PENDING
+            downloads.append(doc)
+        elif not can_download:
+            doc.download_status = Document.READY
+            doc.last_synced = get_utc_timestamp()
+        synced.append((doc, created))
+
+    bulk_save(Document, [doc for doc, created in synced], 'document_id', requester=requester, user_id=requester.id)
+    return synced, downloads
+
+
+def desync_folder(folder_id, folders, requester, service, limiter):
+    """
+    Remove a (hidden) folder with all its subfolders and documents from our indexing. The subfolders are
+    taken from the folder tree, the documents are found by their parent folder. Documents that were synced
+    before their parent was stored don't have it, so as long as user has any of those, the children of
+    the folders are also listed in gdrive.
+    """
+    subtree = folders.subtree(folder_id)
+    for folder_ids in chunked(subtree, 500):
+        algolia_engine.bulk_delete(Document.objects.filter(
+            Q(document_id__in=folder_ids) | Q(document_parent_id__in=folder_ids),
+            user_id=requester.id
+        ))
+    unparented = Document.objects.filter(
+        user_id=requester.id, document_id__isnull=False, document_parent_id__isnull=True).exists()
+    if unparented:
+        for folder_ids in chunked(subtree, 20):
+            for child_ids in chunked(_list_children(service, limiter, folder_ids), 500):
+                algolia_engine.bulk_delete(Document.objects.filter(document_id__in=child_ids, user_id=requester.id))
+    # remember the hidden folders that were desynced, so they are not desynced again
+    for fid in subtree:
+        if folders[fid].get('hidden') is True:
+            folders[fid]['desynced'] = True
+
+
+def _list_children(service, limiter, folder_ids):
+    """ Ids of files (and folders) in any of the folders. """
+    page_token = None
+    while True:
+        params = {
+            'q': ' or '.join("'{}' in parents".format(x) for x in folder_ids),
+            'pageSize': 1000,
+            'fields': 'files(id),nextPageToken'
+        }
+        if page_token:
+            params['pageToken'] = page_token
+        limiter.acquire()
+        children = service.files().list(**params).execute()
+        for child in children.get('files', []):
+            yield child.get('id')
+        page_token = children.get('nextPageToken')
+        if not page_token:
+            break
 
 
-def get_gdrive_folders(service):
+class FolderTree(dict):
+    """
+    Folders of user's gdrive (folder id -> id, parent, name, hidden), as stored in SocialAttributes.
+    Folder paths and hidden flags are memoized per folder.
+    """
+    def __init__(self, *args, **kwargs):
+        super(FolderTree, self).__init__(*args, **kwargs)
+        self._paths = {}
+        self._hidden = {}
+        self._children = None
+
+    def update_folder(self, item):
+        """ Add or update a folder from a gdrive listing item. Returns True if the folder has become hidden. """
+        parents = item.get('parents', [])
+        old = self.get(item.get('id'), {})
+        was_hidden = old.get('hidden') is True
+        self[item.get('id')] = {
+            'id': item.get('id'),
+            'parent': parents[0] if parents else None,
+            'name': item.get('name'),
+            'hidden': is_hidden(item.get('description'))
+        }
+        if self[item.get('id')]['hidden'] and old.get('desynced'):
+            self[item.get('id')]['desynced'] = True
+        self._clear_memo()
+        return self[item.get('id')]['hidden'] and not was_hidden
+
+    def remove_folder(self, folder_id):
+        """ Returns True if the folder was in the tree. """
+        if self.pop(folder_id, None) is None:
+            return False
+        self._clear_memo()
+        return True
+
+    def path(self, folder_id):
+        """ Names of folders from the root to the folder. """
+        if folder_id not in self:
+            return []
+        if folder_id not in self._paths:
+            folder = self[folder_id]
+            self._paths[folder_id] = self.path(folder.get('parent')) + [folder.get('name')]
+        return self._paths[folder_id]
+
+    def is_hidden(self, folder_id):
+        """ Whether the folder or any of its ancestors is hidden. """
+        if folder_id not in self:
+            return False
+        if folder_id not in self._hidden:
+            folder = self[folder_id]
+            self._hidden[folder_id] = folder.get('hidden') is True or self.is_hidden(folder.get('parent'))
+        return self._hidden[folder_id]
+
+    def subtree(self, folder_id):
+        """ Ids of the folder and all the folders below it. """
+        if self._children is None:
+            self._children = defaultdict(list)
+            for folder in self.values():
+                self._children[folder.get('parent')].append(folder.get('id'))
+        ids = set()
+        stack = [folder_id]
+        while stack:
+            fid = stack.pop()
+            if fid in self and fid not in ids:
+                ids.add(fid)
+                stack.extend(self._children[fid])
+        return ids
+
+    def _clear_memo(self):
+        self._paths.clear()
+        self._hidden.clear()
+        self._children = None
+
+
+def load_gdrive_folders(requester, service, limiter, refresh=False):
+    """
+    Returns the stored folder tree of the user, the tree is (re)fetched from gdrive if 'refresh' is set.
+    Hidden folders that haven't been desynced yet (see desync_folder()) are desynced first.
+    """
+    sa = SocialAttributes.objects.filter(user=requester).first()
+    stored = FolderTree(sa.gdrive_folders if sa else {})
+    if stored and not refresh:
+        folders = stored
+    else:
+        logger.debug("Getting folders for %s/%s", requester.id, requester.username)
+        folders = get_gdrive_folders(service, limiter)
+        for folder_id, folder in folders.items():
+            if folder.get('hidden') is True and stored.get(folder_id, {}).get('hidden') is True and \
+                    stored[folder_id].get('desynced'):
+                folder['desynced'] = True
+    # check if any folder was marked as hidden and we already have it synced ...
+    # if we do, then remove it (plus all children) from our indexing, unless that has been done already
+    pending = [k for k, v in folders.items() if v.get('hidden') is True and not v.get('desynced')]
+    for folder_id in pending:
+        # desyncing a folder also flags the hidden folders below it
+        if not folders[folder_id].get('desynced'):
+            desync_folder(folder_id, folders, requester, service, limiter)
+    if pending or folders is not stored:
+        store_gdrive_folders(requester, folders)
+    return folders
+
+
+def store_gdrive_folders(requester, folders):
+    SocialAttributes.objects.update_or_create(user=requester, defaults={'gdrive_folders': dict(folders)})
+
+
+def get_gdrive_folders(service, limiter):
     page_token = None
-    lookup = {}
+    folders = FolderTree()
     while True:
         params = {
-            'q': "mimeType = 'application/vnd.google-apps.folder'",
+            'q': "mimeType = '{}'".format(FOLDER_MIME),
             'pageSize': 300,
             'fields': 'files(id,name,parents,description),nextPageToken'
         }
         if page_token:
             params['pageToken'] = page_token
+        limiter.acquire()
         files = service.files().list(**params).execute()
         for item in files.get('files', []):
-            parents = item.get('parents', [])
-            lookup[item.get('id')] = {
-                'id': item.get('id'),
-                'parent': parents[0] if parents else None,
-                'name': item.get('name'),
-                'hidden': is_hidden(item.get('description'))
-            }
+            folders.update_folder(item)
         page_token = files.get('nextPageToken')
         if not page_token:
             break
-    return lookup
+    return folders
 
 
 def is_hidden(item_description):
@@ -329,59 +524,119 @@ def is_hidden(item_description):
     return '!cuely' in item_description.lower()
 
 
-def is_hidden_in_folder(file_id, folders):
-    if not (file_id and folders and file_id in folders):
-        return []
-    while file_id is not None:
-        f = folders.get(file_id)
-        if f.get('hidden') is True:
-            return True
-        file_id = f.get('parent')
-        if file_id not in folders:
-            file_id = None
-    return False
-
-
-def get_gdrive_path(file_id, folders):
-    if not (file_id and folders and file_id in folders):
-        return []
-    path = []
-    while file_id is not None:
-        f = folders.get(file_id)
-        path.append(f.get('name'))
-        file_id = f.get('parent')
-        if file_id not in folders:
-            file_id = None
-    path.reverse()
-    return path
+def _download_task(doc):
+    """ Signature of the task that downloads the content of 'doc'. """
+    task = extract_gdrive_document if can_extract(doc.mime_type) else download_gdrive_document
+    return task.s(doc.id, doc.mime_type, int(doc.last_updated_ts))
 
 
 @shared_task
-def download_gdrive_document(doc, access_token, refresh_token):
+def download_gdrive_document(doc_id, mime_type, last_updated_ts):
+    """
+    Download the content of a document, only the content is then updated in the index. 'last_updated_ts' is
+    the version of the document that the download was queued for.
+    """
+    def _download(service, doc, limiter):
+        if mime_type.startswith('application/vnd.google-apps.'):
+            export_mime = 'text/csv' if 'spreadsheet' in mime_type else 'text/plain'
+            request = service.files().export_media(fileId=doc.document_id, mimeType=export_mime)
+        else:
+            request = service.files().get_media(fileId=doc.document_id)
+        limiter.acquire()
+        return download_text(request, GDRIVE_CONTENT_BYTES)
+
+    sync_content(doc_id, last_updated_ts, _download)
+
+
+@shared_task(soft_time_limit=EXTRACT_TIMEOUT, time_limit=EXTRACT_TIMEOUT + 30)
+def extract_gdrive_document(doc_id, mime_type, last_updated_ts):
+    """
+    Same as download_gdrive_document(), for PDF and Office files whose text is extracted. Downloading and parsing
+    them takes a while, so these tasks have their own 'extract' queue (see TASK_QUEUES setting) and a time limit.
+    """
+    def _extract(service, doc, limiter):
+        return download_and_extract(service, doc, mime_type, last_updated_ts, limiter)
+
+    sync_content(doc_id, last_updated_ts, _extract)
+
+
+def sync_content(doc_id, last_updated_ts, fetch_fn):
+    """ Update the content of a document (in the index) with the text that 'fetch_fn' returns. """
+    doc = Document.objects.filter(id=doc_id).select_related('requester').first()
+    if not doc:
+        # removed in the meantime
+        return
+    if doc.last_updated_ts and doc.last_updated_ts > last_updated_ts:
+        # a newer version was synced in the meantime and its download is queued, see _process_page()
+        return
     doc.download_status = Document.PROCESSING
     doc.save()
 
     try:
-        service = connect_to_gdrive(access_token, refresh_token)
-
-        request = None
-        if doc.mime_type.startswith('application/vnd.google-apps.'):
-            export_mime = 'text/csv' if 'spreadsheet' in doc.mime_type else 'text/plain'
-            request = service.files().export_media(fileId=doc.document_id, mimeType=export_mime)
-        else:
-            request = service.files().get_media(fileId=doc.document_id)
-        response = request.execute()
+        service = connect_to_gdrive(*get_google_tokens(doc.requester))
+        limiter = RateLimiter.for_user(doc.requester, 'google-oauth2')
+        content = fetch_fn(service, doc, limiter)
         logger.info("Done downloading {} [{}]".format(doc.title, doc.document_id))
 
-        content = cut_utf_string(response.decode('UTF-8', errors='replace'), 9000, step=10)
-        doc.content = content
         doc.last_synced = get_utc_timestamp()
-        algolia_engine.sync(doc, add=False)
+        if content is not None:
+            doc.content = cut_utf_string(content, GDRIVE_CONTENT_BYTES)
+            algolia_engine.sync(doc, fields=GDRIVE_CONTENT_FIELDS)
     finally:
         doc.download_status = Document.READY
         doc.save()
 
 
+class _PrefixBuffer(object):
+    """ Write-only file object that keeps only the first 'max_bytes' bytes written to it. """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.data = bytearray()
+
+    def write(self, chunk):
+        self.data.extend(chunk[:self.max_bytes - len(self.data)])
+
+
+def download_text(request, max_bytes):
+    """
+    Download and decode only the first 'max_bytes' of a media request, with a single ranged request. Exports of
+    Google documents ignore the range and are returned whole, but only their prefix is kept and decoded.
+    """
+    buf = _PrefixBuffer(max_bytes)
+    try:
+        MediaIoBaseDownload(buf, request, chunksize=max_bytes).next_chunk()
+    except HttpError as e:
+        if e.resp.status != 416:
+            raise
+        # empty file, range is not satisfiable
+        return ''
+    # the prefix may end in the middle of a multi-byte character, the decoder drops it instead of replacing it
+    decoder = codecs.getincrementaldecoder('UTF-8')(errors='replace')
+    return decoder.decode(bytes(buf.data), final=False)
+
+
+def download_and_extract(service, doc, mime_type, version, limiter):
+    """
+    Text of a PDF or Office file, taken from the cache or extracted from the downloaded file (see
+    dataimporter/extract.py). Returns None if the file is too big or can't be parsed.
+    """
+    content = get_cached_text(doc.document_id, version)
+    if content is not None:
+        return content
+    request = service.files().get_media(fileId=doc.document_id)
+    with tempfile.NamedTemporaryFile() as f:
+        downloader = MediaIoBaseDownload(f, request, chunksize=GDRIVE_DOWNLOAD_CHUNK)
+        done = False
+        while not done:
+            limiter.acquire()
+            status, done = downloader.next_chunk()
+            if status.total_size and status.total_size > EXTRACT_MAX_FILE_BYTES:
+                logger.info("File %s [%s] is too big for text extraction", doc.title, doc.document_id)
+                return None
+        f.flush()
+        return extract_text(doc.document_id, version, mime_type, f.name, GDRIVE_CONTENT_BYTES)
+
+
 def get_google_tokens(user):
     social = user.social_auth.get(provider='google-oauth2')
     access_token = social.extra_data['access_token']
@@ -399,7 +654,8 @@ def connect_to_gdrive(access_token, refresh_token):
         "https://www.googleapis.com/oauth2/v4/token",
         "cuely/1.0"
     )
-    http = httplib2.Http()
+    # responses are cached per (refresh token) credential, for conditional requests
+    http = CachingHttp('gdrive', refresh_token)
     http = credentials.authorize(http)
     service = discovery.build('drive', 'v3', http=http)
     return service
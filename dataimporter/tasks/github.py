@@ -1,19 +1,26 @@
 """
 Github API integration. Indexing repos, repo dirs/files (not file contents), commits, issues.
 """
-import time
-import json
 import hashlib
+from itertools import islice
+from collections import defaultdict, OrderedDict
+from http.client import HTTPConnection
 from github import Github
 from github.GithubException import UnknownObjectException
-from datetime import datetime, timezone, timedelta
+from github.Requester import Requester
+from datetime import datetime, timezone
 from celery import shared_task, subtask
 import markdown
 from mdx_gfm import GithubFlavoredMarkdownExtension
 
-from dataimporter.task_util import should_sync, should_queue, cut_utf_string, get_utc_timestamp
-from dataimporter.models import Document, get_or_create
+from dataimporter.task_util import (
+    should_sync, loads_requester, holds_lease, should_queue, cut_utf_string, fit_record, get_utc_timestamp, chunked,
+    stash_lookups, get_lookups, get_sync_state, set_sync_state, resumable, RateLimited
+)
+from dataimporter.models import Document, bulk_get_or_create, bulk_save
 from dataimporter.algolia.engine import algolia_engine
+from dataimporter.rate_limit import GithubRateLimiter, MAX_BLOCKING_WAIT
+from dataimporter.http_cache import https_connection_class
 from social.apps.django_app.default.models import UserSocialAuth
 import logging
 logger = logging.getLogger(__name__)
@@ -25,12 +32,26 @@ GITHUB_SECONDARY_KEYWORDS = {
     'issue': 'issue,ticket,task',
     'file': 'file,dir'
 }
+# all github clients make conditional requests, not modified responses don't count against the rate limit
+Requester.injectConnectionClasses(HTTPConnection, https_connection_class('github'))
+# repos without changes are still checked for updated issues this often (seconds), because comments
+# don't change repo's timestamps
+ISSUES_MAX_AGE = 3600
+# issue syncs overlap with the previous ones by this many seconds
+ISSUES_OVERLAP = 300
+# comments listed in issue's content
+ISSUE_MAX_COMMENTS = 20
+# commits listed by the first sync of a repo
+MAX_LISTED_COMMITS = 200
+# commits that a single walk of the history looks at, files that are not resolved by then are looked up one by one
+FILE_HISTORY_MAX_COMMITS = 2000
+FILE_MAX_COMMITTERS = 10
 
 
 def start_synchronization(user):
     """ Run initial syncing of repo and issues data in pipedrive. """
-    if should_sync(user, 'github', 'tasks.github'):
-        collect_repos.delay(requester=user)
+    if should_sync(user, 'github'):
+        collect_repos.delay(requester=user.id)
     else:
         logger.info("Github oauth token for user '%s' already in use, skipping sync ...", user.username)
 
@@ -47,105 +68,158 @@ def update_synchronization():
 
 
 @shared_task
+@loads_requester
+@holds_lease('github')
 def collect_repos(requester):
+    """
+    Sync user's repos and fan out syncing of their commits and issues. The state of each repo (timestamps,
+    contributors) and the issues watermark (stored by collect_issues()) are persisted, so repos that haven't
+    changed since the last sync are skipped and only the subtasks whose inputs changed are queued.
+    """
     github_client = init_github_client(requester)
     # simple check if we are approaching api rate limits
     if github_client.rate_limiting[0] < 500:
         logger.debug("Skipping github repos sync for user '%s' due to rate limits", requester.username)
         return
+    limiter = GithubRateLimiter(github_client, requester)
+    repo_states = get_sync_state(requester, 'github', 'repos')
 
     i = 0
-    for repo in github_client.get_user().get_repos():
-        if not (repo.id or repo.full_name):
-            logger.debug("Skipping github repo '%s' for user '%s'", repo.full_name, requester.username)
-            # seems like broken data, skip it
-            continue
-        if repo.fork:
-            # don't process forked repos
-            logger.debug("Skipping forked github repo '%s' for user '%s'", repo.full_name, requester.username)
-            continue
-
-        db_repo, created = Document.objects.get_or_create(
-            github_repo_id=repo.id,
-            github_commit_id__isnull=True,
-            github_file_id__isnull=True,
-            github_issue_id__isnull=True,
-            requester=requester,
-            user_id=requester.id
-        )
-        db_repo.primary_keywords = GITHUB_PRIMARY_KEYWORDS
-        db_repo.secondary_keywords = GITHUB_SECONDARY_KEYWORDS['repo']
-        db_repo.github_title = 'Repo: {}'.format(repo.name)
-        db_repo.github_repo_owner = repo.owner.login
-        db_repo.github_repo_description = repo.description
-        logger.debug("Processing github repo '%s' for user '%s'", repo.full_name, requester.username)
-        commit_count = 0
-        contributors = []
-        try:
-            # fetch contributors
-            for cnt in repo.get_contributors():
-                commit_count = commit_count + cnt.contributions
-                if len(contributors) <= 10:
-                    contributors.append({
-                        'name': cnt.name,
-                        'url': cnt.html_url,
-                        'avatar': cnt.avatar_url
-                    })
-        except UnknownObjectException:
-            # most probably, this repo is disabled
-            if created:
-                logger.debug("Removing github repo '%s' for user '%s'", repo.full_name, requester.username)
-                db_repo.delete()
-            continue
-        db_repo.github_repo_commit_count = commit_count
-        db_repo.github_repo_contributors = contributors
-        db_repo.github_repo_full_name = repo.full_name
-        new_timestamp = max(repo.updated_at, repo.pushed_at)
-        if created or new_timestamp.timestamp() > (db_repo.last_updated_ts or 0):
-            i = i + 1
-            db_repo.last_updated_ts = new_timestamp.timestamp()
-            db_repo.last_updated = new_timestamp.isoformat() + 'Z'
-            db_repo.webview_link = repo.html_url
-            # fetch readme file
-            try:
-                readme = repo.get_readme()
-                readme_content = cut_utf_string(
-                    readme.decoded_content.decode('UTF-8', errors='replace'),
-                    9000,
-                    step=100
+    with algolia_engine.batch():
+        for repo in github_client.get_user().get_repos():
+            if not (repo.id or repo.full_name):
+                logger.debug("Skipping github repo '%s' for user '%s'", repo.full_name, requester.username)
+                # seems like broken data, skip it
+                continue
+            if repo.fork:
+                # don't process forked repos
+                logger.debug("Skipping forked github repo '%s' for user '%s'", repo.full_name, requester.username)
+                continue
+
+            db_repo, created = Document.objects.get_or_create(
+                github_repo_id=repo.id,
+                github_commit_id__isnull=True,
+                github_file_id__isnull=True,
+                github_issue_id__isnull=True,
+                requester=requester,
+                user_id=requester.id
+            )
+            state = {} if created else repo_states.get(str(repo.id), {})
+            pushed = state.get('pushed_at') != repo.pushed_at.timestamp()
+            updated = state.get('updated_at') != repo.updated_at.timestamp() or \
+                state.get('open_issues') != repo.open_issues_count
+            issues_since = None if created else \
+                get_sync_state(requester, 'github', _issues_state_key(repo.id)).get('since')
+            issues_stale = not issues_since or get_utc_timestamp().timestamp() - issues_since > ISSUES_MAX_AGE
+            if not (pushed or updated or issues_stale):
+                logger.debug("Github repo '%s' for user '%s' hasn't changed", repo.full_name, requester.username)
+                continue
+
+            logger.debug("Processing github repo '%s' for user '%s'", repo.full_name, requester.username)
+            if pushed:
+                try:
+                    # contributors only change with pushes
+                    limiter.acquire()
+                    _update_contributors(repo, state)
+                except UnknownObjectException:
+                    # most probably, this repo is disabled
+                    if created:
+                        logger.debug("Removing github repo '%s' for user '%s'", repo.full_name, requester.username)
+                        db_repo.delete()
+                    continue
+            if pushed or updated:
+                i = i + 1
+                _sync_repo(github_client, repo, db_repo, created, state, limiter)
+                if created:
+                    # sync files
+                    subtask(collect_files).delay(
+                        requester.id, repo.id, repo.full_name, repo.html_url, repo.default_branch,
+                        enrichment_delay=i * 300)
+            if pushed:
+                # sync commits
+                subtask(collect_commits).apply_async(
+                    args=[requester.id, repo.id, repo.full_name, repo.html_url, repo.default_branch],
+                    countdown=240 * i if created else 1
                 )
-                md = github_client.render_markdown(text=readme_content).decode('UTF-8', errors='replace')
-                # also replace <em> tags, because they are used by Algolia highlighting
-                db_repo.github_repo_content = md.replace('<em>', '<b>').replace('</em>', '</b>')
-                db_repo.github_repo_readme = readme.name
-            except UnknownObjectException:
-                # readme does not exist
-                db_repo.github_repo_content = None
-            algolia_engine.sync(db_repo, add=created)
-            if created:
-                # sync files
-                subtask(collect_files).delay(
-                    requester, repo.id, repo.full_name, repo.html_url, repo.default_branch, enrichment_delay=i * 300)
-        # sync commits
-        subtask(collect_commits).apply_async(
-            args=[requester, repo.id, repo.full_name, repo.html_url, repo.default_branch, commit_count],
-            countdown=240 * i if created else 1
-        )
-        # sync issues
-        subtask(collect_issues).apply_async(
-            args=[requester, repo.id, repo.full_name, created],
-            countdown=180 * i if created else 1
-        )
+            # sync issues, the new sync overlaps with the previous one a bit, so that issues updated while
+            # it was listing them aren't missed
+            subtask(collect_issues).apply_async(
+                args=[requester.id, repo.id, repo.full_name, issues_since - ISSUES_OVERLAP if issues_since else None],
+                countdown=180 * i if created else 1
+            )
+
+            state.update({
+                'pushed_at': repo.pushed_at.timestamp(),
+                'updated_at': repo.updated_at.timestamp(),
+                'open_issues': repo.open_issues_count
+            })
+            repo_states[str(repo.id)] = state
+            set_sync_state(requester, 'github', 'repos', repo_states)
+
 
-        db_repo.last_synced = get_utc_timestamp()
-        db_repo.download_status = Document.READY
-        db_repo.save()
+def _issues_state_key(repo_id):
+    return 'issues:{}'.format(repo_id)
+
+
+def _update_contributors(repo, state):
+    """
+    Update commit count and (up to 10) contributors in repo's 'state'. Not modified pages of contributors are
+    answered from the http cache (see https_connection_class()), they don't count against the rate limit.
+    """
+    commit_count = 0
+    contributors = []
+    for cnt in repo.get_contributors():
+        commit_count = commit_count + cnt.contributions
+        if len(contributors) <= 10:
+            contributors.append({
+                'name': cnt.name,
+                'url': cnt.html_url,
+                'avatar': cnt.avatar_url
+            })
+    state.update({
+        'contributors': contributors,
+        'commit_count': commit_count
+    })
+
+
+def _sync_repo(github_client, repo, db_repo, created, state, limiter):
+    db_repo.primary_keywords = GITHUB_PRIMARY_KEYWORDS
+    db_repo.secondary_keywords = GITHUB_SECONDARY_KEYWORDS['repo']
+    db_repo.github_title = 'Repo: {}'.format(repo.name)
+    db_repo.github_repo_owner = repo.owner.login
+    db_repo.github_repo_description = repo.description
+    db_repo.github_repo_commit_count = state.get('commit_count', 0)
+    db_repo.github_repo_contributors = state.get('contributors', [])
+    db_repo.github_repo_full_name = repo.full_name
+    new_timestamp = max(repo.updated_at, repo.pushed_at)
+    db_repo.last_updated_ts = new_timestamp.timestamp()
+    db_repo.last_updated = new_timestamp.isoformat() + 'Z'
+    db_repo.webview_link = repo.html_url
+    # fetch readme file
+    try:
+        limiter.acquire()
+        readme = repo.get_readme()
+        readme_content = cut_utf_string(readme.decoded_content.decode('UTF-8', errors='replace'), 9000)
+        md = github_client.render_markdown(text=readme_content).decode('UTF-8', errors='replace')
+        # also replace <em> tags, because they are used by Algolia highlighting
+        db_repo.github_repo_content = md.replace('<em>', '<b>').replace('</em>', '</b>')
+        db_repo.github_repo_readme = readme.name
+    except UnknownObjectException:
+        # readme does not exist
+        db_repo.github_repo_content = None
+    algolia_engine.sync(db_repo, add=created)
+    db_repo.last_synced = get_utc_timestamp()
+    db_repo.download_status = Document.READY
+    db_repo.save()
 
 
 @shared_task
-def collect_issues(requester, repo_id, repo_name, created):
+@loads_requester
+@holds_lease('github')
+def collect_issues(requester, repo_id, repo_name, since=None):
     """
-    Fetch the issues for a 'repo_name'.
+    Fetch the issues for a 'repo_name', updated after 'since' (timestamp) if given. The start of the sync is
+    stored as the next watermark once all issues are synced.
     Note that Github API considers Pull Requests as issues. Therefore, when iterating through
     repo's issues, we get pull requests as well. At the moment, we also treat PRs as issues.
     TODO: handle pull requests properly (changed files, commits in this PR, possibly diffs ...)
@@ -156,88 +230,140 @@ def collect_issues(requester, repo_id, repo_name, created):
         logger.debug("Skipping github issues sync for user '%s' due to rate limits", requester.username)
         return
 
+    started = get_utc_timestamp().timestamp()
     repo = github_client.get_repo(full_name_or_id=repo_name)
     search_args = {'state': 'all', 'sort': 'updated'}
-    if not created:
+    if since:
         # if we are processing already synced repo, then just look for newly updated issues
-        search_args['since'] = datetime.now(timezone.utc) - timedelta(hours=6)
+        search_args['since'] = datetime.fromtimestamp(since, timezone.utc)
+
+    limiter = GithubRateLimiter(github_client, requester)
+    # comments of all issues, listed once the first changed issue with comments is found
+    repo_comments = None
+    with algolia_engine.batch(max_items=100):
+        for issues in chunked(repo.get_issues(**search_args), 100):
+            db_issues = bulk_get_or_create(
+                Document, 'github_issue_id', [issue.id for issue in issues],
+                github_repo_id=repo_id,
+                requester=requester,
+                user_id=requester.id
+            )
+            changed = []
+            for issue in issues:
+                db_issue, created = db_issues[str(issue.id)]
+                if not created and db_issue.last_updated_ts and \
+                        db_issue.last_updated_ts >= issue.updated_at.timestamp():
+                    continue
+                logger.debug("Processing github issue #%s for user '%s' and repo '%s'",
+                             issue.number, requester.username, repo_name)
+                db_issue.primary_keywords = GITHUB_PRIMARY_KEYWORDS
+                db_issue.secondary_keywords = GITHUB_SECONDARY_KEYWORDS['issue']
+                db_issue.last_updated_ts = issue.updated_at.timestamp()
+                db_issue.last_updated = issue.updated_at.isoformat() + 'Z'
+                db_issue.webview_link = issue.html_url
+                db_issue.github_title = '#{}: {}'.format(issue.number, issue.title)
+                if '/pull/' in issue.html_url:
+                    # pull request
+                    db_issue.github_title = 'PR {}'.format(db_issue.github_title)
+                issue_comments = []
+                if issue.comments > 0:
+                    if repo_comments is None:
+                        repo_comments = _repo_comments(repo, search_args.get('since'), limiter)
+                    # comments that haven't been updated since the last sync are kept from it
+                    issue_comments = _merge_comments(
+                        db_issue.github_issue_comments, [_comment(x) for x in repo_comments.get(issue.number, [])])
+                    if len(issue_comments) != min(issue.comments, ISSUE_MAX_COMMENTS):
+                        # not synced before (or some comments were deleted)
+                        limiter.acquire()
+                        issue_comments = [_comment(x) for x in islice(issue.get_comments(), ISSUE_MAX_COMMENTS)]
+                db_issue.github_issue_comments = issue_comments
+                # fit_record() cuts the bodies of the indexed comments, the stored ones are kept whole
+                comments = [dict(x) for x in issue_comments]
+
+                content = {
+                    'body': _to_html(issue.body),
+                    'comments': comments
+                }
+                # take care of Algolia 10k limit, the last comments are dropped if there's not enough room
+                dropped = fit_record(
+                    content, [(content, 'body')] + [(c, 'body') for c in comments], 9000, min_len=100)
+                content['comments'] = [c for c in comments if c not in dropped]
+
+                db_issue.github_issue_content = content
+                db_issue.github_repo_full_name = repo_name
+                db_issue.github_issue_state = issue.state
+                db_issue.github_issue_labels = [x.name for x in issue.labels]
+                db_issue.github_issue_reporter = {
+                    'name': issue.user.login,
+                    'avatar': issue.user.avatar_url,
+                    'url': issue.user.html_url
+                }
+                db_issue.github_issue_assignees = []
+                for assignee in issue.assignees:
+                    db_issue.github_issue_assignees.append({
+                        'name': assignee.login,
+                        'avatar': assignee.avatar_url,
+                        'url': assignee.html_url
+                    })
 
-    i = 0
-    for issue in repo.get_issues(**search_args):
-        db_issue, created = Document.objects.get_or_create(
-            github_issue_id=issue.id,
-            github_repo_id=repo_id,
-            requester=requester,
-            user_id=requester.id
-        )
-        if not created and db_issue.last_updated_ts and db_issue.last_updated_ts >= issue.updated_at.timestamp():
-            continue
-        logger.debug("Processing github issue #%s for user '%s' and repo '%s'",
-                     issue.number, requester.username, repo_name)
-        db_issue.primary_keywords = GITHUB_PRIMARY_KEYWORDS
-        db_issue.secondary_keywords = GITHUB_SECONDARY_KEYWORDS['issue']
-        db_issue.last_updated_ts = issue.updated_at.timestamp()
-        db_issue.last_updated = issue.updated_at.isoformat() + 'Z'
-        db_issue.webview_link = issue.html_url
-        db_issue.github_title = '#{}: {}'.format(issue.number, issue.title)
-        if '/pull/' in issue.html_url:
-            # pull request
-            db_issue.github_title = 'PR {}'.format(db_issue.github_title)
-        comments = []
-        if issue.comments > 0:
-            for comment in issue.get_comments():
-                comments.append({
-                    'body': _to_html(comment.body),
-                    'timestamp': comment.updated_at.timestamp(),
-                    'author': {
-                        'name': comment.user.login,
-                        'avatar': comment.user.avatar_url,
-                        'url': comment.user.html_url
-                    }
-                })
-                # only list up to 20 comments
-                if len(comments) >= 20:
-                    break
-
-        content = {
-            'body': _to_html(issue.body),
-            'comments': comments
-        }
-        # take care of Algolia 10k limit
-        while len(json.dumps(content).encode('UTF-8')) > 9000:
-            if len(content['comments']) < 1:
-                content['body'] = cut_utf_string(content['body'], 9000, step=100)
-                break
-            content['comments'] = content['comments'][:-1]
-
-        db_issue.github_issue_content = content
-        db_issue.github_repo_full_name = repo_name
-        db_issue.github_issue_state = issue.state
-        db_issue.github_issue_labels = [x.name for x in issue.labels]
-        db_issue.github_issue_reporter = {
-            'name': issue.user.login,
-            'avatar': issue.user.avatar_url,
-            'url': issue.user.html_url
-        }
-        db_issue.github_issue_assignees = []
-        for assignee in issue.assignees:
-            db_issue.github_issue_assignees.append({
-                'name': assignee.login,
-                'avatar': assignee.avatar_url,
-                'url': assignee.html_url
-            })
+                db_issue.last_synced = get_utc_timestamp()
+                db_issue.download_status = Document.READY
+                changed.append((db_issue, created))
+            bulk_save(Document, [x[0] for x in changed], 'github_issue_id',
+                      github_repo_id=repo_id, requester=requester, user_id=requester.id)
+            for db_issue, created in changed:
+                algolia_engine.sync(db_issue, add=created)
+    set_sync_state(requester, 'github', _issues_state_key(repo_id), {'since': started})
 
-        algolia_engine.sync(db_issue, add=created)
-        db_issue.last_synced = get_utc_timestamp()
-        db_issue.download_status = Document.READY
-        db_issue.save()
-        # add sleep every 50 issues to avoid breaking API rate limits
-        i = i + 1
-        if i % 50 == 0:
-            time.sleep(20)
+
+def _repo_comments(repo, since, limiter):
+    """
+    Comments of all repo's issues (updated after 'since'), from one paged listing instead of a listing per issue.
+    Returns issue number -> up to ISSUE_MAX_COMMENTS comments, oldest first.
+    """
+    args = {'sort': 'created', 'direction': 'asc'}
+    if since:
+        args['since'] = since
+    comments = defaultdict(list)
+    limiter.acquire()
+    for page in chunked(repo.get_issues_comments(**args), 100):
+        for comment in page:
+            number = int(comment.issue_url.rsplit('/', 1)[-1])
+            if len(comments[number]) < ISSUE_MAX_COMMENTS:
+                comments[number].append(comment)
+        limiter.acquire()
+    return comments
+
+
+def _merge_comments(synced, listed):
+    """
+    Comments of an issue from the last sync, updated with the 'listed' ones (updated since then). Both are
+    ordered oldest first, up to ISSUE_MAX_COMMENTS are returned.
+    """
+    merged = OrderedDict((x.get('id'), x) for x in synced)
+    for comment in listed:
+        merged[comment['id']] = comment
+    return list(merged.values())[:ISSUE_MAX_COMMENTS]
+
+
+def _comment(comment):
+    body = _to_html(comment.body)
+    return {
+        'id': comment.id,
+        # the index record can't hold more anyway
+        'body': cut_utf_string(body, 9000) if body else body,
+        'timestamp': comment.updated_at.timestamp(),
+        'author': {
+            'name': comment.user.login,
+            'avatar': comment.user.avatar_url,
+            'url': comment.user.html_url
+        }
+    }
 
 
 @shared_task
+@loads_requester
+@holds_lease('github')
 def collect_files(requester, repo_id, repo_name, repo_url, default_branch, enrichment_delay):
     """
     List all files in a repo - should be called once, after first sync of a repo. Subsequent syncing is handled
@@ -252,91 +378,161 @@ def collect_files(requester, repo_id, repo_name, repo_url, default_branch, enric
     github_client = init_github_client(requester)
     repo = github_client.get_repo(full_name_or_id=repo_name)
     new_files = []
-    for f in repo.get_git_tree(sha=repo.default_branch, recursive=True).tree:
-        db_file, created = Document.objects.get_or_create(
-            github_file_id=_compute_sha('{}{}'.format(repo_id, f.path)),
-            github_repo_id=repo_id,
-            requester=requester,
-            user_id=requester.id
-        )
-        if created:
-            new_files.append({
-                'sha': f.sha,
-                'filename': f.path,
-                'action': 'modified',
-                'type': f.type
-            })
-            db_file.primary_keywords = GITHUB_PRIMARY_KEYWORDS
-            db_file.secondary_keywords = GITHUB_SECONDARY_KEYWORDS['file']
-            # set the timestamp to 0 (epoch) to signal that we don't know the update timestamp
-            db_file.last_updated_ts = 0
-            db_file.last_updated = datetime.utcfromtimestamp(0).isoformat() + 'Z'
-            db_file.github_title = '{}: {}'.format('Dir' if f.type == 'tree' else 'File', f.path.split('/')[-1])
-            db_file.github_file_path = f.path
-            db_file.github_repo_full_name = repo_name
-            db_file.webview_link = '{}/blob/{}/{}'.format(repo_url, default_branch, f.path)
-            algolia_engine.sync(db_file, add=created)
-        db_file.last_synced = get_utc_timestamp()
-        db_file.download_status = Document.PENDING
-        db_file.save()
-    # run enrich_files() for all new_files in chunks of 50 items
-    i = 0
-    for ff in [new_files[x:x + 50] for x in range(0, len(new_files), 50)]:
-        i = i + 1
+    with algolia_engine.batch():
+        for tree in chunked(repo.get_git_tree(sha=repo.default_branch, recursive=True).tree, 500):
+            db_files = bulk_get_or_create(
+                Document, 'github_file_id', [_file_id(repo_id, f.path) for f in tree],
+                github_repo_id=repo_id,
+                requester=requester,
+                user_id=requester.id
+            )
+            created_files = []
+            for f in tree:
+                db_file, created = db_files[_file_id(repo_id, f.path)]
+                if created:
+                    new_files.append({
+                        'sha': f.sha,
+                        'filename': f.path,
+                        'action': 'modified',
+                        'type': f.type
+                    })
+                    db_file.primary_keywords = GITHUB_PRIMARY_KEYWORDS
+                    db_file.secondary_keywords = GITHUB_SECONDARY_KEYWORDS['file']
+                    # set the timestamp to 0 (epoch) to signal that we don't know the update timestamp
+                    db_file.last_updated_ts = 0
+                    db_file.last_updated = datetime.utcfromtimestamp(0).isoformat() + 'Z'
+                    db_file.github_title = '{}: {}'.format(
+                        'Dir' if f.type == 'tree' else 'File', f.path.split('/')[-1])
+                    db_file.github_file_path = f.path
+                    db_file.github_repo_full_name = repo_name
+                    db_file.webview_link = '{}/blob/{}/{}'.format(repo_url, default_branch, f.path)
+                    created_files.append(db_file)
+                db_file.last_synced = get_utc_timestamp()
+                db_file.download_status = Document.PENDING
+            bulk_save(Document, [x[0] for x in db_files.values()], 'github_file_id',
+                      github_repo_id=repo_id, requester=requester, user_id=requester.id)
+            for db_file in created_files:
+                algolia_engine.sync(db_file, add=True)
+    if new_files:
+        # the list of files can be big, so it's passed to enrich_files() through redis
         subtask(enrich_files).apply_async(
-            args=[requester, ff, repo.id, repo_name, repo_url, default_branch],
-            countdown=enrichment_delay + (240 * i)
+            args=[requester.id, stash_lookups(files=new_files), repo.id, repo_name, repo_url, default_branch],
+            countdown=enrichment_delay
         )
 
 
 @shared_task
-def enrich_files(requester, files, repo_id, repo_name, repo_url, default_branch):
+@loads_requester
+@holds_lease('github')
+@resumable('github', key=lambda requester, files_key, *args, **kwargs: files_key)
+def enrich_files(requester, files_key, repo_id, repo_name, repo_url, default_branch, incremental=False,
+                 cursor=None):
     """
-    Fetch committers, update timestamp, etc. for files.
+    Fetch committers, update timestamp, etc. for files stashed under 'files_key' (see stash_lookups()).
+    Files of an 'incremental' sync (changed by new commits) get their own commits listed, see
+    resolve_file_history(). If that's rate limited, the task is re-queued and continues with the history
+    collected so far.
     """
-    github_client = init_github_client(requester, per_page=50)
+    github_client = init_github_client(requester)
     # simple check if we are approaching api rate limits
     if github_client.rate_limiting[0] < 500:
-        # reschedule after 10 minutes
-        logger.debug("Skipping github enrich files for user '%s' due to rate limits", requester.username)
-        subtask(enrich_files).apply_async(
-            args=[requester, files, repo_id, repo_name, repo_url, default_branch],
-            countdown=600
-        )
+        # resume after 10 minutes, with the cursor and the credential still leased (see resumable())
+        logger.debug("Postponing github enrich files for user '%s' due to rate limits", requester.username)
+        raise RateLimited('github', 600)
+    lookups = get_lookups(files_key)
+    if lookups is None:
+        logger.warning("Files to enrich for repo '%s' and user '%s' have expired", repo_name, requester.username)
         return
 
     repo = github_client.get_repo(full_name_or_id=repo_name)
-    for f in files:
-        db_file, created = Document.objects.get_or_create(
-            github_file_id=_compute_sha('{}{}'.format(repo_id, f.get('filename'))),
+    limiter = GithubRateLimiter(github_client, requester, max_wait=MAX_BLOCKING_WAIT)
+    files = [f for f in lookups['files'] if f.get('action') != 'removed']
+    removed = [_file_id(repo_id, f.get('filename')) for f in lookups['files'] if f.get('action') == 'removed']
+    collected = get_lookups(cursor['history_key']) if cursor.get('history_key') else None
+    if collected is None:
+        # not resumed (or the collected history has expired), start from the newest commit
+        for k in ('after', 'walked_commits', 'walked', 'history_key'):
+            cursor.pop(k, None)
+    history = FileHistory((f.get('filename') for f in files), collected and collected['history'])
+    try:
+        resolve_file_history(repo, default_branch, history, limiter, cursor, incremental)
+    except RateLimited:
+        # the history can be big, so the cursor has just its key
+        cursor['history_key'] = stash_lookups(history=history)
+        raise
+
+    with algolia_engine.batch():
+        algolia_engine.bulk_delete(Document.objects.filter(
+            github_file_id__in=removed,
             github_repo_id=repo_id,
-            requester=requester,
-            user_id=requester.id
-        )
-        if f.get('action') == 'removed':
-            db_file.delete()
-            continue
-
-        logger.debug("Enriching github file '%s' for repo '%s' and user '%s'",
-                     f.get('filename'), repo_name, requester.username)
-        db_file.primary_keywords = GITHUB_PRIMARY_KEYWORDS
-        db_file.secondary_keywords = GITHUB_SECONDARY_KEYWORDS['file']
-        db_file.github_title = '{}: {}'.format(
-            'Dir' if f.get('type') == 'tree' else 'File',
-            f.get('filename').split('/')[-1]
-        )
-        db_file.github_file_path = f.get('filename')
-        db_file.github_repo_full_name = repo_name
-        db_file.webview_link = '{}/blob/{}/{}'.format(repo_url, default_branch, f.get('filename'))
-        committers = []
-        seen = set()
-        ts_set = False
-        for cmt in repo.get_commits(sha=default_branch, path=f.get('filename')):
-            if not ts_set:
-                db_file.last_updated_ts = cmt.commit.committer.date.timestamp()
-                db_file.last_updated = cmt.commit.committer.date.isoformat() + 'Z'
-                ts_set = True
-            if cmt.commit.committer.name not in seen:
+            requester=requester
+        ))
+        for chunk in chunked(files, 500):
+            db_files = bulk_get_or_create(
+                Document, 'github_file_id', [_file_id(repo_id, f.get('filename')) for f in chunk],
+                github_repo_id=repo_id,
+                requester=requester,
+                user_id=requester.id
+            )
+            changed = []
+            for f in chunk:
+                db_file, created = db_files[_file_id(repo_id, f.get('filename'))]
+                logger.debug("Enriching github file '%s' for repo '%s' and user '%s'",
+                             f.get('filename'), repo_name, requester.username)
+                db_file.primary_keywords = GITHUB_PRIMARY_KEYWORDS
+                db_file.secondary_keywords = GITHUB_SECONDARY_KEYWORDS['file']
+                db_file.github_title = '{}: {}'.format(
+                    'Dir' if f.get('type') == 'tree' else 'File',
+                    f.get('filename').split('/')[-1]
+                )
+                db_file.github_file_path = f.get('filename')
+                db_file.github_repo_full_name = repo_name
+                db_file.webview_link = '{}/blob/{}/{}'.format(repo_url, default_branch, f.get('filename'))
+                file_history = history.get(f.get('filename'))
+                if file_history:
+                    db_file.last_updated_ts = file_history['ts']
+                    db_file.last_updated = file_history['date']
+                    db_file.github_file_committers = file_history['committers']
+                else:
+                    db_file.github_file_committers = []
+                db_file.last_synced = get_utc_timestamp()
+                db_file.download_status = Document.READY
+                changed.append((db_file, created))
+            bulk_save(Document, [x[0] for x in changed], 'github_file_id',
+                      github_repo_id=repo_id, requester=requester, user_id=requester.id)
+            for db_file, created in changed:
+                algolia_engine.sync(db_file, add=created)
+
+
+class FileHistory(dict):
+    """
+    Last commit date and committers of repo paths (files and dirs): path -> {'ts', 'date', 'committers'}.
+    Commits are added newest first, a path is resolved by the first commit that changes it (or a file below it).
+    'collected' is the history collected so far (e.g. by a rate limited task).
+    """
+    def __init__(self, paths, collected=None):
+        super(FileHistory, self).__init__(collected or {})
+        self.paths = set(paths)
+        self.unresolved = self.paths - set(self)
+
+    def add_commit(self, cmt, filenames):
+        # a dir is changed by changes of the files below it
+        changed = set(x for filename in filenames for x in _path_prefixes(filename) if x in self.paths)
+        for path in changed:
+            self.add_path_commits(path, [cmt])
+
+    def add_path_commits(self, path, commits):
+        for cmt in commits:
+            if path not in self:
+                self[path] = {
+                    'ts': cmt.commit.committer.date.timestamp(),
+                    'date': cmt.commit.committer.date.isoformat() + 'Z',
+                    'committers': []
+                }
+                self.unresolved.discard(path)
+            committers = self[path]['committers']
+            if len(committers) < FILE_MAX_COMMITTERS and \
+                    cmt.commit.committer.name not in [c['name'] for c in committers]:
                 c = {
                     'name': cmt.commit.committer.name
                 }
@@ -344,95 +540,181 @@ def enrich_files(requester, files, repo_id, repo_name, repo_url, default_branch)
                     c['url'] = cmt.committer.html_url
                     c['avatar'] = cmt.committer.avatar_url
                 committers.append(c)
-                seen.add(cmt.commit.committer.name)
-            if len(committers) >= 10:
-                break
-        db_file.github_file_committers = committers
-        algolia_engine.sync(db_file, add=created)
 
-        db_file.last_synced = get_utc_timestamp()
-        db_file.download_status = Document.READY
-        db_file.save()
-        # add sleep to avoid breaking API rate limits
-        time.sleep(2)
+
+def resolve_file_history(repo, branch, history, limiter, cursor, incremental=False):
+    """
+    Find the last commit and committers of all paths in 'history' (FileHistory). Instead of listing the commits
+    of each path, the commit history of the 'branch' is walked once, newest first, until the last commit of every
+    path is known. The walk would find only the committers of the newest commits of an 'incremental' sync's paths
+    though (their index records are replaced), so the commits of these paths are listed.
+    """
+    if not incremental and not cursor.get('walked'):
+        walk_file_history(repo, branch, history, limiter, cursor)
+        cursor['walked'] = True
+    for path in list(history.unresolved):
+        # the walk has stopped before reaching the last commit of these
+        history.add_path_commits(path, _path_commits(repo, branch, path, limiter))
+
+
+def walk_file_history(repo, branch, history, limiter, cursor, max_commits=FILE_HISTORY_MAX_COMMITS):
+    """
+    Add commits of the 'branch' to 'history' (FileHistory), newest first, until all of its paths are resolved.
+    Merge commits are skipped, the changes they bring in are found in the merged commits themselves.
+    The last walked commit is kept in the 'cursor', a resumed walk continues with the history of that commit.
+    """
+    i = cursor.get('walked_commits', 0)
+    after = cursor.get('after')
+    limiter.acquire()
+    for cmt in repo.get_commits(sha=after or branch):
+        if cmt.sha == after:
+            continue
+        if not history.unresolved or i >= max_commits:
+            break
+        if len(cmt.parents) <= 1:
+            # changed files are only listed in the full commit (up to 300 of them)
+            limiter.acquire()
+            history.add_commit(cmt, [f.filename for f in cmt.files])
+        i = i + 1
+        cursor.update({'after': cmt.sha, 'walked_commits': i})
+    logger.debug("Walked %s commits of github repo '%s', %s paths unresolved",
+                 i, repo.full_name, len(history.unresolved))
+
+
+def _path_commits(repo, branch, path, limiter):
+    """ Commits that changed the 'path', newest first, enough to find its committers. """
+    limiter.acquire()
+    commits = []
+    seen = set()
+    for cmt in repo.get_commits(sha=branch, path=path):
+        commits.append(cmt)
+        seen.add(cmt.commit.committer.name)
+        if len(seen) >= FILE_MAX_COMMITTERS:
+            break
+    return commits
+
+
+def _path_prefixes(filename):
+    """ The path of a file and paths of all its parent dirs, e.g. 'a/b/c.py' -> 'a/b/c.py', 'a/b', 'a'. """
+    parts = filename.split('/')
+    return ['/'.join(parts[:i]) for i in range(len(parts), 0, -1)]
 
 
 @shared_task
-def collect_commits(requester, repo_id, repo_name, repo_url, default_branch, commit_count):
+@loads_requester
+@holds_lease('github')
+def collect_commits(requester, repo_id, repo_name, repo_url, default_branch):
     """
-    Sync repository commits - up to the last commit that we've already synced or
-    max 200 recent commits (whichever comes first).
-    This is possible to do, because Github api returns commits
-    sorted by commit timestamp and that old commits don't change
-    (at least should not in a normally run repository).
+    Sync repository commits. The last synced head of the default branch is persisted, so the next sync
+    compares it with the branch and gets just the new commits and the files they changed in one call (a repo
+    without new commits costs a single request). The changed files are enriched right away.
+    The first sync, or a sync after the branch was rewritten (e.g. force pushed), lists the recent commits
+    instead, up to MAX_LISTED_COMMITS. Old commits don't change, so already synced commits are skipped.
     """
-    max_commits = 200
-    was_synced = Document.objects.filter(
-        user_id=requester.id,
-        github_repo_id=repo_id,
-        github_commit_id__isnull=False).count() >= min(commit_count, max_commits)
-    github_client = init_github_client(requester, per_page=20 if was_synced else 100)
+    github_client = init_github_client(requester)
     # simple check if we are approaching api rate limits
     if github_client.rate_limiting[0] < 500:
         logger.debug("Skipping github commits sync for user '%s' due to rate limits", requester.username)
         return
 
-    i = 0
-    for cmt in github_client.get_repo(full_name_or_id=repo_name).get_commits():
-        if i >= max_commits:
-            break
-        i = i + 1
-        db_commit, created = get_or_create(
-            model=Document,
-            github_commit_id=cmt.sha,
-            github_repo_id=repo_id,
-            requester=requester,
-            user_id=requester.id
-        )
-        if not created and was_synced:
-            logger.debug("Found already synced commit, skipping further commits syncing for user '%s' and repo '%s'",
-                         requester.username, repo_name)
-            break
-        logger.debug("Processing github commit for user '%s' and repo '%s' with message: %s",
-                     requester.username, repo_name, cmt.commit.message[:30])
-        db_commit.primary_keywords = GITHUB_PRIMARY_KEYWORDS
-        db_commit.secondary_keywords = GITHUB_SECONDARY_KEYWORDS['commit']
-        db_commit.last_updated_ts = cmt.commit.committer.date.timestamp()
-        db_commit.last_updated = cmt.commit.committer.date.isoformat() + 'Z'
-        db_commit.webview_link = cmt.html_url
-        db_commit.github_title = 'Commit: {}'.format(cmt.commit.message[:50])
-        db_commit.github_commit_content = cmt.commit.message
-        db_commit.github_repo_full_name = repo_name
-        db_commit.github_commit_committer = {
-            'name': cmt.commit.author.name,
-        }
-        if cmt.author:
-            db_commit.github_commit_committer['url'] = cmt.author.html_url
-            db_commit.github_commit_committer['avatar'] = cmt.author.avatar_url
-        # get the changed/added/deleted files in this commit (up to 100 files)
-        files = []
-        for f in cmt.files:
-            files.append({
-                'sha': f.sha,
-                'filename': f.filename,
-                'url': f.blob_url,
-                'additions': f.additions,
-                'deletions': f.deletions,
-                'action': f.status
-            })
-            if len(files) >= 100:
-                break
-        if was_synced and len(files) > 0:
-            subtask(enrich_files).delay(requester, files, repo_id, repo_name, repo_url, default_branch)
-
-        db_commit.github_commit_files = files
-        algolia_engine.sync(db_commit, add=created)
+    limiter = GithubRateLimiter(github_client, requester)
+    repo = github_client.get_repo(full_name_or_id=repo_name)
+    state_key = 'commits:{}'.format(repo_id)
+    heads = get_sync_state(requester, 'github', state_key)
+    commits = None
+    changed_files = None
+    if heads.get(default_branch):
+        limiter.acquire()
+        try:
+            comparison = repo.compare(heads.get(default_branch), default_branch)
+        except UnknownObjectException:
+            # the last synced head is gone
+            comparison = None
+        if comparison and comparison.status == 'identical':
+            logger.debug("No new commits for user '%s' and repo '%s'", requester.username, repo_name)
+            return
+        if comparison and comparison.status == 'ahead':
+            # compared commits are listed oldest first
+            commits = list(reversed(comparison.commits))
+            changed_files = _commit_files(comparison.files)
+    if commits is None:
+        limiter.acquire()
+        commits = list(islice(repo.get_commits(sha=default_branch), MAX_LISTED_COMMITS))
+    if not commits:
+        return
 
-        db_commit.last_synced = get_utc_timestamp()
-        db_commit.download_status = Document.READY
-        db_commit.save()
-        # add sleep of half a second to avoid breaking API rate limits
-        time.sleep(0.5)
+    with algolia_engine.batch(max_items=100):
+        for chunk in chunked(commits, 100):
+            db_commits = bulk_get_or_create(
+                Document, 'github_commit_id', [cmt.sha for cmt in chunk],
+                github_repo_id=repo_id,
+                requester=requester,
+                user_id=requester.id
+            )
+            created_commits = []
+            for cmt in chunk:
+                db_commit, created = db_commits[cmt.sha]
+                if not created:
+                    continue
+                logger.debug("Processing github commit for user '%s' and repo '%s' with message: %s",
+                             requester.username, repo_name, cmt.commit.message[:30])
+                db_commit.primary_keywords = GITHUB_PRIMARY_KEYWORDS
+                db_commit.secondary_keywords = GITHUB_SECONDARY_KEYWORDS['commit']
+                db_commit.last_updated_ts = cmt.commit.committer.date.timestamp()
+                db_commit.last_updated = cmt.commit.committer.date.isoformat() + 'Z'
+                db_commit.webview_link = cmt.html_url
+                db_commit.github_title = 'Commit: {}'.format(cmt.commit.message[:50])
+                db_commit.github_commit_content = cmt.commit.message
+                db_commit.github_repo_full_name = repo_name
+                db_commit.github_commit_committer = {
+                    'name': cmt.commit.author.name,
+                }
+                if cmt.author:
+                    db_commit.github_commit_committer['url'] = cmt.author.html_url
+                    db_commit.github_commit_committer['avatar'] = cmt.author.avatar_url
+                if changed_files is not None and len(commits) == 1:
+                    # the comparison has the files of the only new commit
+                    files = changed_files
+                else:
+                    # the changed/added/deleted files are listed in the full commit
+                    limiter.acquire()
+                    files = _commit_files(cmt.files)
+                # up to 100 files
+                db_commit.github_commit_files = files[:100]
+                db_commit.last_synced = get_utc_timestamp()
+                db_commit.download_status = Document.READY
+                created_commits.append(db_commit)
+            bulk_save(Document, created_commits, 'github_commit_id',
+                      github_repo_id=repo_id, requester=requester, user_id=requester.id)
+            for db_commit in created_commits:
+                algolia_engine.sync(db_commit, add=True)
+
+    if changed_files:
+        # renamed files are gone from their previous path
+        removed = [{'filename': f['previous_filename'], 'action': 'removed'}
+                   for f in changed_files if f.get('previous_filename')]
+        subtask(enrich_files).delay(
+            requester.id, stash_lookups(files=changed_files + removed), repo_id, repo_name, repo_url, default_branch,
+            incremental=True)
+    heads[default_branch] = commits[0].sha
+    set_sync_state(requester, 'github', state_key, heads)
+
+
+def _commit_files(files):
+    result = []
+    for f in files:
+        cf = {
+            'sha': f.sha,
+            'filename': f.filename,
+            'url': f.blob_url,
+            'additions': f.additions,
+            'deletions': f.deletions,
+            'action': f.status
+        }
+        if f.status == 'renamed':
+            cf['previous_filename'] = f.previous_filename
+        result.append(cf)
+    return result
 
 
 def init_github_client(user, per_page=100):
@@ -451,6 +733,10 @@ def _to_html(markdown_text):
     return md.replace('<em>', '<b>').replace('</em>', '</b>')
 
 
+def _file_id(repo_id, path):
+    return _compute_sha('{}{}'.format(repo_id, path))
+
+
 def _compute_sha(value):
     sha = hashlib.sha1()
     sha.update(bytes(value, 'utf-8'))
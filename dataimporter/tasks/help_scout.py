@@ -2,20 +2,25 @@
 Helpscout API integration.
 The 'while True' loops are there because of how helpscout api library works when dealing with paged results.
 """
-import json
-import time
 from datetime import datetime, timedelta
 from dateutil.parser import parse as parse_dt
 from celery import shared_task, subtask
 
+import requests
 import helpscout
-from dataimporter.task_util import should_sync, should_queue, cut_utf_string, get_utc_timestamp
+from dataimporter.task_util import (
+    should_sync, loads_requester, holds_lease, resumable, should_queue, cut_utf_string, fit_record, get_utc_timestamp,
+    stash_lookups, get_lookups
+)
 from dataimporter.models import Document
 from dataimporter.algolia.engine import algolia_engine
+from dataimporter.algolia.index import HELPSCOUT_CUSTOMER_FIELDS, HELPSCOUT_CONVERSATION_FIELDS
+from dataimporter.rate_limit import RateLimiter, MAX_BLOCKING_WAIT
 from social.apps.django_app.default.models import UserSocialAuth
 import logging
 logger = logging.getLogger(__name__)
 
+HELPSCOUT_API_URL = 'https://api.helpscout.net/v1/'
 HELPSCOUT_KEYWORDS = {
     'primary': 'helpscout',
     'secondary': 'customer,ticket,support'
@@ -24,8 +29,8 @@ HELPSCOUT_KEYWORDS = {
 
 def start_synchronization(user, update=False):
     """ Run initial syncing of deals data in pipedrive. """
-    if should_sync(user, 'helpscout-apikeys', 'tasks.help_scout'):
-        collect_customers.delay(requester=user, update=update)
+    if should_sync(user, 'helpscout-apikeys'):
+        collect_customers.delay(requester=user.id, update=update)
     else:
         logger.info("Helpscout api key for user '%s' already in use, skipping sync ...", user.username)
 
@@ -42,24 +47,110 @@ def update_synchronization():
 
 
 @shared_task
-def collect_customers(requester, update):
+@loads_requester
+@holds_lease('helpscout-apikeys')
+@resumable('helpscout-apikeys')
+def collect_customers(requester, update, cursor=None):
     helpscout_client = init_helpscout_client(requester)
     if not helpscout_client:
         logger.warn("User is missing Helpscout API key", requester.username)
         return
-    # cache all mailboxes and their folders
+    limiter = RateLimiter.for_user(requester, 'helpscout-apikeys', max_wait=MAX_BLOCKING_WAIT)
+    mailboxes, folders, users = _collect_lookups(helpscout_client, limiter)
+    lookups_key = stash_lookups(mailboxes=mailboxes, folders=folders, users=users)
+
+    if update and 'customer_ids' not in cursor:
+        customer_ids = set()
+        # check for new stuff since last 6 hours only
+        since = get_utc_timestamp() - timedelta(hours=6)
+        # this abomination is needed, because Helpscout API chokes on iso dates with milliseconds and/or timezones
+        since_iso = since.isoformat().split('.')[0] + 'Z'
+        for box in mailboxes:
+            helpscout_client.clearstate()
+            while True:
+                limiter.acquire()
+                cons = helpscout_client.conversations_for_mailbox(mailbox_id=box, modifiedSince=since_iso)
+                if not cons or cons.count < 1:
+                    break
+                for con in cons:
+                    customer_ids.add(con.customer.get('id'))
+        cursor.update({'since': since_iso, 'customer_ids': list(customer_ids)})
+        cursor.checkpoint()
+
+    customer_ids = cursor.get('customer_ids', [])
+    if customer_ids:
+        with algolia_engine.batch() as batch:
+            pending = []
+            try:
+                while customer_ids:
+                    # process customer
+                    limiter.acquire()
+                    customer = helpscout_client.customer(customer_id=customer_ids[-1])
+                    pending.append(_process_customer(requester, customer))
+                    customer_ids.pop()
+            finally:
+                # queue already processed customers even if the task is re-queued
+                _queue_customers(requester, pending, batch, lookups_key)
+                cursor.checkpoint()
+
+    since_iso = cursor.get('since') if update else None
+    # continue after the pages that were already processed before the task was re-queued or restarted
+    page = cursor.get('page', 0)
+    with algolia_engine.batch() as batch:
+        while True:
+            limiter.acquire()
+            customers, pages = _customers_page(helpscout_client, page + 1, since_iso)
+            if not customers:
+                break
+            pending = []
+            for customer in customers:
+                pending.append(_process_customer(requester, customer))
+            _queue_customers(requester, pending, batch, lookups_key)
+            page = page + 1
+            cursor['page'] = page
+            cursor.checkpoint()
+            if page >= pages:
+                break
+
+
+class _HelpscoutItem(object):
+    """ Item of a Helpscout listing, with lowercase attributes (e.g. 'fullname'), the same as in the api client. """
+    def __init__(self, data):
+        for k, v in data.items():
+            setattr(self, k.lower(), v)
+
+
+def _customers_page(helpscout_client, page, modified_since=None):
+    """
+    One page of customers (modified since 'modified_since') and the number of pages. The api client can only
+    list the pages one after another, so it's called directly and a resumed sync starts at its page.
+    """
+    params = {'page': page}
+    if modified_since:
+        params['modifiedSince'] = modified_since
+    response = requests.get(
+        HELPSCOUT_API_URL + 'customers.json', params=params, auth=(helpscout_client.api_key, 'X'))
+    response.raise_for_status()
+    data = response.json()
+    return [_HelpscoutItem(x) for x in data.get('items') or []], data.get('pages', 0)
+
+
+def _collect_lookups(helpscout_client, limiter):
+    """ Load all mailboxes, their folders and users. """
+    limiter.acquire()
     mailboxes = {m.id: m.name for m in helpscout_client.mailboxes()}
     folders = {}
     for box in mailboxes:
         helpscout_client.clearstate()
         while True:
+            limiter.acquire()
             box_folders = helpscout_client.folders(box)
             if not box_folders or box_folders.count < 1:
                 break
             folders[box] = {f.id: f.name for f in box_folders}
-    # cache users
     users = {}
     while True:
+        limiter.acquire()
         helpscout_users = helpscout_client.users()
         if not helpscout_users or helpscout_users.count < 1:
             break
@@ -70,45 +161,23 @@ def collect_customers(requester, update):
                 'email': u.email,
                 'avatar': u.photourl
             }
+    return mailboxes, folders, users
 
-    since_iso = None
-    if update:
-        customer_ids = set()
-        # check for new stuff since last 6 hours only
-        since = get_utc_timestamp() - timedelta(hours=6)
-        # this abomination is needed, because Helpscout API chokes on iso dates with milliseconds and/or timezones
-        since_iso = since.isoformat().split('.')[0] + 'Z'
-        for box in mailboxes:
-            helpscout_client.clearstate()
-            while True:
-                cons = helpscout_client.conversations_for_mailbox(mailbox_id=box, modifiedSince=since_iso)
-                if not cons or cons.count < 1:
-                    break
-                for con in cons:
-                    customer_ids.add(con.customer.get('id'))
-        for cid in customer_ids:
-            # process customer
-            customer = helpscout_client.customer(customer_id=cid)
-            _process_customer(requester, customer, mailboxes, folders, users)
-            # add sleep to avoid breaking API rate limits
-            time.sleep(2)
 
-    while True:
-        customers = helpscout_client.customers(modifiedSince=since_iso) if update else helpscout_client.customers()
-        if not customers or customers.count < 1:
-            break
-        for customer in customers:
-            _process_customer(requester, customer, mailboxes, folders, users)
-            # add sleep to avoid breaking API rate limits
-            time.sleep(2)
+def _queue_customers(requester, db_customers, batch, lookups_key):
+    # flush the index before queueing conversations processing, so that buffered objects (without content)
+    # don't overwrite the ones synced by process_customer()
+    batch.flush()
+    for db_customer in filter(None, db_customers):
+        subtask(process_customer).delay(requester.id, db_customer.id, lookups_key)
 
 
-def _process_customer(requester, customer, mailboxes, folders, users):
+def _process_customer(requester, customer):
     if customer.id is None or (customer.emails is None and customer.fullname is None):
         # can't use customer with no data
         logger.debug("Customer '%s' for user '%s' cannot be used - no data",
                      (customer.id or customer.fullname), requester.username)
-        return
+        return None
     db_customer, created = Document.objects.get_or_create(
         helpscout_customer_id=customer.id,
         requester=requester,
@@ -131,13 +200,24 @@ def _process_customer(requester, customer, mailboxes, folders, users):
     db_customer.helpscout_emails = ', '.join(
         e.get('value') for e in customer.emails if 'value' in e) if customer.emails else None
     db_customer.save()
-    algolia_engine.sync(db_customer, add=created)
-    subtask(process_customer).delay(requester, db_customer, mailboxes, folders, users)
+    # conversation attributes of existing customers stay in the index until process_customer() updates them
+    algolia_engine.sync(db_customer, add=created, fields=None if created else HELPSCOUT_CUSTOMER_FIELDS)
+    return db_customer
 
 
 @shared_task
-def process_customer(requester, db_customer, mailboxes, folders, users):
+@loads_requester
+@holds_lease('helpscout-apikeys')
+def process_customer(requester, db_customer_id, lookups_key):
+    db_customer = Document.objects.filter(id=db_customer_id).first()
+    lookups = get_lookups(lookups_key)
+    if not (db_customer and lookups):
+        logger.info("Helpscout customer %s for user '%s' was removed or its lookups expired, skipping ...",
+                    db_customer_id, requester.username)
+        return
+    mailboxes, folders, users = lookups['mailboxes'], lookups['folders'], lookups['users']
     helpscout_client = init_helpscout_client(requester)
+    limiter = RateLimiter.for_user(requester, 'helpscout-apikeys')
     db_customer.download_status = Document.PROCESSING
     db_customer.save()
 
@@ -145,8 +225,11 @@ def process_customer(requester, db_customer, mailboxes, folders, users):
     conversation_emails = set()
     conversations = []
     for box_id, box_name in mailboxes.items():
-        logger.debug("Fetching Helpscout conversations for '%s' in mailbox '%s'", db_customer.helpscout_name, box_name)
+        # keys of stashed lookups are strings
+        box_id = int(box_id)
+        logger.debug("Fetching Helpscout conversations for '%s' in mailbox '%s'", db_customer.helpscout_title, box_name)
         while True:
+            limiter.acquire()
             box_conversations = helpscout_client.conversations_for_customer_by_mailbox(
                 box_id, db_customer.helpscout_customer_id)
             if not box_conversations or box_conversations.count < 1:
@@ -157,7 +240,7 @@ def process_customer(requester, db_customer, mailboxes, folders, users):
                     'number': '#{}'.format(bc.number),
                     'mailbox': box_name,
                     'mailbox_id': box_id,
-                    'folder': folders.get(bc.folderid),
+                    'folder': folders.get(str(box_id), {}).get(str(bc.folderid)),
                     'status': bc.status,
                     'owner': format_person(bc.owner),
                     'customer': format_person(bc.customer),
@@ -177,14 +260,12 @@ def process_customer(requester, db_customer, mailboxes, folders, users):
                 if last_updated and \
                         conversation.get('last_updated_ts', 0) > last_conversation.get('last_updated_ts', 0):
                     last_conversation = conversation
-        # add sleep of three seconds to avoid breaking API rate limits
-        time.sleep(3)
         helpscout_client.clearstate()
 
     if db_customer.last_updated_ts >= last_conversation.get('last_updated_ts', 0):
         logger.info(
             "Helpscout customer '%s' for user '%s' seems unchanged, skipping further processing",
-            db_customer.helpscout_name, requester.username
+            db_customer.helpscout_title, requester.username
         )
         db_customer.download_status = Document.READY
         db_customer.save()
@@ -201,12 +282,12 @@ def process_customer(requester, db_customer, mailboxes, folders, users):
         db_customer.helpscout_emails = ', '.join(filter(None, conversation_emails))
 
     # build helpscout content
-    content = process_conversations(users, conversations, helpscout_client)
+    content = process_conversations(users, conversations, helpscout_client, limiter)
     db_customer.helpscout_content = content
     db_customer.download_status = Document.READY
     db_customer.last_synced = get_utc_timestamp()
     db_customer.save()
-    algolia_engine.sync(db_customer, add=False)
+    algolia_engine.sync(db_customer, fields=HELPSCOUT_CONVERSATION_FIELDS)
 
 
 def format_person(person):
@@ -219,7 +300,7 @@ def format_person(person):
     }
 
 
-def process_conversations(users, conversations, helpscout_client):
+def process_conversations(users, conversations, helpscout_client, limiter):
     content = {
         'users': [],
         'conversations': []
@@ -228,6 +309,7 @@ def process_conversations(users, conversations, helpscout_client):
     # conversations
     for c in conversations:
         # load conversation threads
+        limiter.acquire()
         threads = helpscout_client.conversation(c.get('id')).threads
         if threads:
             c['threads'] = []
@@ -239,45 +321,26 @@ def process_conversations(users, conversations, helpscout_client):
                         'created': parse_dt(t.get('createdAt')).timestamp(),
                         'author': p.get('name'),
                         'author_id': p.get('id'),
-                        'body': cut_utf_string(t.get('body'), 2000, 300),
+                        'body': cut_utf_string(t.get('body'), 2000),
                         'is_customer': is_customer
                     })
-                uid = t['createdBy'].get('id')
-                if uid and uid in users and not is_customer:
+                # keys of stashed lookups are strings
+                uid = str(t['createdBy'].get('id'))
+                if uid in users and not is_customer:
                     active_users[uid] = users[uid]
 
             content['conversations'].append(c)
         helpscout_client.clearstate()
-        time.sleep(2)
-
-    # work around algolia 10k bytes limit
-    step = 1
-    while len(json.dumps(content).encode('UTF-8')) > 9000:
-        if step > 10:
-            logger.info("Oops, step is over 10. Must be a really long Helpscout conversation")
-            for c in reversed(content['conversations']):
-                if len(c['threads']) > 0:
-                    c['threads'] = []
-                    break
-            step = step + 1
-            if step > 50:
-                # give up, just remove the threads
-                for c in content['conversations']:
-                    c['threads'] = []
-                break
-
-        for c in content['conversations']:
-            max_len = 0
-            max_t = None
-            for t in c['threads']:
-                if len(t['body']) > max_len:
-                    max_len = len(t['body'])
-                    max_t = t
-            if max_t:
-                max_t['body'] = cut_utf_string(max_t['body'], int(len(max_t['body']) / 2), 50)
-        step = step + 1
 
     content['users'] = [v for k, v in active_users.items()]
+    # work around algolia 10k bytes limit: thread bodies share what's left of the record,
+    # threads of the last conversations are dropped if there's not enough room for all of them
+    threads = [(t, 'body') for c in content['conversations'] for t in c['threads']]
+    dropped = fit_record(content, threads, 9000, min_len=100)
+    if dropped:
+        logger.info("Dropped %s threads of a really long Helpscout conversation", len(dropped))
+        for c in content['conversations']:
+            c['threads'] = [t for t in c['threads'] if t.get('body') is not None]
     return content
 
 
@@ -2,15 +2,19 @@
 Helpscout Docs API integration.
 The 'while True' loops are there because of how helpscout api library works when dealing with paged results.
 """
-import time
 from datetime import datetime
 from dateutil.parser import parse as parse_dt
 from celery import shared_task, subtask
 
 import helpscout
-from dataimporter.task_util import should_sync, should_queue, cut_utf_string, get_utc_timestamp
+from dataimporter.task_util import (
+    should_sync, loads_requester, holds_lease, should_queue, cut_utf_string, get_utc_timestamp, stash_lookups,
+    get_lookups
+)
 from dataimporter.models import Document
 from dataimporter.algolia.engine import algolia_engine
+from dataimporter.algolia.index import HELPSCOUT_DOCUMENT_FIELDS, HELPSCOUT_DOCUMENT_CONTENT_FIELDS
+from dataimporter.rate_limit import RateLimiter
 from social.apps.django_app.default.models import UserSocialAuth
 import logging
 logger = logging.getLogger(__name__)
@@ -23,8 +27,8 @@ HELPSCOUT_DOCS_KEYWORDS = {
 
 def start_synchronization(user):
     """ Run initial syncing of deals data in pipedrive. """
-    if should_sync(user, 'helpscout-docs-apikeys', 'tasks.help_scout_docs'):
-        collect_articles.delay(requester=user)
+    if should_sync(user, 'helpscout-docs-apikeys'):
+        collect_articles.delay(requester=user.id)
     else:
         logger.info("Helpscout DOCS api key for user '%s' already in use, skipping sync ...", user.username)
 
@@ -41,16 +45,21 @@ def update_synchronization():
 
 
 @shared_task
+@loads_requester
+@holds_lease('helpscout-docs-apikeys')
 def collect_articles(requester):
     helpscout_client = init_helpscout_client(requester)
     docs_client = init_helpscout_docs_client(requester)
     if not docs_client:
         logger.warn("User %s is missing Helpscout Docs API key", requester.username)
         return
+    limiter = RateLimiter.for_user(requester, 'helpscout-docs-apikeys')
     # cache users
     users = {}
     if helpscout_client:
+        users_limiter = RateLimiter.for_user(requester, 'helpscout-apikeys')
         while True:
+            users_limiter.acquire()
             helpscout_users = helpscout_client.users()
             if not helpscout_users or helpscout_users.count < 1:
                 break
@@ -63,75 +72,96 @@ def collect_articles(requester):
     # cache categories
     cats = dict()
     while True:
+        limiter.acquire()
         collections = docs_client.collections()
         if not collections or collections.count < 1:
             break
         for collection in collections:
             while True:
+                limiter.acquire()
                 categories = docs_client.categories(collection.id)
                 if not categories or categories.count < 1:
                     break
                 for category in categories:
                     cats[category.id] = (category.name, collection.name)
 
-    for cat_id, names in cats.items():
-        while True:
-            articles = docs_client.articles(cat_id, status='published')
-            if not articles or articles.count < 1:
-                break
-            for article in articles:
-                db_doc, created = Document.objects.get_or_create(
-                    helpscout_document_id=article.id,
-                    requester=requester,
-                    user_id=requester.id
-                )
-                logger.debug("Processing Helpscout article '%s' for user '%s'", article.name, requester.username)
-                db_doc.helpscout_document_title = 'Doc: {}'.format(article.name)
-                new_updated = article.updatedat or article.createdat
-                new_updated_ts = parse_dt(new_updated).timestamp() if new_updated else get_utc_timestamp()
-                if not created and db_doc.last_updated_ts:
-                    new_updated_ts = db_doc.last_updated_ts \
-                        if db_doc.last_updated_ts > new_updated_ts else new_updated_ts
-                    if db_doc.last_updated_ts >= new_updated_ts:
-                        logger.info("Helpscout article '%s' for user '%s' is unchanged",
-                                    article.name, requester.username)
-                        continue
-
-                db_doc.last_updated = datetime.utcfromtimestamp(new_updated_ts).isoformat() + 'Z'
-                db_doc.last_updated_ts = new_updated_ts
-                db_doc.webview_link = 'https://secure.helpscout.net/docs/{}/article/{}/'.format(
-                    article.collectionid, article.id)
-                db_doc.helpscout_document_public_link = article.publicurl
-                db_doc.primary_keywords = HELPSCOUT_DOCS_KEYWORDS['primary']
-                db_doc.secondary_keywords = HELPSCOUT_DOCS_KEYWORDS['secondary']
-                db_doc.helpscout_document_collection = names[1]
-                db_doc.helpscout_document_categories = [names[0]] if not names[0] == 'Uncategorized' else []
-                db_doc.helpscout_document_status = article.status
-                db_doc.helpscout_document_keywords = article.keywords or []
-                db_doc.helpscout_document_users = \
-                    [users.get(x) for x in set([article.createdby, article.updatedby])] if users else []
-                db_doc.save()
-                algolia_engine.sync(db_doc, add=created)
-
-                subtask(process_article).delay(requester, db_doc, cats)
-                time.sleep(1)
+    lookups_key = stash_lookups(cats=cats)
+    with algolia_engine.batch() as batch:
+        for cat_id, names in cats.items():
+            while True:
+                limiter.acquire()
+                articles = docs_client.articles(cat_id, status='published')
+                if not articles or articles.count < 1:
+                    break
+                pending = []
+                for article in articles:
+                    db_doc, created = Document.objects.get_or_create(
+                        helpscout_document_id=article.id,
+                        requester=requester,
+                        user_id=requester.id
+                    )
+                    logger.debug("Processing Helpscout article '%s' for user '%s'", article.name, requester.username)
+                    db_doc.helpscout_document_title = 'Doc: {}'.format(article.name)
+                    new_updated = article.updatedat or article.createdat
+                    new_updated_ts = parse_dt(new_updated).timestamp() if new_updated else get_utc_timestamp()
+                    if not created and db_doc.last_updated_ts:
+                        new_updated_ts = db_doc.last_updated_ts \
+                            if db_doc.last_updated_ts > new_updated_ts else new_updated_ts
+                        if db_doc.last_updated_ts >= new_updated_ts:
+                            logger.info("Helpscout article '%s' for user '%s' is unchanged",
+                                        article.name, requester.username)
+                            continue
+
+                    db_doc.last_updated = datetime.utcfromtimestamp(new_updated_ts).isoformat() + 'Z'
+                    db_doc.last_updated_ts = new_updated_ts
+                    db_doc.webview_link = 'https://secure.helpscout.net/docs/{}/article/{}/'.format(
+                        article.collectionid, article.id)
+                    db_doc.helpscout_document_public_link = article.publicurl
+                    db_doc.primary_keywords = HELPSCOUT_DOCS_KEYWORDS['primary']
+                    db_doc.secondary_keywords = HELPSCOUT_DOCS_KEYWORDS['secondary']
+                    db_doc.helpscout_document_collection = names[1]
+                    db_doc.helpscout_document_categories = [names[0]] if not names[0] == 'Uncategorized' else []
+                    db_doc.helpscout_document_status = article.status
+                    db_doc.helpscout_document_keywords = article.keywords or []
+                    db_doc.helpscout_document_users = \
+                        [users.get(x) for x in set([article.createdby, article.updatedby])] if users else []
+                    db_doc.save()
+                    # categories and content of existing articles stay in the index until process_article()
+                    algolia_engine.sync(db_doc, add=created, fields=None if created else HELPSCOUT_DOCUMENT_FIELDS)
+                    pending.append(db_doc)
+
+                # flush the index before queueing article processing, so that buffered objects (without content)
+                # don't overwrite the ones synced by process_article()
+                batch.flush()
+                for db_doc in pending:
+                    subtask(process_article).delay(requester.id, db_doc.id, lookups_key)
 
 
 @shared_task
-def process_article(requester, db_doc, cats):
+@loads_requester
+@holds_lease('helpscout-docs-apikeys')
+def process_article(requester, db_doc_id, lookups_key):
+    db_doc = Document.objects.filter(id=db_doc_id).first()
+    lookups = get_lookups(lookups_key)
+    if not (db_doc and lookups):
+        logger.info("Helpscout article %s for user '%s' was removed or its lookups expired, skipping ...",
+                    db_doc_id, requester.username)
+        return
+    cats = lookups['cats']
     docs_client = init_helpscout_docs_client(requester)
     db_doc.download_status = Document.PROCESSING
     db_doc.save()
 
+    RateLimiter.for_user(requester, 'helpscout-docs-apikeys').acquire()
     article_details = docs_client.article(db_doc.helpscout_document_id)
     db_doc.helpscout_document_categories = \
         [c for c in [cats.get(x, [None])[0] for x in article_details.categories] if c and c != 'Uncategorized']
-    db_doc.helpscout_document_content = cut_utf_string(article_details.text, 9000, 300)
+    db_doc.helpscout_document_content = cut_utf_string(article_details.text, 9000)
 
     db_doc.download_status = Document.READY
     db_doc.last_synced = get_utc_timestamp()
     db_doc.save()
-    algolia_engine.sync(db_doc, add=False)
+    algolia_engine.sync(db_doc, fields=HELPSCOUT_DOCUMENT_CONTENT_FIELDS)
 
 
 def init_helpscout_client(user):
@@ -2,14 +2,19 @@
 Jira API integration.
 """
 from jira.client import JIRA
-import time
+from datetime import timedelta
 from dateutil.parser import parse as parse_dt
 from celery import shared_task
 
 from django.conf import settings
-from dataimporter.task_util import should_sync, should_queue, cut_utf_string, get_utc_timestamp
-from dataimporter.models import Document
+from dataimporter.task_util import (
+    should_sync, loads_requester, holds_lease, resumable, should_queue, cut_utf_string, get_utc_timestamp,
+    get_sync_state, set_sync_state
+)
+from dataimporter.models import Document, bulk_get_or_create, bulk_save
 from dataimporter.algolia.engine import algolia_engine
+from dataimporter.rate_limit import RateLimiter, MAX_BLOCKING_WAIT
+from dataimporter.http_cache import CachingAdapter
 from social.apps.django_app.default.models import UserSocialAuth
 import logging
 logger = logging.getLogger(__name__)
@@ -18,12 +23,18 @@ JIRA_KEYWORDS = {
     'primary': 'jira',
     'secondary': 'issue,task,bug,feature'
 }
+# max page size that Jira allows for issue searches
+JIRA_PAGE_SIZE = 100
+# fetch only the issue fields that we index
+JIRA_FIELDS = 'summary,description,status,issuetype,priority,duedate,labels,assignee,reporter,creator,created,updated'
+# incremental syncs overlap with previous syncs by this much (see _to_jql_date())
+JIRA_WATERMARK_OVERLAP = timedelta(minutes=10)
 
 
 def start_synchronization(user, update=False):
     """ Run initial syncing of issues data in Jira. """
-    if should_sync(user, 'jira-oauth', 'tasks.jira'):
-        collect_issues.delay(requester=user, sync_update=update)
+    if should_sync(user, 'jira-oauth'):
+        collect_issues.delay(requester=user.id, sync_update=update)
     else:
         logger.info("Jira oauth token for user '%s' already in use, skipping sync ...", user.username)
 
@@ -40,76 +51,110 @@ def update_synchronization():
 
 
 @shared_task
-def collect_issues(requester, sync_update=False):
+@loads_requester
+@holds_lease('jira-oauth')
+@resumable('jira-oauth')
+def collect_issues(requester, sync_update=False, cursor=None):
+    """
+    Sync issues of all projects, in the order of their last update. The newest update seen in each project
+    is persisted as project's high-water mark, so the periodic updates only fetch issues updated since then.
+    """
     jira = init_jira_client(requester)
-
-    for project in jira.projects():
-        project_name = project.raw.get('name')
-        project_key = project.raw.get('key')
-        project_url = '{}/projects/{}'.format(project._options.get('server'), project_key)
-        logger.debug("Processing Jira project %s for user %s", project_key, requester.username)
-
-        jql = 'project={}'.format(project_key)
-        if sync_update:
-            # only fetch those issues that were updated in the last day
-            jql = "{} and updated > '-1d'".format(jql)
-        jql = '{} order by key'.format(jql)
-        i = 0
-        old_i = -1
-        while True:
-            # manually page through results (using 'maxResults=None' should page automatically, but it doesn't work)
-            if i == old_i:
-                break
-            old_i = i
-            for issue in jira.search_issues(jql, startAt=i, maxResults=25, validate_query=False):
-                i = i + 1
-                db_issue, created = Document.objects.get_or_create(
-                    jira_issue_key=issue.key,
+    limiter = RateLimiter.for_user(requester, 'jira-oauth', max_wait=MAX_BLOCKING_WAIT)
+    limiter.acquire()
+    done_projects = cursor.setdefault('done_projects', [])
+    watermarks = get_sync_state(requester, 'jira-oauth', 'watermarks')
+
+    with algolia_engine.batch():
+        for project in jira.projects():
+            project_name = project.raw.get('name')
+            project_key = project.raw.get('key')
+            if project_key in done_projects:
+                continue
+            project_url = '{}/projects/{}'.format(project._options.get('server'), project_key)
+            logger.debug("Processing Jira project %s for user %s", project_key, requester.username)
+
+            if cursor.get('project') == project_key:
+                # continue where we left off, if the task was re-queued or restarted in the middle of this project
+                since = cursor.get('since')
+            else:
+                since = watermarks.get(project_key) if sync_update else None
+            jql = 'project={}'.format(project_key)
+            if since:
+                jql = '{} and updated >= "{}"'.format(jql, _to_jql_date(since))
+            jql = '{} order by updated asc'.format(jql)
+            i = 0
+            while True:
+                # manually page through results (using 'maxResults=None' should page automatically, but it doesn't work)
+                limiter.acquire()
+                issues = jira.search_issues(
+                    jql, startAt=i, maxResults=JIRA_PAGE_SIZE, fields=JIRA_FIELDS, validate_query=False)
+                db_issues = bulk_get_or_create(
+                    Document, 'jira_issue_key', [issue.key for issue in issues],
                     requester=requester,
                     user_id=requester.id
                 )
-                logger.debug("Processing Jira issue %s for user %s", issue.key, requester.username)
-                updated = issue.fields.updated or issue.fields.created or get_utc_timestamp()
-                updated_ts = parse_dt(updated).timestamp()
-                if not created and db_issue.last_updated_ts:
-                    # compare timestamps and skip the deal if it hasn't been updated
-                    if db_issue.last_updated_ts >= updated_ts:
-                        logger.debug("Issue '%s' for user '%s' hasn't changed", issue.key, requester.username)
-                        continue
-                i = i + 1
-                db_issue.primary_keywords = JIRA_KEYWORDS['primary']
-                db_issue.secondary_keywords = JIRA_KEYWORDS['secondary']
-                db_issue.last_updated = updated
-                db_issue.last_updated_ts = updated_ts
-                db_issue.webview_link = '{}/browse/{}'.format(project._options.get('server'), issue.key)
-                db_issue.jira_issue_title = '{}: {}'.format(issue.key, issue.fields.summary)
-                db_issue.jira_issue_status = issue.fields.status.name
-                db_issue.jira_issue_type = issue.fields.issuetype.name
-                db_issue.jira_issue_priority = issue.fields.priority.name
-                if issue.fields.description:
-                    db_issue.jira_issue_description = cut_utf_string(issue.fields.description, 9000, 100)
-                db_issue.jira_issue_duedate = issue.fields.duedate
-                db_issue.jira_issue_labels = issue.fields.labels
-                db_issue.jira_issue_assignee = {
-                    'name': issue.fields.assignee.displayName,
-                    'avatar': issue.fields.assignee.raw.get('avatarUrls', {})
-                } if issue.fields.assignee else {}
-                reporter = issue.fields.reporter or issue.fields.creator
-                db_issue.jira_issue_reporter = {
-                    'name': reporter.displayName,
-                    'avatar': reporter.raw.get('avatarUrls', {})
-                }
-                db_issue.jira_project_name = project_name
-                db_issue.jira_project_key = project_key
-                db_issue.jira_project_link = project_url
-                db_issue.last_synced = get_utc_timestamp()
-                db_issue.download_status = Document.READY
-                db_issue.save()
-                algolia_engine.sync(db_issue, add=created)
-            time.sleep(2)
-
-        # add sleep of five seconds to avoid breaking API rate limits
-        time.sleep(5)
+                changed = []
+                for issue in issues:
+                    db_issue, created = db_issues[issue.key]
+                    logger.debug("Processing Jira issue %s for user %s", issue.key, requester.username)
+                    updated = issue.fields.updated or issue.fields.created or get_utc_timestamp()
+                    updated_ts = parse_dt(updated).timestamp()
+                    if not since or updated_ts > parse_dt(since).timestamp():
+                        since = updated
+                    if not created and db_issue.last_updated_ts:
+                        # compare timestamps and skip the deal if it hasn't been updated
+                        if db_issue.last_updated_ts >= updated_ts:
+                            logger.debug("Issue '%s' for user '%s' hasn't changed", issue.key, requester.username)
+                            continue
+                    db_issue.primary_keywords = JIRA_KEYWORDS['primary']
+                    db_issue.secondary_keywords = JIRA_KEYWORDS['secondary']
+                    db_issue.last_updated = updated
+                    db_issue.last_updated_ts = updated_ts
+                    db_issue.webview_link = '{}/browse/{}'.format(project._options.get('server'), issue.key)
+                    db_issue.jira_issue_title = '{}: {}'.format(issue.key, issue.fields.summary)
+                    db_issue.jira_issue_status = issue.fields.status.name
+                    db_issue.jira_issue_type = issue.fields.issuetype.name
+                    db_issue.jira_issue_priority = issue.fields.priority.name
+                    if issue.fields.description:
+                        db_issue.jira_issue_description = cut_utf_string(issue.fields.description, 9000)
+                    db_issue.jira_issue_duedate = issue.fields.duedate
+                    db_issue.jira_issue_labels = issue.fields.labels
+                    db_issue.jira_issue_assignee = {
+                        'name': issue.fields.assignee.displayName,
+                        'avatar': issue.fields.assignee.raw.get('avatarUrls', {})
+                    } if issue.fields.assignee else {}
+                    reporter = issue.fields.reporter or issue.fields.creator
+                    db_issue.jira_issue_reporter = {
+                        'name': reporter.displayName,
+                        'avatar': reporter.raw.get('avatarUrls', {})
+                    }
+                    db_issue.jira_project_name = project_name
+                    db_issue.jira_project_key = project_key
+                    db_issue.jira_project_link = project_url
+                    db_issue.last_synced = get_utc_timestamp()
+                    db_issue.download_status = Document.READY
+                    changed.append((db_issue, created))
+                bulk_save(Document, [x[0] for x in changed], 'jira_issue_key',
+                          requester=requester, user_id=requester.id)
+                for db_issue, created in changed:
+                    algolia_engine.sync(db_issue, add=created)
+                i = i + len(issues)
+                if since:
+                    # issues are sorted by update time, so everything up to 'since' has been synced
+                    watermarks[project_key] = since
+                    set_sync_state(requester, 'jira-oauth', 'watermarks', watermarks)
+                    cursor.update({'project': project_key, 'since': since})
+                    cursor.checkpoint()
+                if len(issues) < 1 or i >= issues.total:
+                    break
+            done_projects.append(project_key)
+            cursor.checkpoint()
+
+
+def _to_jql_date(updated):
+    """ JQL only supports minute precision, so go back a bit to not miss any issues. """
+    return (parse_dt(updated) - JIRA_WATERMARK_OVERLAP).strftime('%Y/%m/%d %H:%M')
 
 
 def init_jira_client(user):
@@ -117,7 +162,7 @@ def init_jira_client(user):
     if not social:
         return None
 
-    return JIRA(
+    client = JIRA(
         options={'server': user.userattributes.jira_server},
         oauth={
             'access_token': social.extra_data.get('oauth_token'),
@@ -126,6 +171,11 @@ def init_jira_client(user):
             'key_cert': _get_cert()
         }
     )
+    # conditional requests, see http_cache
+    adapter = CachingAdapter('jira-oauth', social.extra_data.get('oauth_token'))
+    client._session.mount('https://', adapter)
+    client._session.mount('http://', adapter)
+    return client
 
 
 def _get_cert():
@@ -3,13 +3,15 @@ Pipedrive API integration. At the moment there is no special optimization or wor
 we simply list all deals and store them to database.
 """
 from pypedriver import Client
-import time
 from dateutil.parser import parse as parse_dt
 from celery import shared_task
 
-from dataimporter.task_util import should_sync, should_queue, get_utc_timestamp
-from dataimporter.models import Document
+from dataimporter.task_util import (
+    should_sync, loads_requester, holds_lease, resumable, should_queue, get_utc_timestamp, chunked
+)
+from dataimporter.models import Document, bulk_get_or_create, bulk_save
 from dataimporter.algolia.engine import algolia_engine
+from dataimporter.rate_limit import RateLimiter, MAX_BLOCKING_WAIT
 from social.apps.django_app.default.models import UserSocialAuth
 import logging
 logger = logging.getLogger(__name__)
@@ -22,8 +24,8 @@ PIPEDRIVE_KEYWORDS = {
 
 def start_synchronization(user):
     """ Run initial syncing of deals data in pipedrive. """
-    if should_sync(user, 'pipedrive-apikeys', 'tasks.pipedrive'):
-        collect_deals.delay(requester=user)
+    if should_sync(user, 'pipedrive-apikeys'):
+        collect_deals.delay(requester=user.id)
     else:
         logger.info("Pipedrive api key for user '%s' already in use, skipping sync ...", user.username)
 
@@ -40,50 +42,73 @@ def update_synchronization():
 
 
 @shared_task
-def collect_deals(requester):
+@loads_requester
+@holds_lease('pipedrive-apikeys')
+@resumable('pipedrive-apikeys')
+def collect_deals(requester, cursor=None):
     pipe_client = init_pipedrive_client(requester)
+    limiter = RateLimiter.for_user(requester, 'pipedrive-apikeys', max_wait=MAX_BLOCKING_WAIT)
+    limiter.acquire(2)
     stages = {s.id: s.name for s in pipe_client.Stage.fetch_all()}
     users = {u.id: u for u in pipe_client.User.fetch_all()}
     # fallback domain
-    org_domain = None
-
-    for deal in pipe_client.Deal.fetch_all():
-        if deal.org_id:
-            org_domain = deal.org_id.get('cc_email', '').split('@')[0]
-        if not org_domain:
-            # cannot associate a deal to a company
-            logger.debug("Deal '%s' for user '%s' cannot be associated to a company", deal.title, requester.username)
-            continue
-        db_deal, created = Document.objects.get_or_create(
-            pipedrive_deal_id=deal.id,
-            requester=requester,
-            user_id=requester.id
-        )
-        if not created and db_deal.last_updated_ts:
-            # compare timestamps and skip the deal if it hasn't been updated
-            if db_deal.last_updated_ts >= parse_dt(deal.update_time).timestamp():
-                logger.debug("Deal '%s' for user '%s' hasn't changed", deal.title, requester.username)
-                continue
-
-        db_deal.primary_keywords = PIPEDRIVE_KEYWORDS['primary']
-        db_deal.secondary_keywords = PIPEDRIVE_KEYWORDS['secondary']
-        db_deal.pipedrive_title = deal.title
-        logger.debug("Processing deal '%s' for user '%s'", deal.title, requester.username)
-        db_deal.pipedrive_deal_company = deal.org_id.get('name') if deal.org_id else None
-        db_deal.pipedrive_deal_value = deal.value
-        db_deal.pipedrive_deal_currency = deal.currency
-        db_deal.pipedrive_deal_status = deal.status
-        db_deal.pipedrive_deal_stage = stages.get(deal.stage_id)
-        db_deal.webview_link = 'https://{}.pipedrive.com/deal/{}'.format(org_domain, deal.id)
-        db_deal.last_updated = parse_dt(deal.update_time).isoformat() + 'Z'
-        db_deal.last_updated_ts = parse_dt(deal.update_time).timestamp()
-        db_deal.pipedrive_content = build_deal_content(deal, users, org_domain, pipe_client)
-        db_deal.last_synced = get_utc_timestamp()
-        db_deal.download_status = Document.READY
-        db_deal.save()
-        algolia_engine.sync(db_deal, add=created)
-        # add sleep of one second to avoid breaking API rate limits
-        time.sleep(1)
+    org_domain = cursor.get('org_domain')
+
+    # continue after the deals that were already processed before the task was re-queued or restarted
+    start = cursor.get('start', 0)
+    with algolia_engine.batch(max_items=100):
+        for deals in chunked(pipe_client.Deal.fetch_all(start=start), 100):
+            limiter.acquire()
+            db_deals = bulk_get_or_create(
+                Document, 'pipedrive_deal_id', [deal.id for deal in deals],
+                requester=requester,
+                user_id=requester.id
+            )
+            changed = []
+            for deal in deals:
+                if deal.org_id:
+                    org_domain = deal.org_id.get('cc_email', '').split('@')[0]
+                if not org_domain:
+                    # cannot associate a deal to a company
+                    logger.debug("Deal '%s' for user '%s' cannot be associated to a company",
+                                 deal.title, requester.username)
+                    continue
+                db_deal, created = db_deals[str(deal.id)]
+                if not created and db_deal.last_updated_ts:
+                    # compare timestamps and skip the deal if it hasn't been updated
+                    if db_deal.last_updated_ts >= parse_dt(deal.update_time).timestamp():
+                        logger.debug("Deal '%s' for user '%s' hasn't changed", deal.title, requester.username)
+                        continue
+
+                db_deal.primary_keywords = PIPEDRIVE_KEYWORDS['primary']
+                db_deal.secondary_keywords = PIPEDRIVE_KEYWORDS['secondary']
+                db_deal.pipedrive_title = deal.title
+                logger.debug("Processing deal '%s' for user '%s'", deal.title, requester.username)
+                db_deal.pipedrive_deal_company = deal.org_id.get('name') if deal.org_id else None
+                db_deal.pipedrive_deal_value = deal.value
+                db_deal.pipedrive_deal_currency = deal.currency
+                db_deal.pipedrive_deal_status = deal.status
+                db_deal.pipedrive_deal_stage = stages.get(deal.stage_id)
+                db_deal.webview_link = 'https://{}.pipedrive.com/deal/{}'.format(org_domain, deal.id)
+                db_deal.last_updated = parse_dt(deal.update_time).isoformat() + 'Z'
+                db_deal.last_updated_ts = parse_dt(deal.update_time).timestamp()
+                limiter.acquire(_deal_content_requests(deal))
+                db_deal.pipedrive_content = build_deal_content(deal, users, org_domain, pipe_client)
+                db_deal.last_synced = get_utc_timestamp()
+                db_deal.download_status = Document.READY
+                changed.append((db_deal, created))
+            bulk_save(Document, [x[0] for x in changed], 'pipedrive_deal_id',
+                      requester=requester, user_id=requester.id)
+            for db_deal, created in changed:
+                algolia_engine.sync(db_deal, add=created)
+            start = start + len(deals)
+            cursor.update({'start': start, 'org_domain': org_domain})
+            cursor.checkpoint()
+
+
+def _deal_content_requests(deal):
+    """ Number of API requests that build_deal_content() makes for the deal. """
+    return sum([deal.participants_count > 1, deal.followers_count > 1, deal.done_activities_count > 0])
 
 
 def build_deal_content(deal, users, org_domain, pipe_client):
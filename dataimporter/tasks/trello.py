@@ -1,19 +1,25 @@
 """
 Trello API integration. Indexing (open) boards, lists and cards.
 """
+import json
 from collections import defaultdict
 from operator import itemgetter
 from trello import TrelloClient, Board
 from trello.exceptions import ResourceUnavailable
-import time
 from dateutil.parser import parse as parse_dt
 from celery import shared_task, subtask
 from django.conf import settings
 import markdown
 
-from dataimporter.task_util import should_sync, should_queue, cut_utf_string, get_utc_timestamp
-from dataimporter.models import Document
+from dataimporter.task_util import (
+    should_sync, loads_requester, holds_lease, resumable, should_queue, cut_utf_string, get_utc_timestamp,
+    stash_lookups, get_lookups, LOOKUPS_TTL
+)
+from dataimporter.models import Document, bulk_get_or_create, bulk_save
 from dataimporter.algolia.engine import algolia_engine
+from dataimporter.algolia.index import TRELLO_BOARD_FIELDS, TRELLO_BOARD_CONTENT_FIELDS
+from dataimporter.rate_limit import RateLimiter, MAX_BLOCKING_WAIT
+from cuely.queue_util import get_redis
 from social.apps.django_app.default.models import UserSocialAuth
 import logging
 logger = logging.getLogger(__name__)
@@ -27,8 +33,8 @@ TRELLO_SECONDARY_KEYWORDS = {
 
 def start_synchronization(user):
     """ Run initial syncing of boards data in trello. """
-    if should_sync(user, 'trello', 'tasks.trello'):
-        collect_boards.delay(requester=user)
+    if should_sync(user, 'trello'):
+        collect_boards.delay(requester=user.id)
     else:
         logger.info("Trello oauth token for user '%s' already in use, skipping sync ...", user.username)
 
@@ -45,11 +51,19 @@ def update_synchronization():
 
 
 @shared_task
-def collect_boards(requester):
+@loads_requester
+@holds_lease('trello')
+@resumable('trello')
+def collect_boards(requester, cursor=None):
     trello_client = init_trello_client(requester)
+    limiter = RateLimiter.for_user(requester, 'trello', max_wait=MAX_BLOCKING_WAIT)
     orgs = dict()
+    done_boards = cursor.setdefault('done_boards', [])
 
+    limiter.acquire()
     for board in trello_client.list_boards(board_filter='open,closed'):
+        if board.id in done_boards:
+            continue
         db_board, created = Document.objects.get_or_create(
             trello_board_id=board.id,
             trello_card_id__isnull=True,
@@ -64,6 +78,7 @@ def collect_boards(requester):
                 board_last_activity = db_board.last_updated.isoformat()
             else:
                 # Trello was established in 2011, so we use 01.01.2011 as epoch
+                limiter.acquire()
                 actions = board.fetch_actions(action_filter='all', action_limit=1, since='2011-01-01T00:00:00.000Z')
                 if actions:
                     board_last_activity = actions[0].get('date')
@@ -87,6 +102,7 @@ def collect_boards(requester):
         orgId = board.raw.get('idOrganization')
         if orgId and orgId not in orgs:
             try:
+                limiter.acquire()
                 org = trello_client.get_organization(orgId).raw
                 orgs[orgId] = {
                     'name': org.get('displayName'),
@@ -104,13 +120,12 @@ def collect_boards(requester):
             'closed': l.closed,
             'pos': l.pos
         }
+        # lists and members of the board
+        limiter.acquire(2)
         all_lists = {l.id: build_list(l) for l in board.all_lists()}
         db_board.trello_content = {
             'description': _to_html(board.description),
-            'lists': sorted(
-                filter(lambda x: not x.get('closed'), all_lists.values()),
-                key=itemgetter('pos')
-            )
+            'lists': _open_lists(all_lists)
         }
 
         build_member = lambda m: {
@@ -124,69 +139,95 @@ def collect_boards(requester):
         db_board.last_synced = get_utc_timestamp()
         db_board.download_status = Document.READY
         db_board.save()
-        algolia_engine.sync(db_board, add=created)
-        subtask(collect_cards).delay(requester, db_board, board.name, all_members, all_lists)
-        # add sleep of 30s to avoid breaking api limits
-        time.sleep(30)
+        # lists with cards of existing boards stay in the index until collect_cards() updates them
+        algolia_engine.sync(db_board, add=created, fields=None if created else TRELLO_BOARD_FIELDS)
+        lookups_key = stash_lookups(members=all_members, lists=all_lists)
+        subtask(collect_cards).delay(requester.id, db_board.id, lookups_key)
+        done_boards.append(board.id)
+        cursor.checkpoint()
 
 
 @shared_task
-def collect_cards(requester, db_board, board_name, board_members, all_lists):
+@loads_requester
+@holds_lease('trello')
+@resumable('trello', key=lambda requester, db_board_id, *args, **kwargs: db_board_id)
+def collect_cards(requester, db_board_id, lookups_key, cursor=None):
+    db_board = Document.objects.filter(id=db_board_id).first()
+    lookups = get_lookups(lookups_key)
+    if not (db_board and lookups):
+        logger.info("Trello board %s for user '%s' was removed or its lookups expired, skipping ...",
+                    db_board_id, requester.username)
+        return
+    board_members, all_lists = lookups['members'], lookups['lists']
+    open_cards_key = 'trello:open_cards:{}'.format(db_board_id)
+    if not cursor:
+        # not resumed, drop the open cards left over by a failed sync
+        get_redis().delete(open_cards_key)
     trello_client = init_trello_client(requester)
     # make an instance of py-trello's Board object to have access to relevant api calls
     board = Board(client=trello_client, board_id=db_board.trello_board_id)
-    board.name = board_name
-    # load all checklists
+    limiter = RateLimiter.for_user(requester, 'trello', max_wait=MAX_BLOCKING_WAIT)
+    # load board details and all checklists
+    limiter.acquire(2)
+    board.fetch()
     checklists = defaultdict(list)
     for cl in board.get_checklists():
         checklists[cl.card_id].append(cl)
-    open_cards = collect_cards_internal(requester, board, board_members, checklists, all_lists, card_status='open')
-    # request closed cards separately to have a better chance to index all open cards
-    # (thus avoiding hitting rate limits already in open cards indexing)
-    collect_cards_internal(requester, board, board_members, checklists, all_lists, card_status='closed')
+    with algolia_engine.batch():
+        if cursor.get('status', 'open') == 'open':
+            collect_cards_internal(
+                requester, board, board_members, checklists, all_lists, limiter, cursor, card_status='open',
+                open_cards_key=open_cards_key)
+            cursor.update({'status': 'closed', 'before': None})
+            cursor.checkpoint()
+        # request closed cards separately to have a better chance to index all open cards
+        # (thus avoiding hitting rate limits already in open cards indexing)
+        collect_cards_internal(
+            requester, board, board_members, checklists, all_lists, limiter, cursor, card_status='closed')
 
     # update board lists with a list of cards
     lists_with_cards = defaultdict(list)
-    for ac in open_cards:
-        lists_with_cards[ac.idList].append({
-            'id': ac.id,
-            'name': ac.name,
-            'pos': ac.pos,
-            'url': ac.url
-        })
-    board_lists = db_board.trello_content.get('lists', [])
+    for ac in _load_open_cards(open_cards_key).values():
+        lists_with_cards[ac.pop('list_id')].append(ac)
+    board_lists = _open_lists(all_lists)
     for bl in board_lists:
         bl.update({
             'cards': sorted(lists_with_cards[bl['id']], key=itemgetter('pos'))
         })
     db_board.trello_content = {
-        'description': db_board.trello_content.get('description'),
+        'description': _to_html(board.description),
         'lists': board_lists
     }
-    db_board.save()
-    algolia_engine.sync(db_board, add=False)
+    algolia_engine.sync(db_board, fields=TRELLO_BOARD_CONTENT_FIELDS)
+    get_redis().delete(open_cards_key)
 
 
-def collect_cards_internal(requester, board, board_members, checklists, lists, card_status):
-    collected_cards = []
-    last_card_id = None
+def collect_cards_internal(requester, board, board_members, checklists, lists, limiter, cursor, card_status,
+                           open_cards_key=None):
+    """
+    Sync board's cards with 'card_status'. The paging position is checkpointed in the 'cursor', while
+    open cards collected so far are appended to a redis list at 'open_cards_key' (see _load_open_cards()).
+    """
+    last_card_id = cursor.get('before')
     while True:
         filters = {'filter': 'all', 'fields': 'all', 'limit': '1000'}
         if last_card_id:
             # Trello api supports paging by using the id of the last card in the previous batch as 'before' parameter
             filters['before'] = last_card_id
+        limiter.acquire()
         cards = board.get_cards(filters=filters, card_filter=card_status)
+        db_cards = bulk_get_or_create(
+            Document, 'trello_card_id', [card.id for card in cards],
+            trello_board_id=board.id,
+            requester=requester,
+            user_id=requester.id
+        )
+        changed = []
         for card in cards:
-            db_card, created = Document.objects.get_or_create(
-                trello_board_id=board.id,
-                trello_card_id=card.id,
-                requester=requester,
-                user_id=requester.id
-            )
+            db_card, created = db_cards[card.id]
             card_last_activity = card.raw.get('dateLastActivity')
             last_activity = parse_dt(card_last_activity).isoformat()
             last_activity_ts = int(parse_dt(card_last_activity).timestamp())
-            collected_cards.append(card)
             if not created and db_card.last_updated_ts and db_card.last_updated_ts >= last_activity_ts:
                 logger.debug("Trello card '%s' for user '%s' hasn't changed", card.name[:50], requester.username)
                 continue
@@ -214,12 +255,43 @@ def collect_cards_internal(requester, board, board_members, checklists, lists, c
             db_card.trello_list = lists.get(card.idList)
             db_card.last_synced = get_utc_timestamp()
             db_card.download_status = Document.READY
-            db_card.save()
+            changed.append((db_card, created))
+        bulk_save(Document, [x[0] for x in changed], 'trello_card_id',
+                  trello_board_id=board.id, requester=requester, user_id=requester.id)
+        for db_card, created in changed:
             algolia_engine.sync(db_card, add=created)
-            last_card_id = card.id
+        if open_cards_key and cards:
+            r = get_redis().pipeline()
+            r.rpush(open_cards_key, *(json.dumps({
+                'id': card.id,
+                'name': card.name,
+                'pos': card.pos,
+                'url': card.url,
+                'list_id': card.idList
+            }) for card in cards))
+            r.expire(open_cards_key, LOOKUPS_TTL)
+            r.execute()
+        if cards:
+            # use the last card of this batch for paging, regardless of whether it has changed or not
+            last_card_id = cards[-1].id
+            cursor['before'] = last_card_id
+        cursor.checkpoint()
         if len(cards) < 1000:
             break
-    return collected_cards
+
+
+def _load_open_cards(open_cards_key):
+    """
+    Open cards collected by collect_cards_internal(), by card id. A page can be appended twice, if the task
+    was re-queued or restarted before checkpointing it.
+    """
+    cards = (json.loads(x.decode('UTF-8')) for x in get_redis().lrange(open_cards_key, 0, -1))
+    return {c['id']: c for c in cards}
+
+
+def _open_lists(all_lists):
+    """ Open lists of a board, in the order shown on the board. """
+    return sorted(filter(lambda x: not x.get('closed'), all_lists.values()), key=itemgetter('pos'))
 
 
 def init_trello_client(user):
@@ -238,5 +310,5 @@ def _to_html(markdown_text, max_len=8000):
     if not markdown_text:
         return None
     # convert markdown to html (replace any <em> tags with bold tags, because <em> is reserved by Algolia
-    md = markdown.markdown(cut_utf_string(markdown_text, max_len, step=100))
+    md = markdown.markdown(cut_utf_string(markdown_text, max_len))
     return md.replace('<em>', '<b>').replace('</em>', '</b>')
@@ -1,3 +1,340 @@
-from django.test import TestCase
+import os
+import json
+import tempfile
+from datetime import datetime, timezone
+from unittest import mock
+from django.contrib.auth.models import User
+from django.test import TestCase, SimpleTestCase, override_settings
 
-# Create your tests here.
+import requests
+from requests.structures import CaseInsensitiveDict
+from jira.exceptions import JIRAError
+
+from cuely.queue_util import get_redis
+from dataimporter.task_util import holds_lease, resumable, should_sync, fit_record, RateLimited
+from dataimporter.rate_limit import RateLimiter
+from dataimporter.algolia.engine import AlgoliaBatch
+from dataimporter.algolia.local import LocalEngine
+from dataimporter.http_cache import CachingAdapter, ResponseCache, get_cache_stats
+from dataimporter.models import Document, bulk_get_or_create, bulk_save, bulk_update
+from dataimporter.tasks.github import FileHistory, resolve_file_history, _merge_comments, ISSUE_MAX_COMMENTS
+
+
+class ResumableTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='resumable-test')
+        patcher = mock.patch('dataimporter.task_util.get_api_credential', return_value='resumable-test-credential')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_credential_stays_leased_until_resumed(self):
+        @holds_lease('test')
+        @resumable('test')
+        def sync(requester, cursor=None):
+            self.assertFalse(should_sync(self.user, 'test'))
+            raise RateLimited('test', 30)
+
+        with mock.patch('dataimporter.task_util.current_app') as app:
+            sync(self.user)
+        app.tasks.__getitem__.return_value.apply_async.assert_called_once()
+        # the task has returned, but it's waiting to be resumed
+        self.assertFalse(should_sync(self.user, 'test'))
+
+    def test_throttled_request_requeues_task(self):
+        @holds_lease('jira-oauth')
+        @resumable('jira-oauth')
+        def sync(requester, cursor=None):
+            cursor['start'] = 100
+            response = mock.Mock(status_code=429, headers={'Retry-After': '120'})
+            raise JIRAError(status_code=429, response=response)
+
+        with mock.patch('dataimporter.task_util.current_app') as app:
+            sync(self.user)
+        apply_async = app.tasks.__getitem__.return_value.apply_async
+        apply_async.assert_called_once_with(args=(self.user.id,), kwargs={'cursor': {'start': 100}}, countdown=120)
+        self.assertFalse(should_sync(self.user, 'jira-oauth'))
+        # other tasks with the same credential wait as well
+        self.assertGreater(RateLimiter.for_user(self.user, 'jira-oauth').try_acquire(), 100)
+
+
+class FitRecordTest(SimpleTestCase):
+    def test_escaped_texts_fit_into_json_budget(self):
+        comments = [{'body': 'Čćžš "quoted"\n\tnew line \u65e5\u672c\U0001F600 \\ ' * 200} for _ in range(5)]
+        record = {'body': 'He said: "hi"\r\n' * 500, 'comments': comments}
+        dropped = fit_record(record, [(record, 'body')] + [(c, 'body') for c in comments], 9000, min_len=100)
+        record['comments'] = [c for c in comments if c not in dropped]
+        self.assertLessEqual(len(json.dumps(record)), 9000)
+        self.assertLessEqual(len(json.dumps(record, ensure_ascii=False).encode('UTF-8')), 9000)
+        self.assertTrue(record['comments'])
+
+
+def _commit(sha, committer, day, *filenames):
+    cmt = mock.Mock(sha=sha, parents=[mock.Mock()], files=[mock.Mock(filename=f) for f in filenames], committer=None)
+    cmt.commit.committer.name = committer
+    cmt.commit.committer.date = datetime(2017, 1, day, tzinfo=timezone.utc)
+    return cmt
+
+
+class FileHistoryTest(SimpleTestCase):
+    def _repo(self, commits):
+        def get_commits(sha, path=None):
+            return [cmt for cmt in commits
+                    if path is None or any(f.filename == path or f.filename.startswith(path + '/') for f in cmt.files)]
+        return mock.Mock(get_commits=mock.Mock(side_effect=get_commits))
+
+    def _committers(self, history, path):
+        return [c['name'] for c in history[path]['committers']]
+
+    def test_incremental_sync_keeps_older_committers(self):
+        commits = [
+            _commit('c3', 'Carol', 3, 'src/a.py'),
+            _commit('c2', 'Bob', 2, 'src/a.py'),
+            _commit('c1', 'Alice', 1, 'src/a.py', 'b.py'),
+        ]
+        history = FileHistory(['src/a.py', 'b.py', 'src'])
+        resolve_file_history(self._repo(commits), 'master', history, mock.Mock(), {})
+        self.assertEqual(self._committers(history, 'src/a.py'), ['Carol', 'Bob', 'Alice'])
+
+        commits.insert(0, _commit('c4', 'Dave', 4, 'src/a.py'))
+        history = FileHistory(['src/a.py', 'src'])
+        resolve_file_history(self._repo(commits), 'master', history, mock.Mock(), {}, incremental=True)
+        self.assertEqual(self._committers(history, 'src/a.py'), ['Dave', 'Carol', 'Bob', 'Alice'])
+        self.assertEqual(self._committers(history, 'src'), ['Dave', 'Carol', 'Bob', 'Alice'])
+        self.assertEqual(history['src/a.py']['ts'], datetime(2017, 1, 4, tzinfo=timezone.utc).timestamp())
+
+
+class IssueCommentsTest(SimpleTestCase):
+    def test_updated_comments_are_merged_into_synced_ones(self):
+        synced = [{'id': 1, 'body': 'first'}, {'id': 2, 'body': 'second'}]
+        listed = [{'id': 2, 'body': 'second, edited'}, {'id': 3, 'body': 'third'}]
+        self.assertEqual(_merge_comments(synced, listed), [
+            {'id': 1, 'body': 'first'},
+            {'id': 2, 'body': 'second, edited'},
+            {'id': 3, 'body': 'third'},
+        ])
+
+    def test_merged_comments_are_capped(self):
+        synced = [{'id': i, 'body': ''} for i in range(ISSUE_MAX_COMMENTS)]
+        merged = _merge_comments(synced, [{'id': ISSUE_MAX_COMMENTS, 'body': 'newest'}])
+        self.assertEqual(merged, synced)
+
+
+class AlgoliaBatchTest(SimpleTestCase):
+    def test_writes_of_an_object_are_merged(self):
+        index = mock.Mock()
+        batch = AlgoliaBatch()
+        batch.add(index, AlgoliaBatch.PARTIAL, {'objectID': 1, 'title': 'old'})
+        batch.add(index, AlgoliaBatch.SAVE, {'objectID': 1, 'title': 'new', 'content': 'text'})
+        batch.add(index, AlgoliaBatch.SAVE, {'objectID': 2, 'title': 'two', 'content': 'text'})
+        batch.add(index, AlgoliaBatch.PARTIAL, {'objectID': 2, 'content': 'more text'})
+        batch.flush()
+        index.partial_update_objects.assert_not_called()
+        index.save_objects.assert_called_once_with([
+            {'objectID': 1, 'title': 'new', 'content': 'text'},
+            {'objectID': 2, 'title': 'two', 'content': 'more text'},
+        ])
+
+    def test_flushed_when_full(self):
+        index = mock.Mock()
+        batch = AlgoliaBatch(max_items=3)
+        for i in range(7):
+            batch.add(index, AlgoliaBatch.SAVE, {'objectID': i})
+        self.assertEqual(
+            [c[0][0] for c in index.save_objects.call_args_list],
+            [[{'objectID': 0}, {'objectID': 1}, {'objectID': 2}], [{'objectID': 3}, {'objectID': 4}, {'objectID': 5}]]
+        )
+        batch.flush()
+        index.save_objects.assert_called_with([{'objectID': 6}])
+
+    def test_flushed_when_payload_is_too_large(self):
+        index = mock.Mock()
+        batch = AlgoliaBatch(max_bytes=1000)
+        batch.add(index, AlgoliaBatch.SAVE, {'objectID': 1, 'content': 'x' * 600})
+        index.save_objects.assert_not_called()
+        batch.add(index, AlgoliaBatch.SAVE, {'objectID': 2, 'content': 'y' * 600})
+        index.save_objects.assert_called_once_with([
+            {'objectID': 1, 'content': 'x' * 600},
+            {'objectID': 2, 'content': 'y' * 600},
+        ])
+
+
+class BulkSaveTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='bulk-save-test')
+        self.filter_args = {'trello_board_id': 'board', 'requester': self.user, 'user_id': self.user.id}
+
+    def test_rows_inserted_by_another_task_are_updated(self):
+        cards = bulk_get_or_create(Document, 'trello_card_id', ['a', 'b'], **self.filter_args)
+        # another task inserts one of the cards in the meantime
+        other = Document.objects.create(trello_card_id='a', **self.filter_args)
+        for card, created in cards.values():
+            self.assertTrue(created)
+            card.trello_title = 'Card {}'.format(card.trello_card_id)
+        bulk_save(Document, [x[0] for x in cards.values()], 'trello_card_id', **self.filter_args)
+        self.assertEqual(cards['a'][0].pk, other.pk)
+        self.assertEqual(
+            dict(Document.objects.filter(**self.filter_args).values_list('trello_card_id', 'trello_title')),
+            {'a': 'Card a', 'b': 'Card b'}
+        )
+
+
+class BulkUpdateTest(TestCase):
+    def test_each_object_gets_its_own_values(self):
+        user = User.objects.create(username='bulk-update-test')
+        docs = [
+            Document.objects.create(requester=user, user_id=user.id, trello_card_id=str(i), trello_title='old')
+            for i in range(5)
+        ]
+        for i, doc in enumerate(docs):
+            doc.trello_title = 'Card {}'.format(i)
+            doc.last_updated_ts = 1000 + i
+            doc.trello_card_id = 'changed'
+        bulk_update(Document, docs, fields=['trello_title', 'last_updated_ts'], batch_size=2)
+        self.assertEqual(
+            list(Document.objects.filter(requester=user).order_by('id').values_list(
+                'trello_card_id', 'trello_title', 'last_updated_ts')),
+            [(str(i), 'Card {}'.format(i), 1000 + i) for i in range(5)]
+        )
+
+
+class LocalEngineTest(SimpleTestCase):
+    def setUp(self):
+        fd, path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.index = LocalEngine(path).init_index('local-test')
+        self.index.set_settings({
+            'attributesToIndex': ['title', 'unordered(content)'],
+            'customRanking': ['desc(last_updated_ts)']
+        })
+
+    def _search(self, query, user_id=1):
+        return [x['objectID'] for x in self.index.search(query, user_id)]
+
+    def test_title_matches_rank_first(self):
+        self.index.save_objects([
+            {'objectID': 'in-content', 'user_id': 1, 'title': 'Notes', 'content': 'q3 report', 'last_updated_ts': 3},
+            {'objectID': 'in-title', 'user_id': 1, 'title': 'Q3 report', 'content': 'notes', 'last_updated_ts': 1},
+            {'objectID': 'other', 'user_id': 1, 'title': 'Q3', 'content': 'plan', 'last_updated_ts': 2},
+        ])
+        self.assertEqual(self._search('repo q3'), ['in-title', 'in-content'])
+
+    def test_ties_are_ranked_by_custom_ranking(self):
+        self.index.save_objects([
+            {'objectID': str(ts), 'user_id': 1, 'title': 'Weekly report', 'last_updated_ts': ts} for ts in (2, 3, 1)
+        ])
+        self.assertEqual(self._search('report'), ['3', '2', '1'])
+
+    def test_objects_of_other_users_are_not_found(self):
+        self.index.save_objects([
+            {'objectID': 'mine', 'user_id': 1, 'title': 'Report'},
+            {'objectID': 'theirs', 'user_id': 2, 'title': 'Report'},
+        ])
+        self.assertEqual(self._search('report'), ['mine'])
+
+    def test_updated_and_deleted_objects(self):
+        self.index.save_objects([
+            {'objectID': 'a', 'user_id': 1, 'title': 'Draft', 'content': 'budget'},
+            {'objectID': 'b', 'user_id': 1, 'title': 'Budget'},
+        ])
+        self.index.partial_update_object({'objectID': 'a', 'title': 'Final'})
+        self.index.delete_object('b')
+        self.assertEqual(self._search('final budget'), ['a'])
+        self.assertEqual(self._search('draft'), [])
+
+
+@override_settings(API_RATE_LIMITS={'limit-test': (10, 10)})
+class RateLimiterTest(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('dataimporter.rate_limit.time')
+        self.time = patcher.start()
+        self.time.time.return_value = 1000.0
+        self.time.sleep.side_effect = lambda seconds: setattr(
+            self.time.time, 'return_value', self.time.time.return_value + seconds)
+        self.addCleanup(patcher.stop)
+
+    def _limiter(self, max_wait=None):
+        limiter = RateLimiter('limit-test', 'limit-test-credential', max_wait=max_wait)
+        self.addCleanup(get_redis().delete, limiter.key)
+        return limiter
+
+    def test_bucket_is_refilled_over_time(self):
+        limiter = self._limiter()
+        self.assertEqual(limiter.try_acquire(10), 0)
+        self.assertAlmostEqual(limiter.try_acquire(), 1)
+        self.time.time.return_value = 1005.0
+        self.assertEqual(limiter.try_acquire(5), 0)
+        self.assertAlmostEqual(limiter.try_acquire(2), 2)
+        # never refilled above the capacity
+        self.time.time.return_value = 2000.0
+        self.assertEqual(limiter.try_acquire(10), 0)
+        self.assertAlmostEqual(limiter.try_acquire(), 1)
+
+    def test_short_waits_block(self):
+        limiter = self._limiter(max_wait=5)
+        limiter.acquire(10)
+        limiter.acquire(3)
+        self.time.sleep.assert_called_once_with(3)
+
+    def test_long_waits_raise_rate_limited(self):
+        limiter = self._limiter(max_wait=5)
+        limiter.acquire(10)
+        with self.assertRaises(RateLimited) as raised:
+            limiter.acquire(8)
+        self.assertEqual(raised.exception.countdown, 8)
+        self.time.sleep.assert_not_called()
+
+    def test_blocked_bucket_stays_empty(self):
+        limiter = self._limiter(max_wait=5)
+        limiter.block(120)
+        self.time.time.return_value = 1100.0
+        with self.assertRaises(RateLimited) as raised:
+            limiter.acquire()
+        self.assertEqual(raised.exception.countdown, 20)
+
+
+class CachingAdapterTest(SimpleTestCase):
+    url = 'https://jira.example.com/rest/api/2/search'
+
+    def setUp(self):
+        self.addCleanup(ResponseCache('cache-test', 'cache-test-token').delete, self.url)
+        self.addCleanup(get_redis().delete, 'http-cache:stats:cache-test')
+        patcher = mock.patch('requests.adapters.HTTPAdapter.send')
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _response(status, headers, content=b''):
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = content
+        return response
+
+    def _get(self):
+        adapter = CachingAdapter('cache-test', 'cache-test-token')
+        return adapter.send(requests.Request('GET', self.url).prepare())
+
+    def test_not_modified_response_is_answered_from_cache(self):
+        self.send.return_value = self._response(
+            200, {'ETag': '"v1"', 'Content-Type': 'application/json', 'X-RateLimit-Remaining': '99'}, b'{"total": 1}')
+        self.assertEqual(self._get().content, b'{"total": 1}')
+
+        self.send.return_value = self._response(304, {'ETag': '"v1"', 'X-RateLimit-Remaining': '98'})
+        response = self._get()
+        self.assertEqual(self.send.call_args[0][0].headers['If-None-Match'], '"v1"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'total': 1})
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(response.headers['X-RateLimit-Remaining'], '98')
+        self.assertEqual(get_cache_stats('cache-test'), {'hits': 1, 'misses': 1})
+
+    def test_modified_response_replaces_cached_one(self):
+        self.send.return_value = self._response(200, {'ETag': '"v1"'}, b'old')
+        self._get()
+        self.send.return_value = self._response(200, {'ETag': '"v2"'}, b'new')
+        self.assertEqual(self._get().content, b'new')
+        self.assertEqual(self.send.call_args[0][0].headers['If-None-Match'], '"v1"')
+        self.send.return_value = self._response(304, {'ETag': '"v2"'})
+        self.assertEqual(self._get().content, b'new')
+        self.assertEqual(self.send.call_args[0][0].headers['If-None-Match'], '"v2"')
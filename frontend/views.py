@@ -202,4 +202,4 @@ def _delete_user_internal(user):
 
     # wipe the associated documents in a separate task
     # (can take a long time, but we need to return from this function asap)
-    purge_documents.delay(user, remove_user=True)
+    purge_documents.delay(user.id, remove_user=True)
@@ -6,5 +6,5 @@ rm -rf /var/log/celery_worker*.log
 
 cd /usr/src/app
 
-celery -A cuely --pidfile=/etc/celery_worker.pid worker --concurrency=1 --loglevel=info -Q $1,default &
+celery -A cuely --pidfile=/etc/celery_worker.pid worker --concurrency=${2:-1} --loglevel=info -Q $1,default &
 wait